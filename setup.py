@@ -36,11 +36,18 @@ setup(
     install_requires = [
         'decorator',
         'psutil',
+        'numpy',
         'networkx>=2,<3',
         'cython',
         'pytest',
         'biopython'], # cactus doesn't really need it, but some hal tools do
 
+    # The compression codecs other than gzip (see cactus.shared.compression)
+    extras_require = {
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+    },
+
     cmdclass = {
         'install': PostInstallCommand,
     },
@@ -49,4 +56,5 @@ setup(
                             'cactus-preprocess = cactus.preprocessor.cactus_preprocessor:main',
                             'cactus-prepare = cactus.progressive.cactus_prepare:main',
                             'cactus-blast = cactus.blast.cactus_blast:main',
-                            'cactus-align = cactus.setup.cactus_align:main']},)
+                            'cactus-align = cactus.setup.cactus_align:main',
+                            'cactus-refit-memory = cactus.pipeline.cactus_refitMemory:main']},)
@@ -7,23 +7,31 @@
 sequences. Uses the toil framework to parallelise the blasts.
 """
 import os
+import copy
 import shutil
+import multiprocessing
 from toil.lib.bioio import logger
-from toil.lib.bioio import system
+from toil.lib.bioio import getLogLevelString
 from toil.realtimeLogger import RealtimeLogger
 from toil.lib.threading import cpu_count
 
 from sonLib.bioio import catFiles, nameValue, popenCatch, getTempDirectory
 
 from cactus.shared.common import RoundedJob
-from cactus.shared.common import cactus_call
+from cactus.shared.common import cactus_call, cactus_call_async
 from cactus.shared.common import runLastz, runSelfLastz
 from cactus.shared.common import runCactusRealign, runCactusSelfRealign
 from cactus.shared.common import runGetChunks
 from cactus.shared.common import readGlobalFileWithoutCache
 from cactus.shared.common import ChildTreeJob
+from cactus.shared.common import flattenChildResults
 from cactus.blast.upconvertCoordinates import upconvertCoords
-from cactus.blast.trimSequences import trimSequences
+from cactus.blast.trimSequences import trimSequences, getSeqLengths
+from cactus.blast.cigarCoverage import CigarCoverage
+from cactus.blast.mappingQualityRescoringAndFiltering import mirrorAndSortAlignments, mergeSortedAlignments
+from cactus.shared.fastaStats import FastaStats
+from cactus.shared.compression import getCodec, writeGlobalFileCompressed, readGlobalFileDecompressed
+from cactus.blast.virtualChunks import VirtualChunk, makeVirtualChunks, sourceSize
 
 class BlastOptions(object):
     def __init__(self, chunkSize=10000000, overlapSize=10000,
@@ -43,7 +51,29 @@ class BlastOptions(object):
                  # don't use realign.)
                  trimOutgroupFlanking=2000,
                  keepParalogs=False,
-                 gpuLastz=False):
+                 gpuLastz=False,
+                 # Max number of cores used to trim the ingroups
+                 # and compute their coverage in parallel
+                 trimCores=1,
+                 # Chunk pairs are bundled into jobs of up to this
+                 # many bp (0 to run every pair in its own job)
+                 packSize=0,
+                 # Number of pairs a bundle aligns at once
+                 packCores=1,
+                 # Emit the ingroup alignments mirrored and sorted for
+                 # mapping quality rescoring, merging them as they are
+                 # collated instead of sorting them all at the end
+                 sortResults=False,
+                 # Codec used for the chunks and alignments passed
+                 # between jobs, if compressFiles is set
+                 compressionCodec="gzip",
+                 # Describe the chunks as ranges of the input sequences
+                 # instead of uploading a copy of each chunk
+                 virtualChunks=False,
+                 # Blast jobs are written to the job store in batches
+                 # of this many, for a tree of jobs to add (0 to add
+                 # them all from the job making them)
+                 childBatchSize=0):
         """Class defining options for blast
         """
         self.chunkSize = chunkSize
@@ -66,6 +96,41 @@ class BlastOptions(object):
         self.trimOutgroupFlanking = trimOutgroupFlanking
         self.keepParalogs = keepParalogs
         self.gpuLastz = gpuLastz
+        self.trimCores = trimCores
+        self.packSize = packSize
+        self.packCores = packCores
+        self.sortResults = sortResults
+        self.compressionCodec = compressionCodec
+        self.virtualChunks = virtualChunks
+        self.childBatchSize = childBatchSize
+
+    def getCodec(self):
+        """Get the codec for the chunks and alignments passed between jobs."""
+        return getCodec(self.compressionCodec if self.compressFiles else "none")
+
+def makeChunks(fileStore, sequenceIDs, sequenceFiles, blastOptions):
+    """Chunk up the sequences (local copies of sequenceIDs), returning the
+    IDs of the chunks. If blastOptions.virtualChunks is set these are
+    VirtualChunks that the blast jobs slice out of the sequences
+    themselves, unless the sequences can't be indexed.
+    """
+    if blastOptions.virtualChunks:
+        chunkIDs = makeVirtualChunks(fileStore, sequenceIDs, sequenceFiles,
+                                     blastOptions.chunkSize, blastOptions.overlapSize)
+        if chunkIDs is not None:
+            return chunkIDs
+        logger.info("Sequence lines are too irregular to make virtual chunks, writing the chunks out instead")
+    chunks = runGetChunks(sequenceFiles=sequenceFiles,
+                          chunksDir=getTempDirectory(rootDir=fileStore.getLocalTempDir()),
+                          chunkSize=blastOptions.chunkSize, overlapSize=blastOptions.overlapSize)
+    codec = blastOptions.getCodec()
+    return [writeGlobalFileCompressed(fileStore, chunk, codec, cleanup=True) for chunk in chunks]
+
+def readChunk(fileStore, chunkID, codec):
+    """Get a local copy of a chunk made by makeChunks."""
+    if isinstance(chunkID, VirtualChunk):
+        return chunkID.read(fileStore)
+    return readGlobalFileDecompressed(fileStore, chunkID, codec)
 
 class BlastSequencesAllAgainstAll(RoundedJob):
     """Take a set of sequences, chunks them up and blasts them.
@@ -78,7 +143,6 @@ class BlastSequencesAllAgainstAll(RoundedJob):
         super(BlastSequencesAllAgainstAll, self).__init__(disk=disk, cores=cores, memory=memory, preemptable=True)
         self.sequenceFileIDs1 = sequenceFileIDs1
         self.blastOptions = blastOptions
-        self.blastOptions.compressFiles = False
         self.blastOptions.roundsOfCoordinateConversion = 1
 
     def run(self, fileStore):
@@ -86,13 +150,10 @@ class BlastSequencesAllAgainstAll(RoundedJob):
         if self.blastOptions.gpuLastz == True:
             # wga-gpu has a 6G limit. 
             self.blastOptions.chunkSize = 6000000000
-        chunks = runGetChunks(sequenceFiles=sequenceFiles1,
-                              chunksDir=getTempDirectory(rootDir=fileStore.getLocalTempDir()),
-                              chunkSize=self.blastOptions.chunkSize, overlapSize=self.blastOptions.overlapSize)
-        if len(chunks) == 0:
+        chunkIDs = makeChunks(fileStore, self.sequenceFileIDs1, sequenceFiles1, self.blastOptions)
+        if len(chunkIDs) == 0:
             raise Exception("no chunks produced for files: {} ".format(sequenceFiles1))
         logger.info("Broken up the sequence files into individual 'chunk' files")
-        chunkIDs = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in chunks]
 
         diagonalResultsID = self.addChild(MakeSelfBlasts(self.blastOptions, chunkIDs)).rv()
         offDiagonalResultsID = self.addChild(MakeOffDiagonalBlasts(self.blastOptions, chunkIDs)).rv()
@@ -103,38 +164,34 @@ class MakeSelfBlasts(ChildTreeJob):
     """Breaks up the inputs into bits and builds a bunch of alignment jobs.
     """
     def __init__(self, blastOptions, chunkIDs):
-        super(MakeSelfBlasts, self).__init__(preemptable=True)
+        super(MakeSelfBlasts, self).__init__(preemptable=True, childBatchSize=blastOptions.childBatchSize)
         self.blastOptions = blastOptions
         self.chunkIDs = chunkIDs
 
     def run(self, fileStore):
         logger.info("Chunk IDs: %s" % self.chunkIDs)
-        #Avoid compression if just one chunk
-        self.blastOptions.compressFiles = self.blastOptions.compressFiles and len(self.chunkIDs) > 2
-        resultsIDs = []
-        for i in range(len(self.chunkIDs)):
-            resultsIDs.append(self.addChild(RunSelfBlast(self.blastOptions, self.chunkIDs[i])).rv())
+        resultsIDs = self.addChildBatch([RunSelfBlast(self.blastOptions, chunkID) for chunkID in self.chunkIDs])
         logger.info("Made the list of self blasts")
         #Setup job to make all-against-all blasts
         logger.debug("Collating self blasts.")
         logger.info("Blast file IDs: %s" % resultsIDs)
-        return self.addFollowOn(CollateBlasts(self.blastOptions, resultsIDs)).rv()
+        return self.addFollowOn(CollateBlasts(self.blastOptions, resultsIDs, compressedInputs=True)).rv()
 
 class MakeOffDiagonalBlasts(ChildTreeJob):
         def __init__(self, blastOptions, chunkIDs):
-            super(MakeOffDiagonalBlasts, self).__init__(preemptable=True)
+            super(MakeOffDiagonalBlasts, self).__init__(preemptable=True, childBatchSize=blastOptions.childBatchSize)
             self.chunkIDs = chunkIDs
             self.blastOptions = blastOptions
-            self.blastOptions.compressFiles = False
 
         def run(self, fileStore):
-            resultsIDs = []
             #Make the list of blast jobs.
+            chunkPairs = []
             for i in range(0, len(self.chunkIDs)):
                 for j in range(i+1, len(self.chunkIDs)):
-                    resultsIDs.append(self.addChild(RunBlast(blastOptions=self.blastOptions, seqFileID1=self.chunkIDs[i], seqFileID2=self.chunkIDs[j])).rv())
+                    chunkPairs.append((self.chunkIDs[i], self.chunkIDs[j]))
+            resultsIDs = self.addChildBatch(makeBlastJobs(self.blastOptions, chunkPairs))
 
-            return self.addFollowOn(CollateBlasts(self.blastOptions, resultsIDs)).rv()
+            return self.addFollowOn(CollateBlasts(self.blastOptions, resultsIDs, compressedInputs=True)).rv()
 
 class BlastSequencesAgainstEachOther(ChildTreeJob):
     """Take two sets of sequences, chunks them up and blasts one set against the other.
@@ -144,7 +201,8 @@ class BlastSequencesAgainstEachOther(ChildTreeJob):
         cores = 1
         memory = blastOptions.memory
 
-        super(BlastSequencesAgainstEachOther, self).__init__(disk=disk, cores=cores, memory=memory, preemptable=True)
+        super(BlastSequencesAgainstEachOther, self).__init__(disk=disk, cores=cores, memory=memory, preemptable=True,
+                                                             childBatchSize=blastOptions.childBatchSize)
         self.sequenceFileIDs1 = sequenceFileIDs1
         self.sequenceFileIDs2 = sequenceFileIDs2
         self.blastOptions = blastOptions
@@ -156,20 +214,14 @@ class BlastSequencesAgainstEachOther(ChildTreeJob):
         if self.blastOptions.gpuLastz == True:
             # wga-gpu has a 6G limit. 
             self.blastOptions.chunkSize = 6000000000
-        chunks1 = runGetChunks(sequenceFiles=sequenceFiles1, chunksDir=getTempDirectory(rootDir=fileStore.getLocalTempDir()), chunkSize=self.blastOptions.chunkSize, overlapSize=self.blastOptions.overlapSize)
-        chunks2 = runGetChunks(sequenceFiles=sequenceFiles2, chunksDir=getTempDirectory(rootDir=fileStore.getLocalTempDir()), chunkSize=self.blastOptions.chunkSize, overlapSize=self.blastOptions.overlapSize)
-        chunkIDs1 = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in chunks1]
-        chunkIDs2 = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in chunks2]
-        resultsIDs = []
+        chunkIDs1 = makeChunks(fileStore, self.sequenceFileIDs1, sequenceFiles1, self.blastOptions)
+        chunkIDs2 = makeChunks(fileStore, self.sequenceFileIDs2, sequenceFiles2, self.blastOptions)
         #Make the list of blast jobs.
-        for chunkID1 in chunkIDs1:
-            for chunkID2 in chunkIDs2:
-                #TODO: Make the compression work
-                self.blastOptions.compressFiles = False
-                resultsIDs.append(self.addChild(RunBlast(self.blastOptions, chunkID1, chunkID2)).rv())
+        chunkPairs = [(chunkID1, chunkID2) for chunkID1 in chunkIDs1 for chunkID2 in chunkIDs2]
+        resultsIDs = self.addChildBatch(makeBlastJobs(self.blastOptions, chunkPairs))
         logger.info("Made the list of blasts")
         #Set up the job to collate all the results
-        return self.addFollowOn(CollateBlasts(self.blastOptions, resultsIDs)).rv()
+        return self.addFollowOn(CollateBlasts(self.blastOptions, resultsIDs, compressedInputs=True)).rv()
 
 class BlastIngroupsAndOutgroups(RoundedJob):
     """Blast ingroup sequences against each other, and against the given
@@ -178,7 +230,7 @@ class BlastIngroupsAndOutgroups(RoundedJob):
     outgroup.
     """
     def __init__(self, blastOptions, ingroupNames, ingroupSequenceIDs,
-                 outgroupNames, outgroupSequenceIDs):
+                 outgroupNames, outgroupSequenceIDs, seqLengthsCache=None):
         super(BlastIngroupsAndOutgroups, self).__init__(memory=blastOptions.memory, preemptable=True)
         self.blastOptions = blastOptions
         self.blastOptions.roundsOfCoordinateConversion = 1
@@ -186,6 +238,7 @@ class BlastIngroupsAndOutgroups(RoundedJob):
         self.outgroupNames = outgroupNames
         self.ingroupSequenceIDs = ingroupSequenceIDs
         self.outgroupSequenceIDs = outgroupSequenceIDs
+        self.seqLengthsCache = seqLengthsCache
 
     def run(self, fileStore):
         fileStore.logToMaster("Blasting ingroups vs outgroups. "
@@ -195,6 +248,10 @@ class BlastIngroupsAndOutgroups(RoundedJob):
         ingroupAlignmentsID = self.addChild(BlastSequencesAllAgainstAll(self.ingroupSequenceIDs,
                                                         blastOptions=self.blastOptions)).rv()
         if len(self.outgroupSequenceIDs) > 0:
+            # The outgroup alignments are trimmed and converted before
+            # they are collated, so can't be sorted until the end
+            outgroupBlastOptions = copy.copy(self.blastOptions)
+            outgroupBlastOptions.sortResults = False
             blastFirstOutgroupJob = self.addChild(BlastFirstOutgroup(
                 ingroupNames=self.ingroupNames,
                 untrimmedSequenceIDs=self.ingroupSequenceIDs,
@@ -203,10 +260,13 @@ class BlastIngroupsAndOutgroups(RoundedJob):
                 outgroupSequenceIDs=self.outgroupSequenceIDs,
                 outgroupFragmentIDs=[],
                 outgroupResultsID=None,
-                blastOptions=self.blastOptions,
+                blastOptions=outgroupBlastOptions,
                 outgroupNumber=1,
-                ingroupCoverageIDs=[]))
+                ingroupCoverageIDs=[],
+                seqLengthsCache=self.seqLengthsCache))
             outgroupAlignmentsID = blastFirstOutgroupJob.rv(0)
+            if self.blastOptions.sortResults:
+                outgroupAlignmentsID = blastFirstOutgroupJob.addFollowOn(SortBlastResults(self.blastOptions, outgroupAlignmentsID)).rv()
             outgroupFragmentIDs = blastFirstOutgroupJob.rv(1)
             ingroupCoverageIDs = blastFirstOutgroupJob.rv(2)
             alignmentsID = self.addFollowOn(CollateBlasts(blastOptions=self.blastOptions, resultsFileIDs=[ingroupAlignmentsID, outgroupAlignmentsID])).rv()
@@ -225,7 +285,7 @@ class BlastFirstOutgroup(RoundedJob):
     def __init__(self, ingroupNames, untrimmedSequenceIDs, sequenceIDs,
                  outgroupNames, outgroupSequenceIDs, outgroupFragmentIDs,
                  outgroupResultsID, blastOptions, outgroupNumber,
-                 ingroupCoverageIDs):
+                 ingroupCoverageIDs, seqLengthsCache=None):
         super(BlastFirstOutgroup, self).__init__(memory=blastOptions.memory, preemptable=True)
         self.ingroupNames = ingroupNames
         self.untrimmedSequenceIDs = untrimmedSequenceIDs
@@ -237,7 +297,8 @@ class BlastFirstOutgroup(RoundedJob):
         self.blastOptions = blastOptions
         self.outgroupNumber = outgroupNumber
         self.ingroupCoverageIDs = ingroupCoverageIDs
-        
+        self.seqLengthsCache = seqLengthsCache
+
     def run(self, fileStore):
         logger.info("Blasting ingroup sequences to outgroup %s",
                     self.outgroupNames[self.outgroupNumber - 1])
@@ -256,7 +317,8 @@ class BlastFirstOutgroup(RoundedJob):
             outgroupResultsID=self.outgroupResultsID,
             blastOptions=self.blastOptions,
             outgroupNumber=self.outgroupNumber,
-            ingroupCoverageIDs=self.ingroupCoverageIDs))
+            ingroupCoverageIDs=self.ingroupCoverageIDs,
+            seqLengthsCache=self.seqLengthsCache))
         outgroupAlignmentsID = trimRecurseJob.rv(0)
         outgroupFragmentIDs = trimRecurseJob.rv(1)
         ingroupCoverageIDs = trimRecurseJob.rv(2)
@@ -266,8 +328,12 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
     def __init__(self, ingroupNames, untrimmedSequenceIDs, sequenceIDs,
                  outgroupNames, outgroupSequenceIDs, outgroupFragmentIDs,
                  mostRecentResultsID, outgroupResultsID,
-                 blastOptions, outgroupNumber, ingroupCoverageIDs):
-        super(TrimAndRecurseOnOutgroups, self).__init__(preemptable=True)
+                 blastOptions, outgroupNumber, ingroupCoverageIDs,
+                 seqLengthsCache=None):
+        # The ingroups are trimmed in parallel, on as many of the cores as
+        # the node that runs the job has
+        self.trimCores = max(1, min(len(ingroupNames), blastOptions.trimCores))
+        super(TrimAndRecurseOnOutgroups, self).__init__(cores=self.trimCores, preemptable=True)
         self.ingroupNames = ingroupNames
         self.untrimmedSequenceIDs = untrimmedSequenceIDs
         self.sequenceIDs = sequenceIDs
@@ -279,23 +345,39 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
         self.blastOptions = blastOptions
         self.outgroupNumber = outgroupNumber
         self.ingroupCoverageIDs = ingroupCoverageIDs
+        # file ID -> (header -> length) of the sequences seen in
+        # previous rounds, so each fasta is only scanned once
+        self.seqLengthsCache = seqLengthsCache if seqLengthsCache is not None else {}
+
+    def getSeqLengths(self, fileStore, fileID, path=None):
+        """Get the header -> length dict of a sequence file, only reading
+        it if it hasn't been seen before."""
+        if str(fileID) not in self.seqLengthsCache:
+            if path is None:
+                path = fileStore.readGlobalFile(fileID)
+            with open(path) as sequenceFile:
+                self.seqLengthsCache[str(fileID)] = dict(getSeqLengths(sequenceFile))
+        return self.seqLengthsCache[str(fileID)]
 
     def run(self, fileStore):
         # Trim outgroup, convert outgroup coordinates, and add to
         # outgroup fragments dir
 
-        outgroupSequenceFiles = [fileStore.readGlobalFile(fileID) for fileID in self.outgroupSequenceIDs]
+        outgroupSequenceFile = fileStore.readGlobalFile(self.outgroupSequenceIDs[0])
+        outgroupLengths = self.getSeqLengths(fileStore, self.outgroupSequenceIDs[0], outgroupSequenceFile)
         mostRecentResultsFile = fileStore.readGlobalFile(self.mostRecentResultsID)
+        # Parse the latest results once, and answer all the coverage
+        # queries on them in memory
+        mostRecentCoverage = CigarCoverage(mostRecentResultsFile)
         trimmedOutgroup = fileStore.getLocalTempFile()
         outgroupCoverage = fileStore.getLocalTempFile()
-        calculateCoverage(outgroupSequenceFiles[0],
-                          mostRecentResultsFile, outgroupCoverage)
+        mostRecentCoverage.writeBed(outgroupLengths, outgroupCoverage)
         # The windowSize and threshold are fixed at 1: anything more
         # and we will run into problems with alignments that aren't
         # covered in a matching trimmed sequence.
-        trimSequences(outgroupSequenceFiles[0], outgroupCoverage,
+        trimSequences(outgroupSequenceFile, outgroupCoverage,
                       trimmedOutgroup, flanking=self.blastOptions.trimOutgroupFlanking,
-                      windowSize=1, threshold=1)
+                      windowSize=1, threshold=1, seqLengths=outgroupLengths)
         outgroupConvertedResultsFile = fileStore.getLocalTempFile()
         with open(outgroupConvertedResultsFile, 'w') as f:
             upconvertCoords(cigarPath=mostRecentResultsFile,
@@ -304,15 +386,15 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
                             outputFile=f)
 
         self.outgroupFragmentIDs.append(fileStore.writeGlobalFile(trimmedOutgroup))
-        sequenceFiles = [fileStore.readGlobalFile(path) for path in self.sequenceIDs]
+        with open(trimmedOutgroup) as f:
+            trimmedOutgroupLength = sum(getSeqLengths(f).values())
         untrimmedSequenceFiles = [fileStore.readGlobalFile(path) for path in self.untrimmedSequenceIDs]
 
         # Report coverage of the latest outgroup on the trimmed ingroups.
-        for trimmedIngroupSequence, ingroupSequence, ingroupName in zip(sequenceFiles, untrimmedSequenceFiles, self.ingroupNames):
-            tmpIngroupCoverage = fileStore.getLocalTempFile()
-            calculateCoverage(trimmedIngroupSequence, mostRecentResultsFile,
-                              tmpIngroupCoverage)
-            fileStore.logToMaster("Coverage on %s from outgroup #%d, %s: %s%% (current ingroup length %d, untrimmed length %d). Outgroup trimmed to %d bp from %d" % (ingroupName, self.outgroupNumber, self.outgroupNames[self.outgroupNumber - 1], percentCoverage(trimmedIngroupSequence, tmpIngroupCoverage), sequenceLength(trimmedIngroupSequence), sequenceLength(ingroupSequence), sequenceLength(trimmedOutgroup), sequenceLength(outgroupSequenceFiles[0])))
+        for sequenceID, untrimmedSequenceID, untrimmedSequenceFile, ingroupName in zip(self.sequenceIDs, self.untrimmedSequenceIDs, untrimmedSequenceFiles, self.ingroupNames):
+            trimmedLengths = self.getSeqLengths(fileStore, sequenceID)
+            untrimmedLengths = self.getSeqLengths(fileStore, untrimmedSequenceID, untrimmedSequenceFile)
+            fileStore.logToMaster("Coverage on %s from outgroup #%d, %s: %s%% (current ingroup length %d, untrimmed length %d). Outgroup trimmed to %d bp from %d" % (ingroupName, self.outgroupNumber, self.outgroupNames[self.outgroupNumber - 1], mostRecentCoverage.percentCoverage(trimmedLengths), sum(trimmedLengths.values()), sum(untrimmedLengths.values()), trimmedOutgroupLength, sum(outgroupLengths.values())))
 
         # Convert the alignments' ingroup coordinates.
         ingroupConvertedResultsFile = fileStore.getLocalTempFile()
@@ -333,44 +415,55 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
             outgroupResultsFile = fileStore.getLocalTempFile()
         with open(ingroupConvertedResultsFile) as results:
             with open(outgroupResultsFile, 'a') as output:
-                output.write(results.read())
+                shutil.copyfileobj(results, output)
 
         self.outgroupResultsID = fileStore.writeGlobalFile(outgroupResultsFile)
 
         # Report coverage of the all outgroup alignments so far on the ingroups.
-        ingroupCoverageFiles = []
-        self.ingroupCoverageIDs = []
-        for ingroupSequence, ingroupName in zip(untrimmedSequenceFiles, self.ingroupNames):
-            ingroupCoverageFile = fileStore.getLocalTempFile()
-            calculateCoverage(sequenceFile=ingroupSequence, cigarFile=outgroupResultsFile,
-                              outputFile=ingroupCoverageFile, depthById=self.blastOptions.trimOutgroupDepth > 1)
-            ingroupCoverageFiles.append(ingroupCoverageFile)
-            self.ingroupCoverageIDs.append(fileStore.writeGlobalFile(ingroupCoverageFile))
-            fileStore.logToMaster("Cumulative coverage of %d outgroups on ingroup %s: %s" % (self.outgroupNumber, ingroupName, percentCoverage(ingroupSequence, ingroupCoverageFile)))
+        outgroupResultsCoverage = CigarCoverage(outgroupResultsFile)
+        # The per-ingroup work is spread over a pool of processes, which
+        # share the parsed alignments.
+        trimCores = min(self.trimCores, cpu_count())
+        if trimCores > 1:
+            pool = multiprocessing.Pool(processes=trimCores, initializer=setTrimCoverage,
+                                        initargs=(outgroupResultsCoverage,))
+            mapFn = pool.map
+        else:
+            pool = None
+            setTrimCoverage(outgroupResultsCoverage)
+            mapFn = map
+        try:
+            ingroupCoverageFiles = [fileStore.getLocalTempFile() for fileID in self.untrimmedSequenceIDs]
+            percentCoverages = list(mapFn(writeIngroupCoverage,
+                                          [(self.getSeqLengths(fileStore, fileID), coverageFile, self.blastOptions.trimOutgroupDepth > 1)
+                                           for fileID, coverageFile in zip(self.untrimmedSequenceIDs, ingroupCoverageFiles)]))
+            self.ingroupCoverageIDs = [fileStore.writeGlobalFile(coverageFile) for coverageFile in ingroupCoverageFiles]
+            for ingroupName, percent in zip(self.ingroupNames, percentCoverages):
+                fileStore.logToMaster("Cumulative coverage of %d outgroups on ingroup %s: %s" % (self.outgroupNumber, ingroupName, percent))
+
+            if len(self.outgroupSequenceIDs) > 1:
+                # Use the accumulated results so far to trim away the
+                # aligned parts of the ingroups.
+                trimmedSeqs = [fileStore.getLocalTempFile() for fileID in self.untrimmedSequenceIDs]
+                trimmedLengths = list(mapFn(trimIngroup,
+                                            [(sequenceFile, self.getSeqLengths(fileStore, fileID), coverageFile,
+                                              fileStore.getLocalTempFile(), fileStore.getLocalTempFile(), trimmed, self.blastOptions)
+                                             for sequenceFile, fileID, coverageFile, trimmed in zip(untrimmedSequenceFiles, self.untrimmedSequenceIDs,
+                                                                                                    ingroupCoverageFiles, trimmedSeqs)]))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         if len(self.outgroupSequenceIDs) > 1:
-            # Trim ingroup seqs and recurse on the next outgroup.
-            trimmedSeqs = []
-            # Use the accumulated results so far to trim away the
-            # aligned parts of the ingroups.
-            for i, sequenceFile in enumerate(untrimmedSequenceFiles):
-                outgroupCoverageFile = ingroupCoverageFiles[i]
-                selfCoverageFile = fileStore.getLocalTempFile()
-                coverageFile = fileStore.getLocalTempFile()
-                if self.blastOptions.keepParalogs:
-                    subtractBed(outgroupCoverageFile, selfCoverageFile, coverageFile)
-                else:
-                    coverageFile = outgroupCoverageFile
-
-                trimmed = fileStore.getLocalTempFile()
-                trimSequences(sequenceFile, coverageFile, trimmed,
-                              complement=True, flanking=self.blastOptions.trimFlanking,
-                              minSize=self.blastOptions.trimMinSize,
-                              threshold=self.blastOptions.trimThreshold,
-                              windowSize=self.blastOptions.trimWindowSize,
-                              depth=self.blastOptions.trimOutgroupDepth)
-                trimmedSeqs.append(trimmed)
+            # Recurse on the next outgroup with the trimmed ingroups.
             trimmedSeqIDs = [fileStore.writeGlobalFile(path, cleanup=True) for path in trimmedSeqs]
+            # Pass on the lengths of the sequences the next rounds will use
+            seqLengthsCache = {}
+            for fileID in self.untrimmedSequenceIDs:
+                seqLengthsCache[str(fileID)] = self.seqLengthsCache[str(fileID)]
+            for fileID, lengths in zip(trimmedSeqIDs, trimmedLengths):
+                seqLengthsCache[str(fileID)] = lengths
             return self.addChild(BlastFirstOutgroup(
                 ingroupNames=self.ingroupNames,
                 untrimmedSequenceIDs=self.untrimmedSequenceIDs,
@@ -381,29 +474,70 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
                 outgroupResultsID=self.outgroupResultsID,
                 blastOptions=self.blastOptions,
                 outgroupNumber=self.outgroupNumber + 1,
-                ingroupCoverageIDs=self.ingroupCoverageIDs)).rv()
+                ingroupCoverageIDs=self.ingroupCoverageIDs,
+                seqLengthsCache=seqLengthsCache)).rv()
         else:
             # Finally, put the ingroups and outgroups results together
             return (self.outgroupResultsID, self.outgroupFragmentIDs, self.ingroupCoverageIDs)
 
-def compressFastaFile(fileName):
-    """Compress a fasta file.
+# The accumulated outgroup alignments, in each process of the pool used by
+# TrimAndRecurseOnOutgroups
+trimCoverage = None
+
+def setTrimCoverage(coverage):
+    global trimCoverage
+    trimCoverage = coverage
+
+def writeIngroupCoverage(args):
+    """Write the coverage bed of the outgroup alignments on an ingroup, and
+    return its % coverage."""
+    seqLengths, coverageFile, depthById = args
+    return trimCoverage.writeBed(seqLengths, coverageFile, depthById=depthById)
+
+def trimIngroup(args):
+    """Trim away the parts of an ingroup covered by the outgroups, and return
+    the header -> length dict of the trimmed sequences."""
+    sequenceFile, seqLengths, outgroupCoverageFile, selfCoverageFile, coverageFile, trimmed, blastOptions = args
+    if blastOptions.keepParalogs:
+        subtractBed(outgroupCoverageFile, selfCoverageFile, coverageFile)
+    else:
+        coverageFile = outgroupCoverageFile
+    trimSequences(sequenceFile, coverageFile, trimmed,
+                  complement=True, flanking=blastOptions.trimFlanking,
+                  minSize=blastOptions.trimMinSize,
+                  threshold=blastOptions.trimThreshold,
+                  windowSize=blastOptions.trimWindowSize,
+                  depth=blastOptions.trimOutgroupDepth,
+                  seqLengths=seqLengths)
+    with open(trimmed) as trimmedFile:
+        return dict(getSeqLengths(trimmedFile))
+
+def compressFastaFile(fileName, codec="gzip"):
+    """Compress a fasta file, returning the name of the compressed file.
     """
-    system("bzip2 --keep --fast %s" % fileName)
-    return fileName + ".bz2"
+    codec = getCodec(codec)
+    compressedFileName = fileName + codec.suffix
+    codec.compressFile(fileName, compressedFileName)
+    return compressedFileName
 
-def decompressFastaFile(fileName, tempFileName):
-    """Copies the file from the central dir to a temporary file, returning the temp file name.
+def decompressFastaFile(fileName, tempFileName, codec="gzip"):
+    """Decompresses the file to a temporary file, returning the temp file name.
     """
-    system("bunzip2 --stdout %s > %s" % (fileName, tempFileName))
+    getCodec(codec).decompressFile(fileName, tempFileName)
     return tempFileName
 
+def uncompressedSize(fileID, blastOptions):
+    """Estimate the size of a chunk or alignments file written by the blast jobs."""
+    if isinstance(fileID, VirtualChunk):
+        return fileID.size
+    return fileID.size * blastOptions.getCodec().ratio
+
 class RunSelfBlast(RoundedJob):
     """Runs blast as a job.
     """
     def __init__(self, blastOptions, seqFileID):
-        disk = 3*seqFileID.size
-        memory = 3*seqFileID.size
+        disk = 3*uncompressedSize(seqFileID, blastOptions) + sourceSize([seqFileID])
+        memory = 3*uncompressedSize(seqFileID, blastOptions)
         if blastOptions.gpuLastz:
             # gpu jobs get the whole node
             cores = cpu_count()
@@ -415,7 +549,8 @@ class RunSelfBlast(RoundedJob):
 
     def run(self, fileStore):
         blastResultsFile = fileStore.getLocalTempFile()
-        seqFile = fileStore.readGlobalFile(self.seqFileID)
+        codec = self.blastOptions.getCodec()
+        seqFile = readChunk(fileStore, self.seqFileID, codec)
         runSelfLastz(seqFile, blastResultsFile, lastzArguments=self.blastOptions.lastzArguments,
                      gpuLastz = self.blastOptions.gpuLastz)
         if self.blastOptions.realign:
@@ -429,19 +564,21 @@ class RunSelfBlast(RoundedJob):
                                 blastResultsFile,
                                 resultsFile,
                                 str(self.blastOptions.roundsOfCoordinateConversion)])
-        if self.blastOptions.compressFiles:
-            #TODO: This throws away the compressed file
-            seqFile = compressFastaFile(seqFile)
+        if self.blastOptions.sortResults:
+            sortedResultsFile = fileStore.getLocalTempFile()
+            mirrorAndSortAlignments(resultsFile, sortedResultsFile, fileStore.getLocalTempDir(), getLogLevelString())
+            resultsFile = sortedResultsFile
         logger.info("Ran the self blast okay")
-        return fileStore.writeGlobalFile(resultsFile)
+        return writeGlobalFileCompressed(fileStore, resultsFile, codec)
 
 class RunBlast(RoundedJob):
     """Runs blast as a job.
     """
     def __init__(self, blastOptions, seqFileID1, seqFileID2):
         if hasattr(seqFileID1, "size") and hasattr(seqFileID2, "size"):
-            disk = 2*(seqFileID1.size + seqFileID2.size)
-            memory = 2*(seqFileID1.size + seqFileID2.size)
+            disk = 2*(uncompressedSize(seqFileID1, blastOptions) + uncompressedSize(seqFileID2, blastOptions)) + \
+                   sourceSize([seqFileID1, seqFileID2])
+            memory = 2*(uncompressedSize(seqFileID1, blastOptions) + uncompressedSize(seqFileID2, blastOptions))
         else:
             disk = None
             memory = None
@@ -456,46 +593,164 @@ class RunBlast(RoundedJob):
         self.seqFileID2 = seqFileID2
 
     def run(self, fileStore):
-        seqFile1 = fileStore.readGlobalFile(self.seqFileID1)
-        seqFile2 = fileStore.readGlobalFile(self.seqFileID2)
-        if self.blastOptions.compressFiles:
-            seqFile1 = decompressFastaFile(seqFile1, fileStore.getLocalTempFile())
-            seqFile2 = decompressFastaFile(seqFile2, fileStore.getLocalTempFile())
-        blastResultsFile = fileStore.getLocalTempFile()
-        runLastz(seqFile1, seqFile2, blastResultsFile, lastzArguments = self.blastOptions.lastzArguments,
-                 gpuLastz = self.blastOptions.gpuLastz)
-        if self.blastOptions.realign:
-            realignResultsFile = fileStore.getLocalTempFile()
-            runCactusRealign(seqFile1, seqFile2, inputAlignmentsFile=blastResultsFile,
-                             outputAlignmentsFile=realignResultsFile,
-                             realignArguments=self.blastOptions.realignArguments)
-            blastResultsFile = realignResultsFile
-
+        codec = self.blastOptions.getCodec()
+        seqFile1 = readChunk(fileStore, self.seqFileID1, codec)
+        seqFile2 = readChunk(fileStore, self.seqFileID2, codec)
         resultsFile = fileStore.getLocalTempFile()
-        cactus_call(parameters=["cactus_blast_convertCoordinates",
-                                blastResultsFile,
-                                resultsFile,
-                                str(self.blastOptions.roundsOfCoordinateConversion)])
+        blastPair((self.blastOptions, seqFile1, seqFile2, resultsFile))
         logger.info("Ran the blast okay")
-        return fileStore.writeGlobalFile(resultsFile)
+        return writeGlobalFileCompressed(fileStore, resultsFile, codec)
+
+class RunBlastPack(RoundedJob):
+    """Runs blast on a bundle of chunk pairs in one job, to avoid the
+    overhead of scheduling a job for each of many small pairs.
+    """
+    def __init__(self, blastOptions, chunkPairs):
+        chunkIDs = uniqueChunkIDs(chunkPairs)
+        # The pairs are aligned in parallel, on as many of the cores as the
+        # node that runs the job has
+        self.packCores = max(1, min(len(chunkPairs), blastOptions.packCores))
+        disk = 2*sum(uncompressedSize(chunkID, blastOptions) for chunkID in chunkIDs) + \
+               2*sum(uncompressedSize(chunkID1, blastOptions) + uncompressedSize(chunkID2, blastOptions)
+                     for chunkID1, chunkID2 in chunkPairs) + sourceSize(chunkIDs)
+        memory = self.packCores*max(2*(uncompressedSize(chunkID1, blastOptions) + uncompressedSize(chunkID2, blastOptions))
+                                    for chunkID1, chunkID2 in chunkPairs)
+        super(RunBlastPack, self).__init__(memory=memory, disk=disk, cores=self.packCores, preemptable=True)
+        self.blastOptions = blastOptions
+        self.chunkPairs = chunkPairs
+
+    def run(self, fileStore):
+        # Each chunk is only read once, however many pairs it is in
+        codec = self.blastOptions.getCodec()
+        seqFiles = {}
+        for chunkID in uniqueChunkIDs(self.chunkPairs):
+            seqFiles[chunkID] = readChunk(fileStore, chunkID, codec)
+        pairArgs = [(self.blastOptions, seqFiles[chunkID1], seqFiles[chunkID2], fileStore.getLocalTempFile())
+                    for chunkID1, chunkID2 in self.chunkPairs]
+        packCores = min(self.packCores, cpu_count())
+        if packCores > 1:
+            pool = multiprocessing.Pool(processes=packCores)
+            try:
+                pool.map(blastPair, pairArgs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            list(map(blastPair, pairArgs))
+        resultsFile = fileStore.getLocalTempFile()
+        if self.blastOptions.sortResults:
+            mergeSortedAlignments([args[3] for args in pairArgs], resultsFile)
+        else:
+            catFiles([args[3] for args in pairArgs], resultsFile)
+        logger.info("Ran the blasts on %d chunk pairs okay" % len(self.chunkPairs))
+        return writeGlobalFileCompressed(fileStore, resultsFile, codec)
+
+def blastPair(args):
+    """Align two chunks, writing the alignments with their coordinates
+    converted (and sorted, if blastOptions.sortResults is set) to
+    resultsFile. Takes a (blastOptions, seqFile1, seqFile2, resultsFile)
+    tuple so that it can be mapped over a process pool.
+    """
+    blastOptions, seqFile1, seqFile2, resultsFile = args
+    blastResultsFile = resultsFile + ".lastz"
+    runLastz(seqFile1, seqFile2, blastResultsFile, lastzArguments = blastOptions.lastzArguments,
+             gpuLastz = blastOptions.gpuLastz)
+    if blastOptions.realign:
+        realignResultsFile = resultsFile + ".realign"
+        runCactusRealign(seqFile1, seqFile2, inputAlignmentsFile=blastResultsFile,
+                         outputAlignmentsFile=realignResultsFile,
+                         realignArguments=blastOptions.realignArguments)
+        os.remove(blastResultsFile)
+        blastResultsFile = realignResultsFile
+    if blastOptions.sortResults:
+        convertedResultsFile = resultsFile + ".converted"
+    else:
+        convertedResultsFile = resultsFile
+    cactus_call(parameters=["cactus_blast_convertCoordinates",
+                            blastResultsFile,
+                            convertedResultsFile,
+                            str(blastOptions.roundsOfCoordinateConversion)])
+    os.remove(blastResultsFile)
+    if blastOptions.sortResults:
+        mirrorAndSortAlignments(convertedResultsFile, resultsFile, os.path.dirname(resultsFile), getLogLevelString())
+        os.remove(convertedResultsFile)
+
+def uniqueChunkIDs(chunkPairs):
+    chunkIDs = []
+    seen = set()
+    for chunkPair in chunkPairs:
+        for chunkID in chunkPair:
+            if chunkID not in seen:
+                seen.add(chunkID)
+                chunkIDs.append(chunkID)
+    return chunkIDs
+
+def packChunkPairs(chunkPairs, packSize, blastOptions):
+    """Group the (chunkID1, chunkID2) pairs, in order, into lists whose
+    total uncompressed size is at most packSize. Pairs that are at least
+    packSize on their own, or whose IDs don't have a size, get a list to
+    themselves.
+    """
+    packs = []
+    pack = []
+    packTotal = 0
+    for chunkID1, chunkID2 in chunkPairs:
+        if hasattr(chunkID1, "size") and hasattr(chunkID2, "size"):
+            pairSize = uncompressedSize(chunkID1, blastOptions) + uncompressedSize(chunkID2, blastOptions)
+        else:
+            pairSize = packSize
+        if len(pack) > 0 and packTotal + pairSize > packSize:
+            packs.append(pack)
+            pack = []
+            packTotal = 0
+        pack.append((chunkID1, chunkID2))
+        packTotal += pairSize
+    if len(pack) > 0:
+        packs.append(pack)
+    return packs
+
+def makeBlastJobs(blastOptions, chunkPairs):
+    """Make the jobs to align the given chunk pairs, bundling small pairs
+    together if blastOptions.packSize is set."""
+    if blastOptions.packSize <= 0 or blastOptions.gpuLastz:
+        # gpu jobs already get the whole node
+        return [RunBlast(blastOptions, chunkID1, chunkID2) for chunkID1, chunkID2 in chunkPairs]
+    jobs = []
+    for pack in packChunkPairs(chunkPairs, blastOptions.packSize, blastOptions):
+        if len(pack) == 1:
+            jobs.append(RunBlast(blastOptions, pack[0][0], pack[0][1]))
+        else:
+            jobs.append(RunBlastPack(blastOptions, pack))
+    return jobs
 
 class CollateBlasts(RoundedJob):
-    def __init__(self, blastOptions, resultsFileIDs):
+    def __init__(self, blastOptions, resultsFileIDs, compressedInputs=False):
         super(CollateBlasts, self).__init__(preemptable=True)
         self.blastOptions = blastOptions
         self.resultsFileIDs = resultsFileIDs
+        self.compressedInputs = compressedInputs
 
     def run(self, fileStore):
-        return self.addFollowOn(CollateBlasts2(self.blastOptions, self.resultsFileIDs)).rv()
+        # The results of batched blast jobs come as nested lists
+        resultsFileIDs = flattenChildResults(self.resultsFileIDs)
+        return self.addFollowOn(CollateBlasts2(self.blastOptions, resultsFileIDs, self.compressedInputs)).rv()
 
 class CollateBlasts2(ChildTreeJob):
-    """Collates all the blasts into a single alignments file.
+    """Collates all the blasts into a single alignments file. If
+    compressedInputs is set, the results are straight from the blast
+    jobs and compressed with the blast options' codec. The collated file
+    is never compressed.
     """
-    def __init__(self, blastOptions, resultsFileIDs):
-        disk = 8*sum([alignmentID.size for alignmentID in resultsFileIDs])
+    def __init__(self, blastOptions, resultsFileIDs, compressedInputs=False):
+        if compressedInputs:
+            disk = 8*sum([uncompressedSize(alignmentID, blastOptions) for alignmentID in resultsFileIDs])
+        else:
+            disk = 8*sum([alignmentID.size for alignmentID in resultsFileIDs])
         memory = blastOptions.memory
         super(CollateBlasts2, self).__init__(memory=memory, disk=disk, preemptable=True)
         self.resultsFileIDs = resultsFileIDs
+        self.sortResults = blastOptions.sortResults
+        self.codec = blastOptions.getCodec() if compressedInputs else getCodec("none")
         # it's slow to run fileStore.deleteGlobalFile, so we do it in parallel batches
         self.delete_batch_size = 1000
 
@@ -503,13 +758,33 @@ class CollateBlasts2(ChildTreeJob):
         logger.info("Results IDs: %s" % self.resultsFileIDs)
         resultsFiles = [readGlobalFileWithoutCache(fileStore, fileID) for fileID in self.resultsFileIDs]
         collatedResultsFile = fileStore.getLocalTempFile()
-        catFiles(resultsFiles, collatedResultsFile)
+        if self.sortResults:
+            mergeSortedAlignments(resultsFiles, collatedResultsFile, openFile=self.codec.openText)
+        else:
+            with open(collatedResultsFile, 'wb') as collatedFile:
+                for resultsFile in resultsFiles:
+                    with self.codec.open(resultsFile, 'rb') as resultsFileHandle:
+                        shutil.copyfileobj(resultsFileHandle, collatedFile)
         logger.info("Collated the alignments to the file: %s",  collatedResultsFile)
         collatedResultsID = fileStore.writeGlobalFile(collatedResultsFile)
         for i in range(0, len(self.resultsFileIDs), self.delete_batch_size):
             self.addChild(DeleteFileIDs(self.resultsFileIDs[i:i+self.delete_batch_size]))        
         return collatedResultsID
 
+class SortBlastResults(RoundedJob):
+    """Mirrors and sorts an alignments file so that it can be merged with
+    sorted results.
+    """
+    def __init__(self, blastOptions, resultsFileID):
+        super(SortBlastResults, self).__init__(memory=blastOptions.memory, preemptable=True)
+        self.resultsFileID = resultsFileID
+
+    def run(self, fileStore):
+        resultsFile = fileStore.readGlobalFile(self.resultsFileID)
+        sortedResultsFile = fileStore.getLocalTempFile()
+        mirrorAndSortAlignments(resultsFile, sortedResultsFile, fileStore.getLocalTempDir(), getLogLevelString())
+        return fileStore.writeGlobalFile(sortedResultsFile)
+
 class DeleteFileIDs(RoundedJob):
     """Deletes some files from the file store
     """
@@ -523,13 +798,7 @@ class DeleteFileIDs(RoundedJob):
 
 def sequenceLength(sequenceFile):
     """Get the total # of bp from a fasta file."""
-    seqLength = 0
-    for line in open(sequenceFile):
-        line = line.strip()
-        if line == '' or line[0] == '>':
-            continue
-        seqLength += len(line)
-    return seqLength
+    return FastaStats.fromFasta(sequenceFile).totalLength
 
 def percentCoverage(sequenceFile, coverageFile):
     """Get the % coverage of a sequence from a coverage file."""
@@ -544,6 +813,15 @@ def percentCoverage(sequenceFile, coverageFile):
 def calculateCoverage(sequenceFile, cigarFile, outputFile, fromGenome=None, depthById=False, work_dir=None):
     logger.info("Calculating coverage of cigar file %s on %s, writing to %s" % (
         cigarFile, sequenceFile, outputFile))
+    cactus_call(outfile=outputFile, work_dir=work_dir,
+                parameters=coverageParameters(sequenceFile, cigarFile, fromGenome, depthById))
+
+def calculateCoverageAsync(sequenceFile, cigarFile, outputFile, fromGenome=None, depthById=False, work_dir=None):
+    """Version of calculateCoverage to pass to gather_cactus_calls."""
+    return cactus_call_async(outfile=outputFile, work_dir=work_dir,
+                             parameters=coverageParameters(sequenceFile, cigarFile, fromGenome, depthById))
+
+def coverageParameters(sequenceFile, cigarFile, fromGenome=None, depthById=False):
     args = [sequenceFile, cigarFile]
     if isinstance(fromGenome, list):
         for fg in fromGenome:
@@ -552,8 +830,7 @@ def calculateCoverage(sequenceFile, cigarFile, outputFile, fromGenome=None, dept
         args += ["--from", fromGenome]
     if depthById:
         args += ["--depthById"]
-    cactus_call(outfile=outputFile, work_dir=work_dir,
-                parameters=["cactus_coverage"] + args)
+    return ["cactus_coverage"] + args
 
 def subtractBed(bed1, bed2, destBed):
     """Subtract two non-bed12 beds"""
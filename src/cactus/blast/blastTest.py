@@ -28,6 +28,7 @@ from sonLib.bioio import popenCatch
 
 from cactus.shared.test import checkCigar, getTestLogLevel
 from cactus.blast.blast import decompressFastaFile, compressFastaFile
+from cactus.shared.compression import availableCodecs
 
 from cactus.shared.common import runLastz
 from cactus.shared.common import makeURL
@@ -37,6 +38,7 @@ from cactus.blast.blast import BlastIngroupsAndOutgroups
 from cactus.blast.blast import BlastSequencesAllAgainstAll
 from cactus.blast.blast import BlastSequencesAgainstEachOther
 from cactus.blast.blast import calculateCoverage
+from cactus.blast.blast import packChunkPairs
 
 from toil.job import Job
 from toil.common import Toil
@@ -317,27 +319,50 @@ class TestCase(unittest.TestCase):
         self.tempFiles.append(tempSeqFile2)
         self.encodePath = os.path.join(self.encodePath, "ENm001")
         catFiles([ os.path.join(self.encodePath, fileName) for fileName in os.listdir(self.encodePath) ], tempSeqFile)
-        startTime = time.time()
-        compressFastaFile(tempSeqFile)
-        logger.critical("It took %s seconds to compress the fasta file" % (time.time() - startTime))
-        startTime = time.time()
-        system("rm %s" % tempSeqFile + ".bz2")
-        system("bzip2 --keep --fast %s" % tempSeqFile)
-        logger.critical("It took %s seconds to compress the fasta file by system functions" % (time.time() - startTime))
-        startTime = time.time()
-        decompressFastaFile(tempSeqFile + ".bz2", tempSeqFile2)
-        logger.critical("It took %s seconds to decompress the fasta file" % (time.time() - startTime))
-        system("rm %s" % tempSeqFile2)
-        startTime = time.time()
-        system("bunzip2 --stdout %s > %s" % (tempSeqFile + ".bz2", tempSeqFile2))
-        logger.critical("It took %s seconds to decompress the fasta file using system function" % (time.time() - startTime))
-        logger.critical("File sizes, before: %s, compressed: %s, decompressed: %s" % (os.stat(tempSeqFile).st_size, os.stat(tempSeqFile + ".bz2").st_size, os.stat(tempSeqFile2).st_size))
+        for codec in availableCodecs():
+            startTime = time.time()
+            compressedFile = compressFastaFile(tempSeqFile, codec)
+            self.tempFiles.append(compressedFile)
+            logger.critical("It took %s seconds to compress the fasta file with %s" % (time.time() - startTime, codec))
+            startTime = time.time()
+            decompressFastaFile(compressedFile, tempSeqFile2, codec)
+            logger.critical("It took %s seconds to decompress the fasta file with %s" % (time.time() - startTime, codec))
+            logger.critical("File sizes, before: %s, compressed: %s" % (os.stat(tempSeqFile).st_size, os.stat(compressedFile).st_size))
+            self.assertTrue(filecmp.cmp(tempSeqFile, tempSeqFile2, shallow=False))
         #Above test justifies out use of compression to reduce network transfer!
-        #startTime = time.time()
-        #runNaiveBlast([ tempSeqFile ], self.tempOutputFile, self.tempDir, lastzOptions="--nogapped --step=3 --hspthresh=3000 --ambiguous=iupac")
-        #logger.critical("It took %s seconds to run blast" % (time.time() - startTime))
 
 
+class PackingTest(unittest.TestCase):
+    class SizedID(str):
+        """Stand-in for a toil FileID"""
+        def __new__(cls, name, size):
+            ret = str.__new__(cls, name)
+            ret.size = size
+            return ret
+
+    @TestStatus.shortLength
+    def testPackChunkPairs(self):
+        a = self.SizedID("a", 100)
+        b = self.SizedID("b", 200)
+        c = self.SizedID("c", 1000)
+        pairs = [(a, b), (a, a), (b, b), (a, c), (b, c), (a, b)]
+        uncompressed = BlastOptions(compressFiles=False)
+        self.assertEqual(packChunkPairs(pairs, 500, uncompressed), [[(a, b), (a, a)], [(b, b)], [(a, c)], [(b, c)], [(a, b)]])
+        # Every pair is still aligned once, in order
+        for packSize in range(0, 3000, 100):
+            packs = packChunkPairs(pairs, packSize, uncompressed)
+            self.assertEqual([pair for pack in packs for pair in pack], pairs)
+            for pack in packs:
+                self.assertTrue(len(pack) == 1 or sum(x.size + y.size for x, y in pack) <= packSize)
+        # IDs without sizes aren't packed
+        self.assertEqual(packChunkPairs([("x", "y"), ("x", "z")], 500, uncompressed), [[("x", "y")], [("x", "z")]])
+
+        # Compressed chunks are packed on the size of the sequence they hold
+        compressed = BlastOptions(compressFiles=True, compressionCodec="gzip")
+        ratio = compressed.getCodec().ratio
+        self.assertEqual(packChunkPairs(pairs, 500, compressed), [[pair] for pair in pairs])
+        self.assertEqual(packChunkPairs(pairs, 500 * ratio, compressed), packChunkPairs(pairs, 500, uncompressed))
+
 def compareResultsFile(results1, results2, closeness=0.95):
     results1 = loadResults(results1)
     logger.info("Loaded first results")
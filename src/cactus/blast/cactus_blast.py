@@ -15,7 +15,8 @@ from operator import itemgetter
 
 from cactus.progressive.seqFile import SeqFile
 from cactus.progressive.multiCactusTree import MultiCactusTree
-from cactus.shared.common import setupBinaries, importSingularityImage
+from cactus.shared.common import setupBinaries, importSingularityImage, setResourceRounding, \
+    setMemoryEscalationsFile
 from cactus.progressive.multiCactusProject import MultiCactusProject
 from cactus.shared.experimentWrapper import ExperimentWrapper
 from cactus.progressive.schedule import Schedule
@@ -104,6 +105,7 @@ def main():
 
 def runCactusBlastOnly(options):
     with Toil(options) as toil:
+        setMemoryEscalationsFile(options.jobStore)
         importSingularityImage(options)
         #Run the workflow
         if options.restart:
@@ -191,6 +193,8 @@ def runCactusBlastOnly(options):
             configNode = ET.parse(project.getConfigPath()).getroot()
             configWrapper = ConfigWrapper(configNode)
             configWrapper.substituteAllPredefinedConstantsWithLiterals()
+            configWrapper.checkCodecs()
+            setResourceRounding(configNode)
 
             workFlowArgs = CactusWorkflowArguments(options, experimentFile=experimentFile, configNode=configNode, seqIDMap = project.inputSequenceIDMap)
 
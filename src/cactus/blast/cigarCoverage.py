@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""In-memory equivalent of cactus_coverage, for when the same cigar
+file needs to be queried for coverage on several sequence files.
+"""
+from array import array
+from heapq import merge
+from itertools import groupby
+
+# cactus_coverage stores depth in 16 bits
+MAX_DEPTH = 65535
+
+class CigarCoverage(object):
+    """Parses a cigar file once into per-contig arrays of aligned
+    intervals, then answers coverage queries on any set of sequences.
+
+    Coverage is counted the same way as cactus_coverage (without
+    --onlyContig1/2 or --from): every match in an alignment adds one
+    to the depth of the bases it covers on both of its contigs.
+    """
+    def __init__(self, cigarPath):
+        # contig -> id of the other contig -> (starts, ends)
+        self.intervals = {}
+        with open(cigarPath) as cigarFile:
+            for line in cigarFile:
+                self.addAlignment(line)
+
+    def addAlignment(self, line):
+        fields = line.split()
+        if len(fields) < 10 or fields[0] != "cigar:":
+            return
+        contig1, pos1, strand1 = fields[1], int(fields[2]), fields[4] == '+'
+        contig2, pos2, strand2 = fields[5], int(fields[6]), fields[8] == '+'
+        intervals1 = self.getIntervals(contig1, contig2)
+        intervals2 = self.getIntervals(contig2, contig1)
+        for i in range(10, len(fields) - 1, 2):
+            op, length = fields[i], int(fields[i + 1])
+            if op != 'D':
+                # Matches and insertions advance the first contig
+                if op == 'M':
+                    addInterval(intervals1, pos1, length, strand1)
+                pos1 += length if strand1 else -length
+            if op != 'I':
+                # Matches and deletions advance the second contig
+                if op == 'M':
+                    addInterval(intervals2, pos2, length, strand2)
+                pos2 += length if strand2 else -length
+
+    def getIntervals(self, contig, otherContig):
+        """Get the (starts, ends) arrays for coverage on contig from alignments
+        to otherContig, keyed by the 'id=N' prefix of otherContig if it
+        has one."""
+        otherId = otherContig.split('|')[0]
+        if not otherId.startswith('id='):
+            otherId = None
+        byId = self.intervals.setdefault(contig, {})
+        if otherId not in byId:
+            byId[otherId] = (array('q'), array('q'))
+        return byId[otherId]
+
+    def depthRuns(self, contig, length, depthById=False):
+        """Get the list of (start, end, depth) runs of non-zero depth on
+        contig, as printed by cactus_coverage. If depthById is set, the
+        depth is the number of different 'id=N' prefixes aligned to each
+        base rather than the number of alignments."""
+        if contig not in self.intervals:
+            return []
+        starts = []
+        ends = []
+        for otherId, (idStarts, idEnds) in self.intervals[contig].items():
+            sortIntervals(idStarts, idEnds)
+            if len(idEnds) > 0 and idEnds[-1] > length:
+                raise RuntimeError("Alignment on %s is past chr end (%d)" % (contig, length))
+            if depthById:
+                if otherId is None:
+                    raise RuntimeError("Computing depth by id, but sequences aligned to %s "
+                                       "do not have an 'id=N|' prefix" % contig)
+                idRuns = sweep(idStarts, idEnds)
+                idStarts = array('q', (run[0] for run in idRuns))
+                idEnds = array('q', (run[1] for run in idRuns))
+            starts.append(idStarts)
+            ends.append(idEnds)
+        # Each id is sorted on its own, so they only need merging
+        return sweep(merge(*starts), merge(*ends))
+
+    def coveredBases(self, contig, length):
+        """Get the number of bases on contig with non-zero coverage."""
+        return sum(end - start for start, end, _ in self.depthRuns(contig, length))
+
+    def percentCoverage(self, seqLengths):
+        """Get the % coverage of the sequences in the given header -> length
+        dict, like blast.percentCoverage."""
+        covered = sum(self.coveredBases(contig, length) for contig, length in seqLengths.items())
+        return toPercent(covered, seqLengths)
+
+    def writeBed(self, seqLengths, outputFile, depthById=False):
+        """Write the coverage on the sequences in the given header -> length
+        dict as a bed file, in the same format as cactus_coverage.
+
+        Returns their % coverage, the same as percentCoverage, from the runs
+        that were written (counting depth by id covers the same bases)."""
+        covered = 0
+        with open(outputFile, 'w') as bedFile:
+            for contig, length in seqLengths.items():
+                for start, end, depth in self.depthRuns(contig, length, depthById):
+                    bedFile.write("%s\t%d\t%d\t\t%d\n" % (contig, start, end, depth))
+                    covered += end - start
+        return toPercent(covered, seqLengths)
+
+def toPercent(covered, seqLengths):
+    totalLength = sum(seqLengths.values())
+    if totalLength == 0:
+        return 0
+    return 100*float(covered)/totalLength
+
+def addInterval(intervals, pos, length, strand):
+    if length <= 0:
+        return
+    starts, ends = intervals
+    start = pos if strand else pos - length
+    if len(ends) > 0 and ends[-1] == start:
+        # Adjacent intervals can be merged without changing the depth.
+        ends[-1] = start + length
+    else:
+        starts.append(start)
+        ends.append(start + length)
+
+def sortIntervals(starts, ends):
+    """Sort the starts and ends arrays of an id in place. The depth only
+    depends on which positions are starts and ends, so they don't need to
+    stay paired (and addInterval can still extend the last end)."""
+    starts[:] = array('q', sorted(starts))
+    ends[:] = array('q', sorted(ends))
+
+def sweep(starts, ends):
+    """Get the (start, end, depth) runs of constant non-zero depth from
+    the sorted starts and ends of a set of intervals."""
+    runs = []
+    depth = 0
+    runStart = None
+    events = merge(((pos, 1) for pos in starts), ((pos, -1) for pos in ends))
+    for pos, posEvents in groupby(events, key=lambda event: event[0]):
+        newDepth = depth + sum(delta for _, delta in posEvents)
+        if min(newDepth, MAX_DEPTH) != min(depth, MAX_DEPTH):
+            if depth > 0:
+                runs.append((runStart, pos, min(depth, MAX_DEPTH)))
+            runStart = pos
+        depth = newDepth
+    return runs
@@ -0,0 +1,97 @@
+import unittest, os
+from sonLib.bioio import getTempFile
+from sonLib.bioio import TestStatus
+from textwrap import dedent
+from cactus.blast.cigarCoverage import CigarCoverage
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        # Same data as cactus_coverageTest, so the results should match
+        # the cactus_coverage binary.
+        self.seqLengthsA = { 'id=0|simpleSeqA1': 48, 'id=1|simpleSeqA2': 48 }
+        self.seqLengthsB = { 'id=2|simpleSeqB1': 48 }
+        self.simpleCigarPath = getTempFile()
+        open(self.simpleCigarPath, 'w').write(dedent('''\
+        cigar: id=2|simpleSeqB1 0 9 + id=0|simpleSeqA1 10 0 - 0 M 8 D 1 M 1
+        cigar: id=2|simpleSeqB1 9 18 + id=0|simpleSeqA1 2 6 + 0 M 3 I 5 M 1
+        cigar: id=2|simpleSeqB1 18 28 + id=1|simpleSeqA2 0 10 + 0 M 1 I 2 M 2 D 2 M 5
+        cigar: id=2|simpleSeqB1 28 30 + id=1|simpleSeqA2 6 8 + 0 M 2
+        cigar: id=2|simpleSeqB1 30 32 + id=1|simpleSeqA2 7 9 + 0 M 2
+        cigar: id=12|simpleSeqZ1 0 1 + id=0|simpleSeqA1 6 7 + 0 M 1
+        cigar: id=3|simpleSeqC1 0 5 + id=4|simpleSeqD 0 5 + 0 M 5
+        cigar: id=4|simpleSeqD 5 10 + id=3|simpleSeqC1 5 10 + 0 M 5
+        cigar: id=3|simpleSeqC1 10 15 + id=3|simpleSeqC1 15 20 + 0 M 5
+        cigar: id=303|simpleSeqNonExistent 0 10 + id=3|simpleSeqC1 0 10 + 0 M 10
+        '''))
+        self.bedPath = getTempFile()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        os.remove(self.simpleCigarPath)
+        os.remove(self.bedPath)
+
+    def getBed(self, coverage, seqLengths, depthById=False):
+        coverage.writeBed(seqLengths, self.bedPath, depthById=depthById)
+        with open(self.bedPath) as f:
+            return f.read()
+
+    @TestStatus.shortLength
+    def testSimpleCoverage(self):
+        coverage = CigarCoverage(self.simpleCigarPath)
+        self.assertEqual(self.getBed(coverage, self.seqLengthsA), dedent('''\
+        id=0|simpleSeqA1\t0\t1\t\t1
+        id=0|simpleSeqA1\t2\t7\t\t2
+        id=0|simpleSeqA1\t7\t10\t\t1
+        id=1|simpleSeqA2\t0\t3\t\t1
+        id=1|simpleSeqA2\t5\t6\t\t1
+        id=1|simpleSeqA2\t6\t7\t\t2
+        id=1|simpleSeqA2\t7\t8\t\t3
+        id=1|simpleSeqA2\t8\t9\t\t2
+        id=1|simpleSeqA2\t9\t10\t\t1
+        '''))
+        self.assertEqual(self.getBed(coverage, self.seqLengthsB), dedent('''\
+        id=2|simpleSeqB1\t0\t12\t\t1
+        id=2|simpleSeqB1\t17\t19\t\t1
+        id=2|simpleSeqB1\t21\t32\t\t1
+        '''))
+
+    @TestStatus.shortLength
+    def testDepthByID(self):
+        coverage = CigarCoverage(self.simpleCigarPath)
+        self.assertEqual(self.getBed(coverage, self.seqLengthsA, depthById=True), dedent('''\
+        id=0|simpleSeqA1\t0\t1\t\t1
+        id=0|simpleSeqA1\t2\t6\t\t1
+        id=0|simpleSeqA1\t6\t7\t\t2
+        id=0|simpleSeqA1\t7\t10\t\t1
+        id=1|simpleSeqA2\t0\t3\t\t1
+        id=1|simpleSeqA2\t5\t10\t\t1
+        '''))
+        self.assertEqual(self.getBed(coverage, self.seqLengthsB, depthById=True), dedent('''\
+        id=2|simpleSeqB1\t0\t12\t\t1
+        id=2|simpleSeqB1\t17\t19\t\t1
+        id=2|simpleSeqB1\t21\t32\t\t1
+        '''))
+
+    @TestStatus.shortLength
+    def testPercentCoverage(self):
+        coverage = CigarCoverage(self.simpleCigarPath)
+        self.assertAlmostEqual(coverage.percentCoverage(self.seqLengthsA), 100 * 17.0 / 96)
+        self.assertEqual(coverage.percentCoverage({}), 0)
+        # Writing the bed gives the same coverage, with or without depth by id
+        self.assertAlmostEqual(coverage.writeBed(self.seqLengthsA, self.bedPath), 100 * 17.0 / 96)
+        self.assertAlmostEqual(coverage.writeBed(self.seqLengthsA, self.bedPath, depthById=True), 100 * 17.0 / 96)
+
+    @TestStatus.shortLength
+    def testCoverageCap(self):
+        deepCigarPath = getTempFile()
+        with open(deepCigarPath, 'w') as f:
+            for _ in range(65537):
+                f.write('cigar: id=2|simpleSeqB1 0 1 + id=0|simpleSeqA1 10 9 - 0 M 1\n')
+        self.assertEqual(self.getBed(CigarCoverage(deepCigarPath), self.seqLengthsA), dedent('''\
+        id=0|simpleSeqA1\t9\t10\t\t65535
+        '''))
+        os.remove(deepCigarPath)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,43 +24,206 @@ filtering the alignments to remove lower probability alignments.
         for example to only keep the primary alignment: C subscript: cactus_calculateMappingQualities
 
 """
+import os
+import math
+import zlib
+import heapq
+from contextlib import ExitStack
+
+from sonLib.bioio import getTempFile
+
 from cactus.shared.common import cactus_call
+from cactus.shared.streamStats import StreamStats, CountingTee
+from cactus.shared.callMetrics import makeStreamMetrics, writeCallMetrics
+
+def sortAlignmentsCommand(tempDir):
+    """The command that sorts (mirrored and oriented) alignments by their
+    coordinates. The C locale makes the order the same as
+    alignmentSortKey's."""
+    return ["env", "LC_ALL=C", "sort", "-T{}".format(tempDir), "-k6,6", "-k7,7n", "-k8,8n"]
+
+def alignmentSortKey(line):
+    """Key giving the order of sortAlignmentsCommand, including its
+    last-resort comparison of whole lines."""
+    fields = line.split()
+    return (fields[5], int(fields[6]), int(fields[7]), line.rstrip('\n'))
+
+def mirrorAndSortAlignments(inputFile, outputFile, tempDir, logLevel):
+    """Mirror, orient, sort and deduplicate a cigar file, so that it can
+    be merged with mergeSortedAlignments and passed to
+    mappingQualityRescoring with sortedInput set."""
+    cactus_call(outfile=outputFile,
+                parameters=[["cat", inputFile],
+                            ["cactus_mirrorAndOrientAlignments", logLevel],
+                            sortAlignmentsCommand(tempDir),
+                            ["uniq"]])
+
+def mergeSortedAlignments(inputFiles, outputFile, maxOpenFiles=256, openFile=open):
+    """Merge cigar files sorted by mirrorAndSortAlignments into one sorted
+    file, dropping duplicate alignments as uniq would. openFile is used
+    to open the input files, so they can be decompressed on the fly."""
+    tempFiles = []
+    try:
+        # Merge in rounds if there are too many files to open at once
+        while len(inputFiles) > maxOpenFiles:
+            mergedFiles = []
+            for i in range(0, len(inputFiles), maxOpenFiles):
+                mergedFile = getTempFile(rootDir=os.path.dirname(os.path.abspath(outputFile)))
+                tempFiles.append(mergedFile)
+                mergeSortedAlignments(inputFiles[i:i + maxOpenFiles], mergedFile, maxOpenFiles, openFile)
+                mergedFiles.append(mergedFile)
+            inputFiles = mergedFiles
+            openFile = open
+        with ExitStack() as stack:
+            lines = [(line if line.endswith('\n') else line + '\n'
+                      for line in stack.enter_context(openFile(inputFile)) if not line.isspace())
+                     for inputFile in inputFiles]
+            with open(outputFile, 'w') as outFile:
+                prevLine = None
+                for line in heapq.merge(*lines, key=alignmentSortKey):
+                    if line != prevLine:
+                        outFile.write(line)
+                        prevLine = line
+    finally:
+        for tempFile in tempFiles:
+            os.remove(tempFile)
 
-def countLines(inputFile):
-    with open(inputFile, 'r') as f:
-        return sum(1 for line in f)
+def partitionAlignments(inputFile, bucketSize, sortedInput, makeFile):
+    """Split a mirrored and oriented cigar file into buckets of about
+    bucketSize bytes, keeping all the alignments on a (first) contig in
+    the same bucket, so that each bucket can be rescored on its own.
+    Sorted input is split into runs of consecutive contigs, so the buckets
+    stay in order. Otherwise contigs are assigned to buckets by a hash of
+    their name. makeFile is called to get the path of each new bucket.
+    Returns the paths of the non-empty buckets.
+    """
+    numBuckets = max(1, int(math.ceil(os.path.getsize(inputFile) / float(bucketSize))))
+    bucketFiles = []
+    with ExitStack() as stack:
+        buckets = {}
+        bucketBytes = 0
+        prevContig = None
+        for line in stack.enter_context(open(inputFile)):
+            fields = line.split(None, 6)
+            if len(fields) < 6:
+                continue
+            contig = fields[5]
+            if sortedInput:
+                if contig != prevContig and (len(bucketFiles) == 0 or bucketBytes >= bucketSize):
+                    bucketFiles.append(makeFile())
+                    buckets[0] = stack.enter_context(open(bucketFiles[-1], 'w'))
+                    bucketBytes = 0
+                bucket = 0
+                prevContig = contig
+            else:
+                bucket = zlib.crc32(contig.encode()) % numBuckets
+                if bucket not in buckets:
+                    bucketFiles.append(makeFile())
+                    buckets[bucket] = stack.enter_context(open(bucketFiles[-1], 'w'))
+            buckets[bucket].write(line)
+            bucketBytes += len(line)
+    return bucketFiles
 
 def mappingQualityRescoring(job, inputAlignmentFileID,
-                            minimumMapQValue, maxAlignmentsPerSite, alpha, logLevel):
+                            minimumMapQValue, maxAlignmentsPerSite, alpha, logLevel,
+                            sortedInput=False, bucketSize=0):
     """
     Function to rescore and filter alignments by calculating the mapping quality of sub-alignments
 
+    If sortedInput is set, the alignments have already been through
+    mirrorAndSortAlignments (and mergeSortedAlignments) and aren't sorted again.
+
+    If bucketSize is set and the alignments are bigger than it, they are
+    partitioned by contig (see partitionAlignments) and each bucket is
+    rescored by a child job.
+
     Returns primary alignments and secondary alignments in two separate files.
     """
     inputAlignmentFile = job.fileStore.readGlobalFile(inputAlignmentFileID)
+    if bucketSize <= 0 or os.path.getsize(inputAlignmentFile) <= bucketSize:
+        primaryFile, secondaryFile = rescoreAlignments(job, inputAlignmentFile, minimumMapQValue, maxAlignmentsPerSite,
+                                                       alpha, logLevel, mirrored=sortedInput, sortedInput=sortedInput)
+        return job.fileStore.writeGlobalFile(primaryFile), job.fileStore.writeGlobalFile(secondaryFile)
+
+    if sortedInput:
+        mirroredFile = inputAlignmentFile
+    else:
+        mirroredFile = job.fileStore.getLocalTempFile()
+        cactus_call(outfile=mirroredFile,
+                    parameters=[["cat", inputAlignmentFile],
+                                ["cactus_mirrorAndOrientAlignments", logLevel]])
+    bucketFiles = partitionAlignments(mirroredFile, bucketSize, sortedInput, job.fileStore.getLocalTempFile)
+    job.fileStore.logToMaster("Rescoring alignments in %d buckets" % len(bucketFiles))
+    bucketResults = []
+    for bucketFile in bucketFiles:
+        bucketID = job.fileStore.writeGlobalFile(bucketFile, cleanup=True)
+        bucketResults.append(job.addChildJobFn(mappingQualityRescoringBucket, bucketID,
+                                               minimumMapQValue, maxAlignmentsPerSite, alpha, logLevel,
+                                               sortedInput, disk=4*bucketID.size, preemptable=True).rv())
+    return job.addFollowOnJobFn(mergeRescoredBuckets, bucketResults, preemptable=True).rv()
 
-    job.fileStore.logToMaster("Input cigar file has %s lines" % countLines(inputAlignmentFile))
+def mappingQualityRescoringBucket(job, bucketID, minimumMapQValue, maxAlignmentsPerSite, alpha, logLevel, sortedInput):
+    """Rescore one bucket of mirrored alignments made by partitionAlignments."""
+    bucketFile = job.fileStore.readGlobalFile(bucketID)
+    primaryFile, secondaryFile = rescoreAlignments(job, bucketFile, minimumMapQValue, maxAlignmentsPerSite,
+                                                   alpha, logLevel, mirrored=True, sortedInput=sortedInput)
+    return job.fileStore.writeGlobalFile(primaryFile), job.fileStore.writeGlobalFile(secondaryFile)
 
+def mergeRescoredBuckets(job, bucketResults):
+    """Concatenate the (primary, secondary) alignments of each bucket, in
+    order, in a child with room for them now that their sizes are known."""
+    disk = 2*sum(result[i].size for result in bucketResults for i in range(2))
+    return job.addChildJobFn(concatenateRescoredBuckets, bucketResults, disk=disk, preemptable=True).rv()
+
+def concatenateRescoredBuckets(job, bucketResults):
+    outputIDs = []
+    for i in range(2):
+        outputFile = job.fileStore.getLocalTempFile()
+        cactus_call(parameters=[["cat"] + [job.fileStore.readGlobalFile(result[i]) for result in bucketResults]],
+                    outfile=outputFile)
+        outputIDs.append(job.fileStore.writeGlobalFile(outputFile))
+    return tuple(outputIDs)
+
+def rescoreAlignments(job, inputAlignmentFile, minimumMapQValue, maxAlignmentsPerSite, alpha, logLevel,
+                      mirrored, sortedInput):
+    """Rescore and filter a local cigar file, which may already have been
+    mirrored and sorted, returning the local paths of the primary and
+    secondary alignments."""
     # Get temporary file
     assert maxAlignmentsPerSite >= 1
     tempAlignmentFiles = [job.fileStore.getLocalTempFile() for i in range(maxAlignmentsPerSite)]
 
     # Mirror and orient alignments, sort, split overlaps and calculate mapping qualities
-    cactus_call(parameters=[["cat", inputAlignmentFile],
-                            ["cactus_mirrorAndOrientAlignments", logLevel],
-                            ["sort", "-T{}".format(job.fileStore.getLocalTempDir()), "-k6,6", "-k7,7n", "-k8,8n"], # This sorts by coordinate
-                            ["uniq"], # This eliminates any annoying duplicates if lastz reports the alignment in both orientations
-                            ["cactus_splitAlignmentOverlaps", logLevel],
-                            ["cactus_calculateMappingQualities", logLevel, str(maxAlignmentsPerSite),
-                             str(minimumMapQValue), str(alpha)] + tempAlignmentFiles])
+    sortCommands = [["cat"]]
+    if not mirrored:
+        sortCommands.append(["cactus_mirrorAndOrientAlignments", logLevel])
+    if not sortedInput:
+        sortCommands += [sortAlignmentsCommand(job.fileStore.getLocalTempDir()), # This sorts by coordinate
+                         ["uniq"]] # This eliminates any annoying duplicates if lastz reports the alignment in both orientations
+    # The input and outputs go through counting tees, so their sizes can be
+    # logged and recorded without reading them again
+    with ExitStack() as stack:
+        inputTee = stack.enter_context(CountingTee(inputAlignmentFile, 'r', name="Input cigar file"))
+        outputTees = [stack.enter_context(CountingTee(tempAlignmentFile, 'w'))
+                      for tempAlignmentFile in tempAlignmentFiles]
+        cactus_call(infile=inputTee.fifo,
+                    parameters=sortCommands +
+                               [["cactus_splitAlignmentOverlaps", logLevel],
+                                ["cactus_calculateMappingQualities", logLevel, str(maxAlignmentsPerSite),
+                                 str(minimumMapQValue), str(alpha)] + [tee.fifo for tee in outputTees]])
 
     # Merge together the output files in order
     secondaryTempAlignmentFile = job.fileStore.getLocalTempFile()
     if len(tempAlignmentFiles) > 1:
         cactus_call(parameters=[["cat" ] + tempAlignmentFiles[1:]], outfile=secondaryTempAlignmentFile)
 
-    job.fileStore.logToMaster("Filtered, non-overlapping primary cigar file has %s lines" % countLines(tempAlignmentFiles[0]))
-    job.fileStore.logToMaster("Filtered, non-overlapping secondary cigar file has %s lines" % countLines(secondaryTempAlignmentFile))
+    primaryStats = outputTees[0].stats
+    primaryStats.name = "Filtered, non-overlapping primary cigar file"
+    secondaryStats = sum([tee.stats for tee in outputTees[1:]],
+                         StreamStats("Filtered, non-overlapping secondary cigar file"))
+    for stats in (inputTee.stats, primaryStats, secondaryStats):
+        job.fileStore.logToMaster(str(stats))
+        writeCallMetrics(makeStreamMetrics("cactus_calculateMappingQualities", stats, jobName="mappingQualityRescoring"),
+                         fileStore=job.fileStore)
 
-    # Now write back alignments results file and return
-    return job.fileStore.writeGlobalFile(tempAlignmentFiles[0]), job.fileStore.writeGlobalFile(secondaryTempAlignmentFile)
+    return tempAlignmentFiles[0], secondaryTempAlignmentFile
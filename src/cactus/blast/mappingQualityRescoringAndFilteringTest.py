@@ -13,6 +13,8 @@ from textwrap import dedent
 from cactus.shared.common import cactus_call, runSelfLastz
 from cactus.shared.test import getCactusInputs_encode
 from cactus.blast.mappingQualityRescoringAndFiltering import mappingQualityRescoring
+from cactus.blast.mappingQualityRescoringAndFiltering import mirrorAndSortAlignments, mergeSortedAlignments
+from cactus.blast.mappingQualityRescoringAndFiltering import partitionAlignments
 from cactus.shared.common import makeURL
 
 from cactus.shared.test import getCactusInputs_evolverMammals
@@ -318,7 +320,7 @@ class TestCase(unittest.TestCase):
 
         self.assertEqual(self.filteredSortedNonOverlappingInputCigars, outputCigars)
 
-    def runToilPipeline(self, alignmentsFile, alpha=0.001):
+    def runToilPipeline(self, alignmentsFile, alpha=0.001, sortedInput=False, bucketSize=0):
         # Tests the toil pipeline
         options = Job.Runner.getDefaultOptions(os.path.join(self.tempDir, "toil"))
         options.logLevel = self.logLevelString
@@ -328,7 +330,8 @@ class TestCase(unittest.TestCase):
             inputAlignmentFileID = toil.importFile(makeURL(alignmentsFile))
 
             rootJob = Job.wrapJobFn(mappingQualityRescoring, inputAlignmentFileID,
-                                    minimumMapQValue=0, maxAlignmentsPerSite=1, alpha=alpha, logLevel=self.logLevelString)
+                                    minimumMapQValue=0, maxAlignmentsPerSite=1, alpha=alpha, logLevel=self.logLevelString,
+                                    sortedInput=sortedInput, bucketSize=bucketSize)
 
             primaryOutputAlignmentsFileID, secondaryOutputAlignmentsFileID = toil.start(rootJob)
             toil.exportFile(primaryOutputAlignmentsFileID, makeURL(self.simpleOutputCigarPath))
@@ -352,6 +355,64 @@ class TestCase(unittest.TestCase):
 
         self.assertEqual(self.filteredSortedNonOverlappingInputCigars, outputCigars)
 
+    @TestStatus.shortLength
+    def testMergeSortedAlignments(self):
+        """
+        Tests that merging separately sorted pieces gives the same alignments as
+        sorting them all at once, and that the pipeline gives the same results on them.
+        """
+        sortedPaths = []
+        # The pieces overlap, to check duplicates are removed
+        for i in range(3):
+            piecePath = os.path.join(self.tempDir, "piece%d.cigar" % i)
+            with open(piecePath, 'w') as fH:
+                fH.write("\n".join(self.inputCigars[i*4:i*4 + 5]) + "\n")
+            sortedPaths.append(os.path.join(self.tempDir, "piece%d.sorted.cigar" % i))
+            mirrorAndSortAlignments(piecePath, sortedPaths[-1], self.tempDir, self.logLevelString)
+        mergedPath = os.path.join(self.tempDir, "merged.cigar")
+        mergeSortedAlignments(sortedPaths, mergedPath, maxOpenFiles=2)
+
+        mirrorAndSortAlignments(self.simpleInputCigarPath, self.simpleOutputCigarPath, self.tempDir, self.logLevelString)
+        with open(mergedPath) as mergedFile, open(self.simpleOutputCigarPath) as sortedFile:
+            self.assertEqual(mergedFile.read(), sortedFile.read())
+
+        outputCigars = self.runToilPipeline(mergedPath, alpha=1.0, sortedInput=True)
+        self.assertEqual(self.filteredSortedNonOverlappingInputCigars, outputCigars)
+
+    @TestStatus.shortLength
+    def testPartitionedRescoring(self):
+        """
+        Tests that splitting the alignments by contig keeps each contig in one
+        bucket and gives the same results as rescoring them all at once.
+        """
+        sortedPath = os.path.join(self.tempDir, "sorted.cigar")
+        mirrorAndSortAlignments(self.simpleInputCigarPath, sortedPath, self.tempDir, self.logLevelString)
+        for sortedInput in (True, False):
+            bucketPaths = partitionAlignments(sortedPath, 100, sortedInput,
+                                              lambda: getTempFile(rootDir=self.tempDir))
+            self.assertTrue(len(bucketPaths) > 1)
+            bucketContigs = []
+            bucketLines = []
+            for bucketPath in bucketPaths:
+                with open(bucketPath) as bucketFile:
+                    lines = bucketFile.readlines()
+                bucketContigs.append(set(line.split()[5] for line in lines))
+                bucketLines += lines
+            for i in range(len(bucketContigs)):
+                for j in range(i + 1, len(bucketContigs)):
+                    self.assertEqual(bucketContigs[i] & bucketContigs[j], set())
+            with open(sortedPath) as sortedFile:
+                sortedLines = sortedFile.readlines()
+            if sortedInput:
+                self.assertEqual(bucketLines, sortedLines)
+            else:
+                self.assertEqual(sorted(bucketLines), sorted(sortedLines))
+
+        outputCigars = self.runToilPipeline(sortedPath, alpha=1.0, sortedInput=True, bucketSize=100)
+        self.assertEqual(self.filteredSortedNonOverlappingInputCigars, outputCigars)
+        outputCigars = self.runToilPipeline(self.simpleInputCigarPath, alpha=1.0, bucketSize=100)
+        self.assertEqual(sorted(self.filteredSortedNonOverlappingInputCigars), sorted(outputCigars))
+
     def alignAndRunPipeline(self, concatenatedSequenceFile):
         # Run lastz
         startTime = time.time()
@@ -1,8 +1,89 @@
 #!/usr/bin/env python3
 from collections import defaultdict
 from operator import itemgetter
+import math
 
 def windowFilter(windowSize, threshold, blockDict, seqLengths):
+    """Get dict of sequence -> [(start, end)] regions where the fraction of
+    each windowSize-long window covered by blocks is at least threshold.
+
+    Each sequence is handled independently by windowFilterSequence, so
+    the work is proportional to the number of blocks rather than the
+    number of bases.
+    """
+    if windowSize == 1 and threshold == 1:
+        # Don't need to do expensive window-filtering
+        return blockDict
+    ret = defaultdict(list)
+    for seq, blocks in list(blockDict.items()):
+        regions = windowFilterSequence(windowSize, threshold, blocks, seqLengths[seq])
+        if len(regions) > 0:
+            ret[seq] = regions
+    return ret
+
+def windowFilterSequence(windowSize, threshold, blocks, seqLength):
+    """Window-filter the (start, stop, score) blocks of a single sequence.
+
+    The number of covered bases in the window [i, i + windowSize) is a
+    piecewise-linear function of i that only changes slope at
+    start - windowSize, start, stop - windowSize and stop of each
+    block, so we sweep over those breakpoints instead of over every
+    base. Gives the same regions as naiveWindowFilter.
+    """
+    blocks = [block for block in blocks if block[2] >= 1 and block[1] > block[0]]
+    # Smallest covered-base count that passes the threshold.
+    minCovered = max(int(math.ceil(threshold * windowSize)), 0)
+    while minCovered > 0 and (minCovered - 1) / float(windowSize) >= threshold:
+        minCovered -= 1
+    while minCovered / float(windowSize) < threshold:
+        minCovered += 1
+
+    # Covered bases in the first window, and the slope changes of the
+    # covered-base count: a base entering the window at i + windowSize
+    # adds one, a base leaving it at i removes one.
+    covered = 0
+    slopeChanges = defaultdict(int)
+    for start, stop, _ in blocks:
+        covered += max(0, min(stop, windowSize) - start)
+        slopeChanges[start - windowSize] += 1
+        slopeChanges[stop - windowSize] -= 1
+        slopeChanges[start] -= 1
+        slopeChanges[stop] += 1
+    slope = 0
+    for pos in [pos for pos in slopeChanges if pos <= 0]:
+        slope += slopeChanges.pop(pos)
+    breakpoints = sorted(pos for pos in slopeChanges if pos < seqLength) + [seqLength]
+
+    ret = []
+    inRegion = False
+    regionStart = 0
+    segmentStart = 0
+    for segmentEnd in breakpoints:
+        # covered is the count at segmentStart and slope is constant
+        # until segmentEnd, so the state flips at most once in between.
+        if covered >= minCovered and not inRegion:
+            regionStart = segmentStart
+            inRegion = True
+        elif covered < minCovered and inRegion:
+            ret.append((regionStart, segmentStart + windowSize - 1))
+            inRegion = False
+        if slope > 0 and not inRegion:
+            flip = segmentStart + (minCovered - covered + slope - 1) // slope
+            if flip < segmentEnd:
+                regionStart = flip
+                inRegion = True
+        elif slope < 0 and inRegion:
+            flip = segmentStart + (covered - minCovered) // -slope + 1
+            if flip < segmentEnd:
+                ret.append((regionStart, flip + windowSize - 1))
+                inRegion = False
+        covered += slope * (segmentEnd - segmentStart)
+        slope += slopeChanges.get(segmentEnd, 0)
+        segmentStart = segmentEnd
+    return ret
+
+def naiveWindowFilter(windowSize, threshold, blockDict, seqLengths):
+    """Per-base reference implementation of windowFilter, kept for testing."""
     if windowSize == 1 and threshold == 1:
         # Don't need to do expensive window-filtering
         return blockDict
@@ -115,34 +196,81 @@ def complementBlocks(blocksDict, seqLengths):
             ret[chr].append((0, len))
     return ret
 
-def printTrimmedSeq(header, seq, blocks, outFile):
-    for block in blocks:
-        outFile.write(">%s|%d\n" % (header, block[0]))
-        outFile.write(seq[block[0]:block[1]])
-        outFile.write("\n")
+class TrimmedSeqPrinter(object):
+    """Prints the (start, end) blocks of a single sequence as its lines are
+    streamed in, so only one line of the sequence is held in memory.
+    The blocks must not overlap.
+    """
+    def __init__(self, header, blocks, outFile):
+        self.header = header
+        self.blocks = sorted(blocks, key=itemgetter(0))
+        for prevBlock, block in zip(self.blocks, self.blocks[1:]):
+            if block[0] < prevBlock[1]:
+                raise RuntimeError("Overlapping blocks %s and %s on %s "
+                                   "cannot be trimmed" % (prevBlock, block, header))
+        self.outFile = outFile
+        # Index of the next block to finish, whether it's been started,
+        # and the position in the sequence of the next line.
+        self.blockIdx = 0
+        self.inBlock = False
+        self.pos = 0
+
+    def addLine(self, line):
+        lineEnd = self.pos + len(line)
+        while self.blockIdx < len(self.blocks):
+            block = self.blocks[self.blockIdx]
+            if not self.inBlock:
+                if block[0] >= lineEnd:
+                    break
+                self.outFile.write(">%s|%d\n" % (self.header, block[0]))
+                self.inBlock = True
+            self.outFile.write(line[max(block[0], self.pos) - self.pos:min(block[1], lineEnd) - self.pos])
+            if block[1] > lineEnd:
+                break
+            self.outFile.write("\n")
+            self.inBlock = False
+            self.blockIdx += 1
+        self.pos = lineEnd
+
+    def finish(self):
+        """Close off the blocks that run past the end of the sequence."""
+        for block in self.blocks[self.blockIdx:]:
+            if not self.inBlock:
+                self.outFile.write(">%s|%d\n" % (self.header, block[0]))
+            self.outFile.write("\n")
+            self.inBlock = False
+        self.blockIdx = len(self.blocks)
 
 def printTrimmedFasta(fastaFile, toTrim, outFile):
-    header = None
-    seq = None
+    """Print the toTrim blocks of each sequence in the fasta, streaming
+    through it rather than loading whole sequences."""
+    printer = None
     for line in fastaFile:
         line = line.strip()
         if len(line) == 0:
             # Blank line
             continue
         if line[0] == '>':
-            if seq is not None:
-                printTrimmedSeq(header, seq, toTrim[header], outFile)
-            seq = ""
+            if printer is not None:
+                printer.finish()
             header = line[1:].split()[0]
+            printer = TrimmedSeqPrinter(header, toTrim.get(header, []), outFile)
             continue
-        seq += line
-    if seq is not None:
-        printTrimmedSeq(header, seq, toTrim[header], outFile)
+        printer.addLine(line)
+    if printer is not None:
+        printer.finish()
 
 def trimSequences(fastaPath, bedPath, outputPathOrFile, flanking=0, minSize=0,
-                  windowSize=10, threshold=0.8, depth=1, complement=False):
-    fastaFile = open(fastaPath)
-    seqLengths = getSeqLengths(fastaFile)
+                  windowSize=10, threshold=0.8, depth=1, complement=False,
+                  seqLengths=None):
+    """Trim the fasta down to the regions covered by the bed (or not covered,
+    if complement is set). seqLengths is an optional header -> length dict
+    for the fasta, to save reading it twice."""
+    if seqLengths is None:
+        with open(fastaPath) as fastaFile:
+            seqLengths = getSeqLengths(fastaFile)
+    else:
+        seqLengths = defaultdict(int, seqLengths)
     with open(bedPath) as bedFile:
         toTrim = windowFilter(windowSize, threshold,
                               getSeparateBedBlocks(bedFile, depth), seqLengths)
@@ -157,11 +285,13 @@ def trimSequences(fastaPath, bedPath, outputPathOrFile, flanking=0, minSize=0,
                                      min(x[1] + flanking, seqLengths[k])) for x in v])
                   for k, v in list(toTrim.items()))
 
-    fastaFile.seek(0)
     try:
         outputPathOrFile.write('')
         outputFile = outputPathOrFile
     except:
         # Not a file
         outputFile = open(outputPathOrFile, 'w')
-    printTrimmedFasta(fastaFile, toTrim, outputFile)
+    with open(fastaPath) as fastaFile:
+        printTrimmedFasta(fastaFile, toTrim, outputFile)
+    if outputFile is not outputPathOrFile:
+        outputFile.close()
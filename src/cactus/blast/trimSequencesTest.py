@@ -1,9 +1,15 @@
 import unittest
+import random
+import time
+from collections import defaultdict
 from io import StringIO
 from textwrap import dedent
 from sonLib.bioio import getTempFile
 from sonLib.bioio import TestStatus
+from sonLib.bioio import logger
 from cactus.blast.trimSequences import trimSequences
+from cactus.blast.trimSequences import windowFilter, naiveWindowFilter
+from cactus.blast.trimSequences import printTrimmedFasta
 import os
 
 class TestCase(unittest.TestCase):
@@ -109,5 +115,57 @@ class TestCase(unittest.TestCase):
         >seq1|15
         G''') in output.getvalue())
 
+    @TestStatus.shortLength
+    def testBlocksSpanningLines(self):
+        output = StringIO()
+        with open(self.faPath) as fastaFile:
+            printTrimmedFasta(fastaFile, { 'seq1': [(20, 50), (90, 100)] }, output)
+        self.assertEqual(output.getvalue(), dedent('''\
+        >seq1|20
+        CATGCATGCATGCATGCATGCATGCATGCA
+        >seq1|90
+        TGCATG
+        '''))
+
+    @TestStatus.shortLength
+    def testWindowFilter(self):
+        # The block sweep should give exactly the same regions as the
+        # per-base implementation.
+        for i in range(1000):
+            seqLength = random.randint(0, 300)
+            blockDict = { 'seq': randomBlocks(seqLength, 30, 30) }
+            seqLengths = defaultdict(int, { 'seq': seqLength })
+            windowSize = random.randint(2, 30)
+            threshold = random.choice([0.0, 0.1, 0.5, 0.8, 1.0/3, 1])
+            self.assertEqual(dict(windowFilter(windowSize, threshold, blockDict, seqLengths)),
+                             dict(naiveWindowFilter(windowSize, threshold, blockDict, seqLengths)))
+
+    @TestStatus.veryLongLength
+    def testWindowFilterBenchmark(self):
+        # Synthetic 100 Mbp genome split into 4 chromosomes.
+        seqLengths = defaultdict(int)
+        blockDict = {}
+        for i in range(4):
+            seqLengths['chr%d' % i] = 25000000
+            blockDict['chr%d' % i] = randomBlocks(25000000, 2000, 2000)
+        startTime = time.time()
+        regions = windowFilter(10, 0.8, blockDict, seqLengths)
+        logger.critical("It took %s seconds to window-filter the 100 Mbp genome" % (time.time() - startTime))
+        startTime = time.time()
+        naiveRegions = naiveWindowFilter(10, 0.8, blockDict, seqLengths)
+        logger.critical("It took %s seconds to window-filter the 100 Mbp genome per-base" % (time.time() - startTime))
+        self.assertEqual(dict(regions), dict(naiveRegions))
+
+def randomBlocks(seqLength, maxGap, maxSize):
+    """Get a sorted list of non-overlapping (start, stop, score) blocks, like
+    the ones cactus_coverage produces."""
+    blocks = []
+    pos = random.randint(0, maxGap)
+    while pos < seqLength:
+        end = min(pos + random.randint(1, maxSize), seqLength)
+        blocks.append((pos, end, random.randint(1, 3)))
+        pos = end + random.randint(0, maxGap)
+    return blocks
+
 if __name__ == "__main__":
     unittest.main()
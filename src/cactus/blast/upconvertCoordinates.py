@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
 from collections import defaultdict
+from bisect import bisect_right
 import sys
 import os
-from sonLib.bioio import cigarRead, cigarWrite, getTempFile, system
+from sonLib.bioio import cigarRead, cigarWrite
 
 def getSequenceRanges(fa):
     """Get dict of (untrimmed header) -> [(start, non-inclusive end)] mappings
-    from a trimmed fasta."""
+    from a trimmed fasta. Only the sequence lengths are kept, so this
+    streams through the fasta in constant memory."""
     ret = defaultdict(list)
-    curSeq = ""
+    curSeqLength = 0
     curHeader = None
     curTrimmedStart = None
     for line in fa:
@@ -20,18 +22,18 @@ def getSequenceRanges(fa):
             if curHeader is not None:
                 # Add previous seq info to dict
                 trimmedRange = (curTrimmedStart,
-                                curTrimmedStart + len(curSeq))
+                                curTrimmedStart + curSeqLength)
                 untrimmedHeader = "|".join(curHeader.split("|")[:-1])
                 ret[untrimmedHeader].append(trimmedRange)
             curHeader = line[1:].split()[0]
             curTrimmedStart = int(curHeader.split('|')[-1])
-            curSeq = ""
+            curSeqLength = 0
         else:
-            curSeq += line
+            curSeqLength += len(line)
     if curHeader is not None:
         # Add final seq info to dict
         trimmedRange = (curTrimmedStart,
-                        curTrimmedStart + len(curSeq))
+                        curTrimmedStart + curSeqLength)
         untrimmedHeader = "|".join(curHeader.split("|")[:-1])
         ret[untrimmedHeader].append(trimmedRange)
     for key in list(ret.keys()):
@@ -53,40 +55,43 @@ def validateRanges(seqRanges):
                 range2 = ranges[i + 1]
                 assert start < range2[0]
 
-def sortCigarByContigAndPos(cigarPath, contigNum):
-    contigNameKey = 2 if contigNum == 1 else 6
-    startPosKey = 3 if contigNum == 1 else 7
-    tempFile = getTempFile()
-    system("sort -k %d,%d -k %d,%dn %s > %s" % (contigNameKey, contigNameKey, startPosKey, startPosKey, cigarPath, tempFile))
-    return tempFile
+def getRangeStarts(seqRanges):
+    """Get dict of header -> sorted list of range starts, for bisecting."""
+    return dict((seq, [r[0] for r in ranges]) for seq, ranges in seqRanges.items())
+
+def findRange(seqRanges, rangeStarts, contig, pos):
+    """Get the (start, non-inclusive end) range on contig containing pos,
+    or None if there is no such range."""
+    idx = bisect_right(rangeStarts[contig], pos) - 1
+    if idx >= 0 and seqRanges[contig][idx][0] <= pos < seqRanges[contig][idx][1]:
+        return seqRanges[contig][idx]
+    return None
 
 def upconvertCoords(cigarPath, fastaPath, contigNum, outputFile):
     """Convert the coordinates of the given alignment, so that the
     alignment refers to a set of trimmed sequences originating from a
-    contig rather than to the contig itself."""
+    contig rather than to the contig itself.
+
+    cigarPath can also be an open file (e.g. a pipe from lastz). The
+    alignments don't need to be sorted: each one is looked up in the
+    trimmed ranges by bisection, so the cigar is read in a single pass."""
     with open(fastaPath) as f:
         seqRanges = getSequenceRanges(f)
     validateRanges(seqRanges)
-    sortedCigarPath = sortCigarByContigAndPos(cigarPath, contigNum)
-    sortedCigarFile = open(sortedCigarPath)
+    rangeStarts = getRangeStarts(seqRanges)
+    if isinstance(cigarPath, str):
+        cigarFile = open(cigarPath)
+    else:
+        cigarFile = cigarPath
 
-    currentContig = None
-    currentRangeIdx = None
-    currentRange = None
-    for alignment in cigarRead(sortedCigarFile):
+    for alignment in cigarRead(cigarFile):
         # contig1 and contig2 are reversed in python api!!
         contig = alignment.contig2 if contigNum == 1 else alignment.contig1
         minPos = min(alignment.start2, alignment.end2) if contigNum == 1 else min(alignment.start1, alignment.end1)
         maxPos = max(alignment.start2, alignment.end2) if contigNum == 1 else max(alignment.start1, alignment.end1)
         if contig in seqRanges:
-            if contig != currentContig:
-                currentContig = contig
-                currentRangeIdx = 0
-                currentRange = seqRanges[contig][0]
-            while (minPos >= currentRange[1] or minPos < currentRange[0]) and currentRangeIdx < len(seqRanges[contig]) - 1:
-                currentRangeIdx += 1
-                currentRange = seqRanges[contig][currentRangeIdx]
-            if currentRange[0] <= minPos < currentRange[1]:
+            currentRange = findRange(seqRanges, rangeStarts, contig, minPos)
+            if currentRange is not None:
                 if maxPos - 1 > currentRange[1]:
                     raise RuntimeError("alignment on %s:%d-%d crosses "
                                        "trimmed sequence boundary" %\
@@ -107,4 +112,5 @@ def upconvertCoords(cigarPath, fastaPath, contigNum, outputFile):
                                                     minPos,
                                                     maxPos))
         cigarWrite(outputFile, alignment, False)
-    os.remove(sortedCigarPath)
+    if cigarFile is not cigarPath:
+        cigarFile.close()
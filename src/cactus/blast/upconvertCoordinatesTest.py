@@ -0,0 +1,84 @@
+import unittest
+import os
+import io
+import shutil
+import subprocess
+from textwrap import dedent
+from sonLib.bioio import TestStatus
+from sonLib.bioio import getTempDirectory
+from sonLib.bioio import cigarRead, cigarWrite
+from sonLib.bioio import PairwiseAlignment, AlignmentOperation
+from cactus.blast.upconvertCoordinates import upconvertCoords
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tempDir = getTempDirectory(os.getcwd())
+        # Two trimmed pieces of chr1 and one of chr2
+        self.fastaPath = os.path.join(self.tempDir, "trimmed.fa")
+        with open(self.fastaPath, 'w') as f:
+            f.write(dedent('''\
+            >id=0|chr1|500
+            ACGTACGTAC
+            ACGTACGTAC
+            >id=0|chr1|100
+            ACGTACGTAC
+            >id=0|chr2|0
+            ACGTACGTACGTACGTACGT
+            '''))
+        # Out of order on chr1, and on both strands
+        self.alignments = [self.alignment("id=0|chr1", 510, 515),
+                           self.alignment("id=0|chr2", 4, 8),
+                           self.alignment("id=0|chr1", 108, 102),
+                           self.alignment("id=0|chr1", 500, 503)]
+        self.cigarPath = os.path.join(self.tempDir, "alignments.cigar")
+        with open(self.cigarPath, 'w') as f:
+            for alignment in self.alignments:
+                cigarWrite(f, alignment, False)
+        # Expected (contig, start, end) of the converted alignments, in input order
+        self.expected = [("id=0|chr1|500", 10, 15),
+                         ("id=0|chr2|0", 4, 8),
+                         ("id=0|chr1|100", 8, 2),
+                         ("id=0|chr1|500", 0, 3)]
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tempDir)
+
+    def alignment(self, contig, start, end):
+        length = abs(end - start)
+        return PairwiseAlignment("id=1|other", 0, length, True,
+                                 contig, start, end, start < end,
+                                 0, [AlignmentOperation(PairwiseAlignment.PAIRWISE_MATCH, length, 0)])
+
+    def convert(self, cigar):
+        outputPath = os.path.join(self.tempDir, "output.cigar")
+        with open(outputPath, 'w') as output:
+            upconvertCoords(cigar, self.fastaPath, 1, output)
+        with open(outputPath) as output:
+            return [(a.contig2, a.start2, a.end2) for a in cigarRead(output)]
+
+    @TestStatus.shortLength
+    def testUnsortedInput(self):
+        self.assertEqual(self.convert(self.cigarPath), self.expected)
+
+    @TestStatus.shortLength
+    def testStreamedInput(self):
+        # Alignments read from a pipe, as they are written by lastz
+        process = subprocess.Popen(["cat", self.cigarPath], stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(self.convert(process.stdout), self.expected)
+        process.stdout.close()
+        self.assertEqual(process.wait(), 0)
+
+        with open(self.cigarPath) as f:
+            self.assertEqual(self.convert(io.StringIO(f.read())), self.expected)
+
+    @TestStatus.shortLength
+    def testAlignmentOutsideTrimmedRanges(self):
+        with open(self.cigarPath, 'w') as f:
+            cigarWrite(f, self.alignment("id=0|chr1", 200, 205), False)
+        with self.assertRaises(RuntimeError):
+            self.convert(self.cigarPath)
+
+if __name__ == '__main__':
+    unittest.main()
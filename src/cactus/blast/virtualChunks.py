@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Virtual chunks: the same chunks as cactus_blast_chunkSequences makes,
+but described as (contig, start, end) ranges of the input FASTA files
+rather than written out and uploaded as FASTA files of their own.
+
+The chunking job only makes a faidx-style index of the input sequences
+(which are already in the job store) and uploads a small manifest of
+the ranges in each chunk. The jobs that align a chunk read the input
+sequences (once per node, through the file store cache) and slice the
+chunk out of them with mmap, writing it with the same "name|start"
+headers as cactus_blast_chunkSequences, so cactus_blast_convertCoordinates
+works on the alignments as usual. lastz's [subrange] syntax isn't used
+because a chunk can hold pieces of many contigs.
+"""
+import mmap
+from collections import namedtuple
+
+# Layout of a contig in a FASTA file, as in a samtools .fai index
+FastaIndexEntry = namedtuple("FastaIndexEntry", ["name", "length", "offset", "lineBases", "lineBytes"])
+
+# Range [start, end) of a contig that is part of a chunk. fileIndex is
+# the position of the contig's file in the chunk's sequenceIDs.
+ChunkRange = namedtuple("ChunkRange", ["fileIndex", "name", "offset", "lineBases", "lineBytes", "start", "end"])
+
+def indexFasta(path):
+    """Index a FASTA file without loading it into memory, returning a list
+    of FastaIndexEntrys, or None if its lines aren't laid out regularly
+    enough to be sliced (every line of a contig but the last must have
+    the same length). Contigs are named by the first word of their header,
+    as in cactus_blast_chunkSequences.
+    """
+    entries = []
+    name = None
+    offset = 0
+    with open(path, 'rb') as fastaFile:
+        for line in fastaFile:
+            lineStart = offset
+            offset += len(line)
+            if line[:1] == b'>':
+                if name is not None:
+                    entries.append(FastaIndexEntry(name, length, seqOffset, lineBases, lineBytes))
+                name = line[1:].rstrip(b'\r\n').split(b' ')[0].split(b'\t')[0].decode()
+                seqOffset = offset
+                length = 0
+                lineBases = lineBytes = None
+                lastLineBases = None
+                continue
+            bases = len(line.rstrip(b'\r\n'))
+            if name is None:
+                if bases > 0:
+                    return None
+                continue
+            if bases == 0:
+                # Blank lines are only allowed after the contig's sequence
+                lastLineBases = 0
+                continue
+            if lastLineBases is not None and lastLineBases != lineBases:
+                # Only the last line can be shorter, and nothing can
+                # follow a blank line
+                return None
+            if lineBases is None:
+                lineBases = bases
+                lineBytes = len(line)
+                seqOffset = lineStart
+            elif bases > lineBases or (bases == lineBases and len(line) != lineBytes):
+                return None
+            lastLineBases = bases
+            length += bases
+    if name is not None:
+        entries.append(FastaIndexEntry(name, length, seqOffset, lineBases, lineBytes))
+    return entries
+
+def chunkRanges(entries, chunkSize, overlapSize):
+    """Split (fileIndex, FastaIndexEntry) pairs into chunks, in the same
+    way as cactus_blast_chunkSequences, yielding the list of ChunkRanges
+    in each chunk.
+    """
+    assert overlapSize <= chunkSize
+    chunks = []
+    chunk = []
+    remaining = [chunkSize]
+
+    def addRange(fileIndex, entry, start, maxLength):
+        length = min(maxLength, entry.length - start)
+        chunk.append(ChunkRange(fileIndex, entry.name, entry.offset, entry.lineBases, entry.lineBytes,
+                                start, start + length))
+        remaining[0] -= length
+        if remaining[0] <= 0:
+            chunks.append(list(chunk))
+            del chunk[:]
+            remaining[0] = chunkSize
+        return length
+
+    for fileIndex, entry in entries:
+        if entry.length == 0:
+            continue
+        position = addRange(fileIndex, entry, 0, remaining[0])
+        while entry.length - position > 0:
+            length = addRange(fileIndex, entry, position, remaining[0])
+            if overlapSize > 0:
+                addRange(fileIndex, entry, max(0, position - overlapSize // 2), overlapSize)
+            position += length
+        for finished in chunks:
+            yield finished
+        del chunks[:]
+    if len(chunk) > 0:
+        yield chunk
+
+def writeChunk(sequenceFiles, ranges, outputFile, lineLength=80):
+    """Slice the given ChunkRanges out of the sequence files, writing them
+    as a chunk FASTA file like those of cactus_blast_chunkSequences.
+    """
+    maps = {}
+    handles = []
+    try:
+        with open(outputFile, 'w') as chunkFile:
+            for chunkRange in ranges:
+                if chunkRange.fileIndex not in maps:
+                    handle = open(sequenceFiles[chunkRange.fileIndex], 'rb')
+                    handles.append(handle)
+                    maps[chunkRange.fileIndex] = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+                sequence = sliceSequence(maps[chunkRange.fileIndex], chunkRange)
+                chunkFile.write(">%s|%d\n" % (chunkRange.name, chunkRange.start))
+                for i in range(0, len(sequence), lineLength):
+                    chunkFile.write(sequence[i:i + lineLength])
+                    chunkFile.write("\n")
+    finally:
+        for fastaMap in maps.values():
+            fastaMap.close()
+        for handle in handles:
+            handle.close()
+
+def sliceSequence(fastaMap, chunkRange):
+    """Get the bases of a ChunkRange from an mmapped FASTA file."""
+    def byteOffset(position):
+        return chunkRange.offset + (position // chunkRange.lineBases) * chunkRange.lineBytes + \
+            position % chunkRange.lineBases
+    data = fastaMap[byteOffset(chunkRange.start):byteOffset(chunkRange.end - 1) + 1]
+    return data.replace(b'\n', b'').replace(b'\r', b'').decode()
+
+class VirtualChunk(object):
+    """Stands in for the file ID of a chunk. The chunk's ranges are stored
+    in a manifest file shared by all the chunks of a set of sequences,
+    between the byte offsets manifestStart and manifestEnd.
+    """
+    def __init__(self, sequenceIDs, manifestID, manifestStart, manifestEnd, size, chunkNumber):
+        self.sequenceIDs = sequenceIDs
+        self.manifestID = manifestID
+        self.manifestStart = manifestStart
+        self.manifestEnd = manifestEnd
+        # Number of bases in the chunk, used for resource estimates
+        self.size = size
+        self.chunkNumber = chunkNumber
+
+    def __eq__(self, other):
+        return isinstance(other, VirtualChunk) and \
+            (self.manifestID, self.chunkNumber) == (other.manifestID, other.chunkNumber)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((str(self.manifestID), self.chunkNumber))
+
+    def __repr__(self):
+        return "VirtualChunk(%s, %d)" % (self.manifestID, self.chunkNumber)
+
+    def getRanges(self, manifestFile):
+        with open(manifestFile, 'rb') as manifest:
+            manifest.seek(self.manifestStart)
+            data = manifest.read(self.manifestEnd - self.manifestStart).decode()
+        ranges = []
+        for line in data.splitlines():
+            fields = line.split('\t')
+            ranges.append(ChunkRange(int(fields[0]), fields[1], *[int(field) for field in fields[2:]]))
+        return ranges
+
+    def read(self, fileStore):
+        """Slice the chunk out of its sequences, returning the path to it."""
+        ranges = self.getRanges(fileStore.readGlobalFile(self.manifestID))
+        sequenceFiles = {}
+        for chunkRange in ranges:
+            if chunkRange.fileIndex not in sequenceFiles:
+                sequenceFiles[chunkRange.fileIndex] = fileStore.readGlobalFile(self.sequenceIDs[chunkRange.fileIndex])
+        chunkFile = fileStore.getLocalTempFile()
+        writeChunk(sequenceFiles, ranges, chunkFile)
+        return chunkFile
+
+def makeVirtualChunks(fileStore, sequenceIDs, sequenceFiles, chunkSize, overlapSize):
+    """Chunk up the sequences, which must be the local copies of sequenceIDs,
+    returning a list of VirtualChunks, or None if any of the files can't
+    be indexed.
+    """
+    entries = []
+    for fileIndex, sequenceFile in enumerate(sequenceFiles):
+        index = indexFasta(sequenceFile)
+        if index is None:
+            return None
+        entries += [(fileIndex, entry) for entry in index]
+    manifestFile = fileStore.getLocalTempFile()
+    chunkOffsets = []
+    with open(manifestFile, 'wb') as manifest:
+        for ranges in chunkRanges(entries, chunkSize, overlapSize):
+            start = manifest.tell()
+            for chunkRange in ranges:
+                manifest.write(("\t".join(map(str, chunkRange)) + "\n").encode())
+            chunkOffsets.append((start, manifest.tell(), sum(r.end - r.start for r in ranges)))
+    manifestID = fileStore.writeGlobalFile(manifestFile, cleanup=True)
+    return [VirtualChunk(sequenceIDs, manifestID, start, end, size, chunkNumber)
+            for chunkNumber, (start, end, size) in enumerate(chunkOffsets)]
+
+def sourceSize(chunkIDs):
+    """Total size of the sequence files that any VirtualChunks among the
+    given chunk IDs are sliced from, each counted once."""
+    sources = {}
+    for chunkID in chunkIDs:
+        if isinstance(chunkID, VirtualChunk):
+            for sequenceID in chunkID.sequenceIDs:
+                sources[str(sequenceID)] = sequenceID.size if hasattr(sequenceID, "size") else 0
+    return sum(sources.values())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+"""Tests slicing chunks out of FASTA files with an index.
+"""
+
+import unittest
+import os
+import random
+from sonLib.bioio import TestStatus
+from sonLib.bioio import getTempFile
+from cactus.blast.virtualChunks import indexFasta, chunkRanges, writeChunk
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tempFiles = []
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        for tempFile in self.tempFiles:
+            if os.path.exists(tempFile):
+                os.remove(tempFile)
+
+    def writeFasta(self, contents):
+        path = getTempFile()
+        self.tempFiles.append(path)
+        with open(path, 'w') as fastaFile:
+            fastaFile.write(contents)
+        return path
+
+    @TestStatus.shortLength
+    def testIndexFasta(self):
+        index = indexFasta(self.writeFasta(">a desc\nACGT\nAC\n\n>b\n>c\tdesc\r\nACG\r\n"))
+        self.assertEqual([(entry.name, entry.length) for entry in index], [("a", 6), ("b", 0), ("c", 3)])
+        self.assertEqual((index[0].offset, index[0].lineBases, index[0].lineBytes), (8, 4, 5))
+        self.assertEqual((index[2].lineBases, index[2].lineBytes), (3, 5))
+        # Lines that can't be sliced
+        self.assertEqual(indexFasta(self.writeFasta(">a\nACG\nACGT\n")), None)
+        self.assertEqual(indexFasta(self.writeFasta(">a\nACGT\n\nACG\n")), None)
+
+    @TestStatus.shortLength
+    def testChunksCoverSequences(self):
+        """Every piece of every chunk should be the right slice of its
+        contig, and the chunks should cover every base."""
+        sequences = {}
+        fastaFiles = []
+        for fileIndex in range(2):
+            contents = ""
+            for contigIndex in range(5):
+                name = "file%dcontig%d" % (fileIndex, contigIndex)
+                sequence = "".join(random.choice("ACGTacgtN") for _ in range(random.randint(0, 3000)))
+                sequences[name] = sequence
+                lineLength = random.randint(5, 100)
+                contents += ">%s some description\n" % name
+                contents += "".join(sequence[i:i + lineLength] + "\n" for i in range(0, len(sequence), lineLength))
+            fastaFiles.append(self.writeFasta(contents))
+        entries = []
+        for fileIndex, fastaFile in enumerate(fastaFiles):
+            entries += [(fileIndex, entry) for entry in indexFasta(fastaFile)]
+        coverage = dict((name, [0] * len(sequence)) for name, sequence in sequences.items())
+        for ranges in chunkRanges(entries, 1000, 100):
+            # Chunks can overflow by up to the overlap size
+            self.assertTrue(sum(r.end - r.start for r in ranges) < 1100)
+            chunkFile = getTempFile()
+            self.tempFiles.append(chunkFile)
+            writeChunk(fastaFiles, ranges, chunkFile)
+            pieces = []
+            with open(chunkFile) as chunk:
+                for line in chunk:
+                    if line[0] == '>':
+                        pieces.append([line[1:].strip(), ""])
+                    else:
+                        pieces[-1][1] += line.strip()
+            for header, sequence in pieces:
+                name, start = header.rsplit("|", 1)
+                start = int(start)
+                self.assertEqual(sequences[name][start:start + len(sequence)], sequence)
+                for i in range(start, start + len(sequence)):
+                    coverage[name][i] += 1
+        for name, depths in coverage.items():
+            self.assertTrue(all(depth > 0 for depth in depths))
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
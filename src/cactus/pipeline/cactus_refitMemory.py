@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Refit the memoryPoly resource models of the cactus workflow jobs from
+the resource usage recorded by cactus_call (see cactus.shared.callMetrics),
+and write them into the config, where they replace the class defaults.
+
+Each job class gets a line through (feature, peak memory) at a high
+quantile of its jobs, by quantile regression, so that most jobs fit in
+their request without reserving the worst case for all of them.
+"""
+import os
+import sys
+import json
+import math
+import xml.etree.ElementTree as ET
+from argparse import ArgumentParser
+from collections import defaultdict
+
+from cactus.shared.common import cactusRootPath
+from cactus.shared.configWrapper import ConfigWrapper
+from cactus.shared.callMetrics import readCallMetrics
+
+def jobPeakMemories(records):
+    """Get the (features, peak memory) of the jobs in a set of call records,
+    by job class. The peak of a job is the largest of its calls', and jobs
+    of a class with identical features are counted once."""
+    peaks = {}
+    for record in records:
+        if not record.get("job") or not record.get("features") or not record.get("peakMemory"):
+            continue
+        key = (record["job"], json.dumps(record["features"], sort_keys=True))
+        peaks[key] = max(peaks.get(key, 0), record["peakMemory"])
+    jobs = defaultdict(list)
+    for (jobName, features), peak in peaks.items():
+        jobs[jobName].append((json.loads(features), peak))
+    return jobs
+
+def quantile(values, q):
+    """The q quantile of values, by nearest rank. This minimises the
+    quantile (pinball) loss among constants."""
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(math.ceil(q * len(values))) - 1))]
+
+def quantileLoss(xs, ys, slope, intercept, q):
+    loss = 0.0
+    for x, y in zip(xs, ys):
+        residual = y - (slope * x + intercept)
+        loss += q * residual if residual >= 0 else (q - 1) * residual
+    return loss
+
+def fitLinearQuantile(xs, ys, q, iterations=100):
+    """Fit y = slope * x + intercept at quantile q, with a non-negative
+    slope, returning [slope, intercept].
+
+    For a given slope the best intercept is the q quantile of the
+    residuals, and the loss of that fit is convex in the slope, so the
+    slope is found by golden section search. The best fit passes through
+    two points, so it is no steeper than the steepest line between points
+    adjacent in x.
+    """
+    points = sorted(zip(xs, ys))
+    maxSlope = 0.0
+    for (x1, y1), (x2, y2) in zip(points, points[1:]):
+        if x2 > x1:
+            maxSlope = max(maxSlope, (y2 - y1) / float(x2 - x1))
+
+    def fit(slope):
+        intercept = quantile([y - slope * x for x, y in points], q)
+        return quantileLoss(xs, ys, slope, intercept, q), intercept
+
+    ratio = (math.sqrt(5) - 1) / 2
+    low, high = 0.0, maxSlope
+    for i in range(iterations):
+        a = high - ratio * (high - low)
+        b = low + ratio * (high - low)
+        if fit(a)[0] <= fit(b)[0]:
+            high = b
+        else:
+            low = a
+    slope = min([low, high, 0.0, maxSlope], key=lambda s: fit(s)[0])
+    return [slope, fit(slope)[1]]
+
+def fitMemoryPoly(points, q, minJobs=10):
+    """Fit a memoryPoly to (feature, peak memory) points. With too few jobs
+    (or sizes) to fit a line, the quantile itself is used."""
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+    if len(points) < minJobs or min(xs) == max(xs):
+        return [quantile(ys, q)]
+    slope, intercept = fitLinearQuantile(xs, ys, q)
+    # Small jobs still need some memory
+    return [slope, max(intercept, 0.0)]
+
+def formatResourcePoly(poly):
+    return " ".join("%.6g" % coefficient for coefficient in poly)
+
+def setMemoryPolys(configNode, polys):
+    """Set the memoryPoly attribute of the job nodes of the given classes,
+    returning the classes that have no node in the config."""
+    missing = []
+    for jobName, poly in sorted(polys.items()):
+        jobNodes = list(configNode.iter(jobName))
+        if not jobNodes:
+            missing.append(jobName)
+        for jobNode in jobNodes:
+            jobNode.attrib["memoryPoly"] = formatResourcePoly(poly)
+    return missing
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("metricsFiles", nargs="+", help="Metrics files (CACTUS_METRICS_FILE) "
+                        "or leader logs containing metrics records (CACTUS_METRICS_LOG_TO_LEADER)")
+    parser.add_argument("--configFile", default=os.path.join(cactusRootPath(), "cactus_progressive_config.xml"))
+    parser.add_argument("--outputFile", help="Config file to write [default: overwrite --configFile]")
+    parser.add_argument("--quantile", type=float, default=0.95, help="Quantile of the peak memory of jobs to fit")
+    parser.add_argument("--minJobs", type=int, default=10, help="Minimum number of jobs to fit a line rather than a constant")
+    parser.add_argument("--jobs", nargs="*", help="Only refit these job classes")
+    options = parser.parse_args()
+
+    # Only needed to know which feature each class's polynomial is in
+    import cactus.pipeline.cactus_workflow as cactus_workflow
+
+    records = []
+    for metricsFile in options.metricsFiles:
+        records += readCallMetrics(metricsFile)
+
+    polys = {}
+    for jobName, jobs in sorted(jobPeakMemories(records).items()):
+        jobClass = getattr(cactus_workflow, jobName, None)
+        if not isinstance(jobClass, type) or not issubclass(jobClass, cactus_workflow.CactusJob):
+            continue
+        if options.jobs and jobName not in options.jobs:
+            continue
+        feature = getattr(jobClass, "feature", "totalSequenceSize")
+        points = [(features[feature], peak) for features, peak in jobs if feature in features]
+        if not points:
+            continue
+        polys[jobName] = fitMemoryPoly(points, options.quantile, options.minJobs)
+        print("%s: %d jobs, memoryPoly on %s = %s (was %s)" % (
+            jobName, len(points), feature, formatResourcePoly(polys[jobName]),
+            formatResourcePoly(getattr(jobClass, "memoryPoly", [])) or "unset"))
+
+    configWrapper = ConfigWrapper(ET.parse(options.configFile).getroot())
+    for jobName in setMemoryPolys(configWrapper.xmlRoot, polys):
+        sys.stderr.write("Warning: %s has no node in the config, add one to its phase to use its fit\n" % jobName)
+    configWrapper.writeXML(options.outputFile or options.configFile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+"""Tests refitting job memory polynomials from recorded resource usage.
+"""
+
+import unittest
+import random
+import xml.etree.ElementTree as ET
+from sonLib.bioio import TestStatus
+from cactus.pipeline.cactus_refitMemory import jobPeakMemories, fitMemoryPoly, setMemoryPolys
+
+class TestCase(unittest.TestCase):
+    @TestStatus.shortLength
+    def testJobPeakMemories(self):
+        records = [{"job": "CactusBarWrapper", "features": {"flowerGroupSize": 10}, "peakMemory": 5},
+                   {"job": "CactusBarWrapper", "features": {"flowerGroupSize": 10}, "peakMemory": 7},
+                   {"job": "CactusBarWrapper", "features": {"flowerGroupSize": 20}, "peakMemory": 3},
+                   {"job": None, "features": None, "peakMemory": 100},
+                   {"job": "CactusBarWrapper", "features": {"flowerGroupSize": 30}, "returnCode": 0}]
+        self.assertEqual(sorted(jobPeakMemories(records)["CactusBarWrapper"], key=lambda p: p[1]),
+                         [({"flowerGroupSize": 20}, 3), ({"flowerGroupSize": 10}, 7)])
+
+    @TestStatus.shortLength
+    def testFitMemoryPoly(self):
+        random.seed(1)
+        points = []
+        for i in range(1000):
+            x = random.uniform(0, 1e9)
+            points.append((x, 2 * x + 1e9 + random.uniform(0, 1e8)))
+        slope, intercept = fitMemoryPoly(points, 0.95)
+        self.assertAlmostEqual(slope, 2, delta=0.01)
+        self.assertAlmostEqual(intercept, 1.095e9, delta=1e7)
+        covered = sum(1 for x, y in points if y <= slope * x + intercept)
+        self.assertTrue(940 <= covered <= 960)
+
+        # Too few jobs for a line
+        self.assertEqual(fitMemoryPoly(points[:5], 0.95), [max(y for x, y in points[:5])])
+        # Memory can't go down with size
+        self.assertEqual(fitMemoryPoly([(x, 1e9 - x) for x in range(20)], 0.5)[0], 0)
+
+    @TestStatus.shortLength
+    def testSetMemoryPolys(self):
+        configNode = ET.fromstring('<cactusWorkflowConfig><bar><CactusBarWrapper memory="littleMemory"/></bar>'
+                                   '<reference><CactusBarWrapper/></reference></cactusWorkflowConfig>')
+        missing = setMemoryPolys(configNode, {"CactusBarWrapper": [0.25, 3e9], "CactusCafPhase": [4e9]})
+        self.assertEqual(missing, ["CactusCafPhase"])
+        for jobNode in configNode.iter("CactusBarWrapper"):
+            self.assertEqual(jobNode.attrib["memoryPoly"], "0.25 3e+09")
+        self.assertEqual(configNode.find("bar/CactusBarWrapper").attrib["memory"], "littleMemory")
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,7 @@ import xml.etree.ElementTree as ET
 import math
 import time
 import copy
+import functools
 from argparse import ArgumentParser
 from operator import itemgetter
 
@@ -33,7 +34,9 @@ from toil.realtimeLogger import RealtimeLogger
 
 from cactus.shared.common import makeURL
 from cactus.shared.common import cactus_call
+from cactus.shared.common import CactusOOMError
 from cactus.shared.common import RunAsFollowOn
+from cactus.shared.callMetrics import escalatedMemory, recordMemoryEscalation
 from cactus.shared.common import getOptionalAttrib
 from cactus.shared.common import runCactusSetup
 from cactus.shared.common import runCactusCaf
@@ -58,6 +61,7 @@ from cactus.shared.common import runConvertAlignmentsToInternalNames
 from cactus.shared.common import runStripUniqueIDs
 from cactus.shared.common import RoundedJob
 from cactus.shared.common import readGlobalFileWithoutCache
+from cactus.shared.fastaStats import getFastaStats
 
 from cactus.blast.blast import BlastIngroupsAndOutgroups
 from cactus.blast.blast import BlastOptions
@@ -69,7 +73,8 @@ from cactus.shared.experimentWrapper import ExperimentWrapper
 from cactus.shared.experimentWrapper import DbElemWrapper
 from cactus.shared.configWrapper import ConfigWrapper
 from cactus.pipeline.ktserverToil import KtServerService
-from cactus.pipeline.ktserverControl import stopKtserver
+from cactus.pipeline.ktserverControl import stopKtserver, getKtserverStats, saveKtserver, reloadKtserver
+from cactus.pipeline.ktSnapshot import restoreSnapshot
 
 ############################################################
 ############################################################
@@ -92,11 +97,17 @@ def getJobNode(phaseNode, jobClass):
     assert className.isalnum()
     return phaseNode.find(className)
 
+def parseResourcePoly(value):
+    """Parse the coefficients of a resource polynomial from a config
+    attribute, highest degree first, as in the memoryPoly class attributes.
+    """
+    return [float(coefficient) for coefficient in value.split()]
+
 class CactusJob(RoundedJob):
     """Base job for all cactus workflow jobs.
     """
     def __init__(self, phaseNode, constantsNode, overlarge=False,
-                 checkpoint=False, preemptable=True):
+                 checkpoint=False, preemptable=True, memory=None):
         self.phaseNode = phaseNode
         self.constantsNode = constantsNode
         self.overlarge = overlarge
@@ -104,14 +115,22 @@ class CactusJob(RoundedJob):
         if self.jobNode is not None:
             logger.info("JobNode = %s" % self.jobNode.attrib)
 
-        memory = None
         cores = None
-        if hasattr(self, 'memoryPoly'):
+        # The config can replace the class's fit, eg with one refit by
+        # cactus-refit-memory
+        memoryPoly = self.getOptionalJobAttrib("memoryPoly", typeFn=parseResourcePoly,
+                                               default=getattr(self, 'memoryPoly', None))
+        memoryCap = self.getOptionalJobAttrib("memoryCap", typeFn=float,
+                                              default=getattr(self, 'memoryCap', None))
+        if memory is None and memoryPoly is not None:
             # Memory should be determined by a polynomial fit on the
             # input size
-            memory = self.evaluateResourcePoly(self.memoryPoly)
-            if hasattr(self, 'memoryCap'):
-                memory = int(min(memory, self.memoryCap))
+            memory = self.evaluateResourcePoly(memoryPoly)
+            if memoryCap is not None:
+                memory = int(min(memory, memoryCap))
+            if getattr(self.run, 'escalatesMemory', False):
+                # Start with the memory similar jobs had to be rerun with
+                memory = max(memory, self.getEscalatedMemory())
 
         disk = None
         if memory is None and overlarge:
@@ -127,11 +146,16 @@ class CactusJob(RoundedJob):
         RoundedJob.__init__(self, memory=memory, cores=cores, disk=disk,
                             checkpoint=checkpoint, preemptable=preemptable)
 
-    def evaluateResourcePoly(self, poly):
-        """Evaluate a polynomial based on the total sequence size."""
+    def getFeatures(self):
+        """Get the input sizes that resource polynomials are fit on."""
         features = {'totalSequenceSize': self.cactusWorkflowArguments.totalSequenceSize}
         if hasattr(self, 'featuresFn'):
             features.update(self.featuresFn())
+        return features
+
+    def evaluateResourcePoly(self, poly):
+        """Evaluate a polynomial based on the total sequence size."""
+        features = self.getFeatures()
         if hasattr(self, 'feature'):
             x = features[self.feature]
         else:
@@ -249,20 +273,45 @@ class CactusCheckpointJob(CactusPhasesJob):
 
     def runPhaseWithPrimaryDB(self, jobConstructor):
         """Start and load a new primary DB before running the given phase.
+        If the persistent primary DB is running, the phase just uses it.
         """
         job = jobConstructor(cactusWorkflowArguments=self.cactusWorkflowArguments,
                              phaseName=self.phaseName, topFlowerName=self.topFlowerName)
+        if self.cactusWorkflowArguments.primaryDbRunning:
+            return self.addChild(ReloadPrimaryDB(job, ktServerDump=self.ktServerDump,
+                                                 cactusWorkflowArguments=self.cactusWorkflowArguments,
+                                                 phaseName=self.phaseName, topFlowerName=self.topFlowerName))
         startDBJob = StartPrimaryDB(job, ktServerDump=self.ktServerDump,
                                     cactusWorkflowArguments=self.cactusWorkflowArguments,
                                     phaseName=self.phaseName, topFlowerName=self.topFlowerName)
         promise = self.addChild(startDBJob)
         return promise
 
+    def runWithPersistentPrimaryDB(self):
+        """If the primary DB should persist but hasn't been started, start
+        it and run this checkpoint, and so all the ones that follow it,
+        within the scope of its service. Returns the promise of the
+        checkpoint's result, or None if there is nothing to do.
+        """
+        if not self.cactusWorkflowArguments.persistentPrimaryDb or \
+           self.cactusWorkflowArguments.primaryDbRunning or \
+           self.cactusWorkflowArguments.experimentWrapper.getDbType() != "kyoto_tycoon":
+            return None
+        checkpoint = self.__class__(ktServerDump=self.ktServerDump,
+                                    cactusWorkflowArguments=self.cactusWorkflowArguments,
+                                    phaseName=self.phaseName, topFlowerName=self.topFlowerName,
+                                    halID=self.halID, fastaID=self.fastaID)
+        return self.addChild(StartPrimaryDB(checkpoint, ktServerDump=self.ktServerDump, persistent=True,
+                                            cactusWorkflowArguments=self.cactusWorkflowArguments,
+                                            phaseName=self.phaseName, topFlowerName=self.topFlowerName)).rv()
+
 class StartPrimaryDB(CactusPhasesJob):
-    """Launches a primary Cactus DB."""
-    def __init__(self, nextJob, ktServerDump=None, *args, **kwargs):
+    """Launches a primary Cactus DB. A persistent DB is kept running until
+    all of nextJob's successors are done."""
+    def __init__(self, nextJob, ktServerDump=None, persistent=False, *args, **kwargs):
         self.nextJob = nextJob
         self.ktServerDump = ktServerDump
+        self.persistent = persistent
         kwargs['checkpoint'] = True
         kwargs['preemptable'] = False
         super(StartPrimaryDB, self).__init__(*args, **kwargs)
@@ -274,8 +323,17 @@ class StartPrimaryDB(CactusPhasesJob):
             memory = max(2500000000, self.evaluateResourcePoly([4.10201882, 2.01324291e+08]))
             cores = cw.getKtserverCpu(default=0.1)
             dbElem = ExperimentWrapper(self.cactusWorkflowArguments.experimentNode)
+            snapshotExportID = None
+            if self.persistent:
+                # Made here rather than by the service, so that if the
+                # service is restarted it finds the last snapshot saved
+                snapshotExportID = fileStore.jobStore.getEmptyFileStoreID()
+                self.nextJob.cactusWorkflowArguments.primaryDbRunning = True
             service = self.addService(KtServerService(dbElem=dbElem,
                                                       existingSnapshotID=self.ktServerDump,
+                                                      snapshotCodec=cw.getKtserverSnapshotCodec(),
+                                                      snapshotExportID=snapshotExportID,
+                                                      persistent=self.persistent,
                                                       isSecondary=False,
                                                       memory=memory, cores=cores))
             dbString = service.rv(0)
@@ -287,8 +345,28 @@ class StartPrimaryDB(CactusPhasesJob):
         else:
             return self.addFollowOn(self.nextJob).rv()
 
+class ReloadPrimaryDB(CactusPhasesJob):
+    """Runs the phase of a checkpoint against the persistent primary DB,
+    once it holds the snapshot the checkpoint starts from. Like
+    StartPrimaryDB, it is a Toil checkpoint, so if the phase fails it is
+    rerun, and reloads the snapshot the failed run changed."""
+    def __init__(self, nextJob, ktServerDump=None, *args, **kwargs):
+        self.nextJob = nextJob
+        self.ktServerDump = ktServerDump
+        kwargs['checkpoint'] = True
+        kwargs['preemptable'] = False
+        super(ReloadPrimaryDB, self).__init__(*args, **kwargs)
+
+    def run(self, fileStore):
+        dbElem = DbElemWrapper(ET.fromstring(self.cactusWorkflowArguments.cactusDiskDatabaseString))
+        if reloadKtserver(dbElem, self.ktServerDump):
+            fileStore.logToMaster("Reloaded the primary DB with the snapshot the %s checkpoint starts from" %
+                                  self.phaseName)
+        return self.addChild(self.nextJob).rv()
+
 class SavePrimaryDB(CactusPhasesJob):
-    """Saves the DB to a file and clears the DB."""
+    """Saves the DB to a file and clears the DB, unless it is the
+    persistent primary DB, which carries on into the next checkpoint."""
     def __init__(self, *args, **kwargs):
         super(SavePrimaryDB, self).__init__(*args, **kwargs)
 
@@ -297,22 +375,64 @@ class SavePrimaryDB(CactusPhasesJob):
                                      flowerName=0)
         fileStore.logToMaster("At end of %s phase, got stats %s" % (self.phaseName, stats))
         dbElem = DbElemWrapper(ET.fromstring(self.cactusWorkflowArguments.cactusDiskDatabaseString))
-        # Send the terminate message
-        stopKtserver(dbElem)
-        # Wait for the file to appear in the right place. This may take a while
-        while True:
-            with fileStore.readGlobalFileStream(self.cactusWorkflowArguments.snapshotID) as f:
-                if f.read(1) != b'':
-                    # The file is no longer empty
-                    break
-            time.sleep(10)
+        records, size = getKtserverStats(dbElem)
+        fileStore.logToMaster("At end of %s phase, the DB has %d records in %d bytes" % (self.phaseName, records, size))
+        if self.cactusWorkflowArguments.primaryDbRunning:
+            # Save the DB as it is at the end of the phase, for the next
+            # checkpoint to start from, and carry on with it
+            snapshotID = fileStore.jobStore.getEmptyFileStoreID()
+            saveKtserver(dbElem, fileStore.jobStore, snapshotID)
+        else:
+            snapshotID = self.cactusWorkflowArguments.snapshotID
+            # Send the terminate message
+            stopKtserver(dbElem)
+            # Wait for the file to appear in the right place. This may take a while
+            while True:
+                with fileStore.readGlobalFileStream(snapshotID) as f:
+                    if f.read(1) != b'':
+                        # The file is no longer empty
+                        break
+                time.sleep(10)
         # We have the file now
         intermediateResultsUrl = getattr(self.cactusWorkflowArguments, 'intermediateResultsUrl', None)
         if intermediateResultsUrl is not None:
-            # The user requested to keep the DB dumps in a separate place. Export it there.
+            # The user requested to keep the DB dumps in a separate place. Export it there,
+            # as a whole snapshot rather than its manifest. It is only compressed if ktserver
+            # compressed it, when the DB was loaded from a whole lzo snapshot.
             url = intermediateResultsUrl + "-dump-" + self.phaseName
-            fileStore.exportFile(self.cactusWorkflowArguments.snapshotID, url)
-        return self.cactusWorkflowArguments.snapshotID
+            snapshotPath = fileStore.getLocalTempFile()
+            restoreSnapshot(fileStore.jobStore, snapshotID, snapshotPath)
+            fileStore.exportFile(fileStore.writeGlobalFile(snapshotPath), url)
+        return snapshotID
+
+def escalateMemoryOnOOM(run):
+    """Decorates the run method of a CactusRecursionJob so that if one of
+    its commands is killed for running out of memory, the job is rerun as a
+    follow-on with geometrically more memory, rather than retried by Toil
+    with the same memory. The escalation is recorded, and later jobs of the
+    same class with similar features are made with the memory needed.
+
+    Only for jobs that add no children or follow-ons before their commands
+    are done.
+    """
+    @functools.wraps(run)
+    def escalatingRun(self, fileStore):
+        try:
+            return run(self, fileStore)
+        except CactusOOMError as e:
+            memory = min(int(self.memory * self.getOptionalJobAttrib("memoryEscalation", float, default=2.0)),
+                         self.getMaxEscalatedMemory())
+            if memory <= self.memory:
+                # Leave it to Toil's retries
+                raise
+            jobName = self.__class__.__name__
+            value = self.getFeatures()[self.feature]
+            fileStore.logToMaster("%s with %s=%s ran out of its %i bytes of memory, rerunning it with %i: %s" % (
+                jobName, self.feature, value, self.memory, memory, e))
+            recordMemoryEscalation(jobName, self.feature, value, memory)
+            return self.makeFollowOnWithMemory(memory)
+    escalatingRun.escalatesMemory = True
+    return escalatingRun
 
 class CactusRecursionJob(CactusJob):
     """Base recursive job for traversals up and down the cactus tree.
@@ -323,7 +443,7 @@ class CactusRecursionJob(CactusJob):
     featuresFn = flowerFeatures
     feature = 'flowerGroupSize'
     maxSequenceSizeOfFlowerGroupingDefault = 1000000
-    def __init__(self, phaseNode, constantsNode, cactusDiskDatabaseString, flowerNames, flowerSizes, overlarge=False, precomputedAlignmentIDs=None, checkpoint = False, cactusWorkflowArguments=None, preemptable=True, memPoly=None):
+    def __init__(self, phaseNode, constantsNode, cactusDiskDatabaseString, flowerNames, flowerSizes, overlarge=False, precomputedAlignmentIDs=None, checkpoint = False, cactusWorkflowArguments=None, preemptable=True, memPoly=None, memory=None):
         self.cactusDiskDatabaseString = cactusDiskDatabaseString
         self.flowerNames = flowerNames
         self.flowerSizes = flowerSizes
@@ -335,7 +455,37 @@ class CactusRecursionJob(CactusJob):
         self.precomputedAlignmentIDs = precomputedAlignmentIDs
 
         CactusJob.__init__(self, phaseNode=phaseNode, constantsNode=constantsNode, overlarge=overlarge,
-                           checkpoint=checkpoint, preemptable=preemptable)
+                           checkpoint=checkpoint, preemptable=preemptable, memory=memory)
+
+    def getMaxEscalatedMemory(self):
+        """Gets the most memory escalateMemoryOnOOM will rerun the job with:
+        the maxEscalatedMemory of the job's node, or of its class, or else
+        its memoryCap.
+        """
+        default = getattr(self, 'maxEscalatedMemory', getattr(self, 'memoryCap', None))
+        if default is None:
+            default = self.getOptionalJobAttrib("overlargeMemory", typeFn=int,
+                                                default=getOptionalAttrib(self.constantsNode, "defaultOverlargeMemory", int, default=sys.maxsize))
+        return int(self.getOptionalJobAttrib("maxEscalatedMemory", typeFn=float, default=default))
+
+    def getEscalatedMemory(self):
+        """Gets the memory that jobs of this class with similar features had
+        to be rerun with (see escalateMemoryOnOOM), up to the most they can
+        have, or 0 if there are none.
+        """
+        memory = escalatedMemory(self.__class__.__name__, self.feature, self.getFeatures()[self.feature])
+        return min(memory, self.getMaxEscalatedMemory()) if memory is not None else 0
+
+    def makeFollowOnWithMemory(self, memory):
+        """Sets the followon to a copy of this job with the given memory.
+        """
+        return self.addFollowOn(self.__class__(phaseNode=self.phaseNode, constantsNode=self.constantsNode,
+                                               cactusDiskDatabaseString=self.cactusDiskDatabaseString,
+                                               flowerNames=self.flowerNames, flowerSizes=self.flowerSizes,
+                                               overlarge=self.overlarge,
+                                               precomputedAlignmentIDs=self.precomputedAlignmentIDs,
+                                               cactusWorkflowArguments=self.cactusWorkflowArguments,
+                                               memory=memory)).rv()
 
     def makeFollowOnRecursiveJob(self, job, phaseNode=None):
         """Sets the followon to the given recursive job
@@ -404,7 +554,7 @@ class CactusRecursionJob(CactusJob):
             job = self.__class__
         jobNode = getJobNode(self.phaseNode, job)
         flowersAndSizes=runCactusGetFlowers(cactusDiskDatabaseString=self.cactusDiskDatabaseString,
-                                            features=self.featuresFn(),
+                                            features=self.getFeatures(),
                                             jobName=job.__name__,
                                             fileStore=fileStore,
                                             flowerNames=self.flowerNames,
@@ -422,7 +572,7 @@ class CactusRecursionJob(CactusJob):
 
         jobNode = getJobNode(self.phaseNode, job)
         flowersAndSizes=runCactusExtendFlowers(cactusDiskDatabaseString=self.cactusDiskDatabaseString,
-                                              features=self.featuresFn(),
+                                              features=self.getFeatures(),
                                               jobName=job.__name__,
                                               fileStore=fileStore,
                                               flowerNames=self.flowerNames,
@@ -523,12 +673,20 @@ class CactusTrimmingBlastPhase(CactusPhasesJob):
         print((exp.getRootGenome()))
         print(ingroupsAndOriginalIDs)
         print(outgroupsAndOriginalIDs)
-        sequences = [fileStore.readGlobalFile(id) for id in map(itemgetter(1), ingroupsAndOriginalIDs + outgroupsAndOriginalIDs)]
-        self.cactusWorkflowArguments.totalSequenceSize = sum(os.stat(x).st_size for x in sequences)
+        sequenceIDs = list(map(itemgetter(1), ingroupsAndOriginalIDs + outgroupsAndOriginalIDs))
+        sequences = [fileStore.readGlobalFile(id) for id in sequenceIDs]
+        sequenceStats = [getFastaStats(fileStore, id, self.cactusWorkflowArguments.sequenceStatsIDMap, path)
+                         for id, path in zip(sequenceIDs, sequences)]
+        self.cactusWorkflowArguments.totalSequenceSize = sum(stats.totalLength for stats in sequenceStats)
 
         renamedInputSeqDir = fileStore.getLocalTempDir()
         uniqueFas = prependUniqueIDs(sequences, renamedInputSeqDir)
         uniqueFaIDs = [fileStore.writeGlobalFile(seq, cleanup=True) for seq in uniqueFas]
+        # The lengths of the uniquified sequences, so that the trimming
+        # doesn't have to scan them again (see prependUniqueIDs for the headers)
+        seqLengthsCache = dict((str(uniqueFaID), dict(("id=%d|%s" % (uniqueID, header), length)
+                                                      for header, length in stats.seqLengths.items()))
+                               for uniqueID, (uniqueFaID, stats) in enumerate(zip(uniqueFaIDs, sequenceStats)))
 
         # Set the uniquified IDs for the ingroups and outgroups
         ingroupsAndNewIDs = list(zip(list(map(itemgetter(0), ingroupsAndOriginalIDs)), uniqueFaIDs[:len(ingroupsAndOriginalIDs)]))
@@ -546,6 +704,9 @@ class CactusTrimmingBlastPhase(CactusPhasesJob):
                          overlapSize=getOptionalAttrib(cafNode, "overlapSize", int),
                          lastzArguments=getOptionalAttrib(cafNode, "lastzArguments"),
                          compressFiles=getOptionalAttrib(cafNode, "compressFiles", bool),
+                         compressionCodec=getOptionalAttrib(cafNode, "compressionCodec", str, "gzip"),
+                         virtualChunks=getOptionalAttrib(cafNode, "virtualChunks", bool, False),
+                         childBatchSize=getOptionalAttrib(cafNode, "lastzJobBatchSize", int, 0),
                          realign=getOptionalAttrib(cafNode, "realign", bool),
                          realignArguments=getOptionalAttrib(cafNode, "realignArguments"),
                          memory=getOptionalAttrib(cafNode, "lastzMemory", int, sys.maxsize),
@@ -559,9 +720,15 @@ class CactusTrimmingBlastPhase(CactusPhasesJob):
                          trimOutgroupFlanking=self.getOptionalPhaseAttrib("trimOutgroupFlanking", int, 100),
                          trimOutgroupDepth=self.getOptionalPhaseAttrib("trimOutgroupDepth", int, 1),
                          keepParalogs=self.getOptionalPhaseAttrib("keepParalogs", bool, False),
+                         trimCores=self.getOptionalPhaseAttrib("trimCores", int, 1),
+                         packSize=getOptionalAttrib(cafNode, "lastzPackSize", int, 0),
+                         packCores=getOptionalAttrib(cafNode, "lastzPackCores", int, 1),
+                         sortResults=getOptionalAttrib(cafNode, "runMapQFiltering", bool, False) and \
+                                     getOptionalAttrib(cafNode, "sortBlastResults", bool, False),
                          gpuLastz=getOptionalAttrib(cafNode, "gpuLastz", bool, False)),
             list(map(itemgetter(0), ingroupsAndNewIDs)), list(map(itemgetter(1), ingroupsAndNewIDs)),
-            list(map(itemgetter(0), outgroupsAndNewIDs)), list(map(itemgetter(1), outgroupsAndNewIDs))))
+            list(map(itemgetter(0), outgroupsAndNewIDs)), list(map(itemgetter(1), outgroupsAndNewIDs)),
+            seqLengthsCache=seqLengthsCache))
         
         # Alignment post processing to filter alignments
         if getOptionalAttrib(cafNode, "runMapQFiltering", bool, False):
@@ -577,6 +744,8 @@ class CactusTrimmingBlastPhase(CactusPhasesJob):
                                                 maxAlignmentsPerSite=maxAlignmentsPerSite,
                                                 alpha=alpha,
                                                 logLevel=getLogLevelString(),
+                                                sortedInput=getOptionalAttrib(cafNode, "sortBlastResults", bool, False),
+                                                bucketSize=getOptionalAttrib(cafNode, "mapQBucketSize", int, 0),
                                                 preemptable=True)
             self.cactusWorkflowArguments.alignmentsID = mapQJob.rv(0)
             self.cactusWorkflowArguments.secondaryAlignmentsID = mapQJob.rv(1)
@@ -629,6 +798,9 @@ def getLongestPath(node, distance=0.0):
 class CactusSetupCheckpoint(CactusCheckpointJob):
     """Start a new DB, run the setup and CAF phases, save the DB, then launch the BAR checkpoint."""
     def run(self, fileStore):
+        persistentRun = self.runWithPersistentPrimaryDB()
+        if persistentRun is not None:
+            return persistentRun
         ktServerDump = self.runPhaseWithPrimaryDB(CactusSetupPhase).rv()
         return self.makeFollowOnCheckpointJob(CactusBarCheckpoint, "bar", ktServerDump=ktServerDump)
 
@@ -672,7 +844,7 @@ def inverseJukesCantor(d):
     return 0.75 * (1 - math.exp(-d * 4.0/3.0))
 
 class CactusCafPhase(CactusPhasesJob):
-    memoryPoly = [2.51087392e+00, 4.49616219e+08]
+    memoryPoly = [2.55272182e+00, 4.49616219e+08]
 
     def __init__(self, **kwargs):
         # Ensure non-preemptability, since this job takes a long time
@@ -748,7 +920,7 @@ class CactusCafWrapper(CactusRecursionJob):
         if debugFilePath != None:
             debugFilePath += exp.getRootGenome()
         messages = runCactusCaf(cactusDiskDatabaseString=self.cactusDiskDatabaseString,
-                          features=self.featuresFn(),
+                          features=self.getFeatures(),
                           fileStore=fileStore,
                           jobName=self.__class__.__name__,
                           alignments=alignmentFile,
@@ -800,6 +972,7 @@ class CactusCafWrapper(CactusRecursionJob):
         for message in messages:
             logger.info(message)
 
+    @escalateMemoryOnOOM
     def run(self, fileStore):
         alignments = fileStore.readGlobalFile(self.cactusWorkflowArguments.alignmentsID)
         logger.info("Alignments file: %s" % alignments)
@@ -881,9 +1054,11 @@ class CactusBarWrapper(CactusRecursionJob):
     """Runs the BAR algorithm implementation.
     """
     memoryPoly = [2.81473430e-01, 2.96245523e+09]
+    maxEscalatedMemory = 40e09
 
+    @escalateMemoryOnOOM
     def run(self, fileStore):
-        messages = runBarForJob(self, features=self.featuresFn(), fileStore=fileStore)
+        messages = runBarForJob(self, features=self.getFeatures(), fileStore=fileStore)
         for message in messages:
             fileStore.logToMaster(message)
 
@@ -900,7 +1075,7 @@ class CactusBarWrapperLarge(CactusRecursionJob):
         endsToAlign = []
         endSizes = []
         precomputedAlignmentIDs = []
-        for line in runBarForJob(self, features=self.featuresFn(),
+        for line in runBarForJob(self, features=self.getFeatures(),
                                  fileStore=fileStore, calculateWhichEndsToComputeSeparately=True):
             endToAlign, sequencesInEndAlignment, basesInEndAlignment = line.split()
             sequencesInEndAlignment = int(sequencesInEndAlignment)
@@ -968,7 +1143,7 @@ class CactusBarEndAlignerWrapper(CactusRecursionJob):
         self.endsToAlign.sort()
         self.flowerNames = encodeFlowerNames((decodeFirstFlowerName(self.flowerNames),) + tuple(self.endsToAlign)) #The ends to align become like extra flower names
         alignmentFile = fileStore.getLocalTempFile()
-        messages = runBarForJob(self, features=self.featuresFn(),
+        messages = runBarForJob(self, features=self.getFeatures(),
                                 fileStore=fileStore,
                                 endAlignmentsToPrecomputeOutputFile=alignmentFile)
         for message in messages:
@@ -984,7 +1159,7 @@ class CactusBarWrapperWithPrecomputedEndAlignments(CactusRecursionJob):
     def run(self, fileStore):
         if self.precomputedAlignmentIDs:
             precomputedAlignments = [readGlobalFileWithoutCache(fileStore, fileID) for fileID in self.precomputedAlignmentIDs]
-            messages = runBarForJob(self, features=self.featuresFn(),
+            messages = runBarForJob(self, features=self.getFeatures(),
                                     fileStore=fileStore,
                                     precomputedAlignments=precomputedAlignments)
         else:
@@ -1114,7 +1289,7 @@ class CactusReferenceWrapper(CactusRecursionJob):
         exp = self.cactusWorkflowArguments.experimentWrapper
         runCactusReference(fileStore=fileStore,
                        jobName=self.__class__.__name__,
-                       features=self.featuresFn(),
+                       features=self.getFeatures(),
                        cactusDiskDatabaseString=self.cactusDiskDatabaseString,
                        flowerNames=self.flowerNames,
                        matchingAlgorithm=self.getOptionalPhaseAttrib("matchingAlgorithm"),
@@ -1152,7 +1327,7 @@ class CactusSetReferenceCoordinatesUpWrapper(CactusRecursionJob):
     def run(self, fileStore):
         exp = self.cactusWorkflowArguments.experimentWrapper
         runCactusAddReferenceCoordinates(fileStore=fileStore, jobName=self.__class__.__name__,
-                                         features=self.featuresFn(),
+                                         features=self.getFeatures(),
                                          cactusDiskDatabaseString=self.cactusDiskDatabaseString,
                                          secondaryDatabaseString=self.getOptionalPhaseAttrib("secondaryDatabaseString"),
                                          flowerNames=self.flowerNames,
@@ -1192,7 +1367,7 @@ class CactusSetReferenceCoordinatesDownWrapper(CactusRecursionJob):
 
     def run(self, fileStore):
         exp = self.cactusWorkflowArguments.experimentWrapper
-        runCactusAddReferenceCoordinates(fileStore=fileStore, features=self.featuresFn(),
+        runCactusAddReferenceCoordinates(fileStore=fileStore, features=self.getFeatures(),
                                          jobName=self.__class__.__name__,
                                          cactusDiskDatabaseString=self.cactusDiskDatabaseString,
                                          flowerNames=self.flowerNames,
@@ -1201,7 +1376,7 @@ class CactusSetReferenceCoordinatesDownWrapper(CactusRecursionJob):
                                          bottomUpPhase=False)
 
 class CactusExtractReferencePhase(CactusPhasesJob):
-    memoryPoly = [2.24519561e+00, 4.70479486e+08]
+    memoryPoly = [2.28261554e+00, 4.70479486e+08]
 
     def run(self, fileStore):
         experiment = ExperimentWrapper(self.cactusWorkflowArguments.experimentNode)
@@ -1289,7 +1464,7 @@ class CactusHalGeneratorPhase3(CactusPhasesJob):
         return self.cactusWorkflowArguments.experimentWrapper
 
 class CactusFastaGenerator(CactusRecursionJob):
-    memoryPoly = [2.99160856e+00, 4.48507512e+08]
+    memoryPoly = [3.04146870e+00, 4.48507512e+08]
     feature = 'totalSequenceSize'
 
     def run(self, fileStore):
@@ -1329,7 +1504,7 @@ class CactusHalGeneratorUpWrapper(CactusRecursionJob):
         else:
             tmpHal = None
         runCactusHalGenerator(jobName=self.__class__.__name__,
-                              features=self.featuresFn(),
+                              features=self.getFeatures(),
                               fileStore=fileStore,
                               cactusDiskDatabaseString=self.cactusDiskDatabaseString,
                               secondaryDatabaseString=self.getOptionalPhaseAttrib("secondaryDatabaseString"),
@@ -1366,7 +1541,7 @@ class CactusHalGeneratorPhaseCleanup(CactusPhasesJob):
 class CactusWorkflowArguments:
     """Object for representing a cactus workflow's arguments
     """
-    def __init__(self, options, experimentFile, configNode, seqIDMap):
+    def __init__(self, options, experimentFile, configNode, seqIDMap, seqStatsIDMap=None):
         #Get a local copy of the experiment file
         self.experimentFile = experimentFile
         self.experimentNode = ET.parse(self.experimentFile).getroot()
@@ -1376,6 +1551,8 @@ class CactusWorkflowArguments:
         for genome, seqID in list(seqIDMap.items()):
             print(('setting this', genome, seqID))
             self.experimentWrapper.setSequenceID(genome, seqID)
+        #str(sequence ID) -> ID of its FastaStats sidecar, where known
+        self.sequenceStatsIDMap = seqStatsIDMap if seqStatsIDMap is not None else {}
         #Get the database string
         self.cactusDiskDatabaseString = ET.tostring(self.experimentNode.find("cactus_disk").find("st_kv_database_conf"), encoding='unicode').replace('\n', '')
         #Get the species tree
@@ -1412,6 +1589,17 @@ class CactusWorkflowArguments:
         #Now build the remaining options from the arguments
         findRequiredNode(self.configNode, "avg").attrib["buildAvgs"] = "1" if options.buildAvgs else "0"
 
+        # Whether to keep the primary DB running through all the checkpoints
+        persistentPrimaryDb = self.configWrapper.getKtserverPersistentPrimaryDb()
+        if persistentPrimaryDb == "auto":
+            # The DB never has to move between nodes, and its dumps aren't wanted
+            self.persistentPrimaryDb = getattr(options, "batchSystem", None) == "singleMachine" and \
+                                       self.intermediateResultsUrl is None
+        else:
+            self.persistentPrimaryDb = persistentPrimaryDb.lower() in ("1", "true")
+        # Set when the persistent primary DB has been started
+        self.primaryDbRunning = False
+
 def addCactusWorkflowOptions(parser):
     parser.add_argument("--experiment", dest="experimentFile",
                       help="The file containing a link to the experiment parameters")
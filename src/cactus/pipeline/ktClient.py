@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""
+A minimal client for the HTTP RPC protocol of Kyoto Tycoon, so that
+flags and stats can be read from and written to a ktserver without
+running ktremotemgr (a whole container launch in docker mode).
+"""
+
+import base64
+import http.client
+from urllib.parse import unquote_to_bytes
+import quopri
+
+class KtError(RuntimeError):
+    """Raised when ktserver can't be reached or reports an error."""
+    pass
+
+def encodeTsv(columns):
+    """Encode a mapping of str or bytes to a base64-encoded TSV body."""
+    lines = []
+    for name, value in columns.items():
+        if isinstance(name, str):
+            name = name.encode()
+        if isinstance(value, str):
+            value = value.encode()
+        lines.append(base64.b64encode(name) + b"\t" + base64.b64encode(value))
+    return b"\n".join(lines) + b"\n"
+
+def decodeTsv(body, contentType):
+    """Decode a TSV body, in the column encoding named by its content type,
+    into a dict of bytes to bytes."""
+    decode = lambda column: column
+    for parameter in (contentType or "").split(";"):
+        parameter = parameter.strip()
+        if parameter.startswith("colenc="):
+            decode = { "B": base64.b64decode,
+                       "U": unquote_to_bytes,
+                       "Q": quopri.decodestring }[parameter[len("colenc="):]]
+    columns = {}
+    for line in body.split(b"\n"):
+        if b"\t" in line:
+            name, value = line.split(b"\t", 1)
+            columns[decode(name)] = decode(value)
+    return columns
+
+class KtClient(object):
+    """Client for one ktserver. Keys and values can be given as str or
+    bytes; values are returned as bytes."""
+    def __init__(self, host, port, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    @classmethod
+    def fromDbElem(cls, dbElem, timeout=30):
+        return cls(dbElem.getDbHost() or 'localhost', dbElem.getDbPort(), timeout=timeout)
+
+    def call(self, procedure, columns=None):
+        """Call an RPC procedure, returning its HTTP status and its output
+        columns."""
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request("POST", "/rpc/" + procedure, body=encodeTsv(columns or {}),
+                               headers={ "Content-Type": "text/tab-separated-values; colenc=B" })
+            response = connection.getresponse()
+            output = decodeTsv(response.read(), response.getheader("Content-Type"))
+        except (OSError, http.client.HTTPException) as e:
+            raise KtError("Can't reach ktserver at %s:%s: %s" % (self.host, self.port, e))
+        finally:
+            connection.close()
+        if response.status not in (200, 450):
+            raise KtError("ktserver %s failed with status %d: %s" % (
+                procedure, response.status, output.get(b"ERROR", b"").decode(errors='replace')))
+        return response.status, output
+
+    def get(self, key):
+        """Get the value of a key, or None if there isn't one."""
+        status, output = self.call("get", { "key": key })
+        # 450 means there is no such record
+        return output[b"value"] if status == 200 else None
+
+    def set(self, key, value):
+        self.call("set", { "key": key, "value": value })
+
+    def remove(self, key):
+        """Remove a key, returning False if there wasn't one."""
+        status, output = self.call("remove", { "key": key })
+        return status == 200
+
+    def status(self):
+        """Get the status of the DB, including its record count and size."""
+        return self._stringMap(self.call("status")[1])
+
+    def report(self):
+        """Get the report of the server, including its connection and
+        operation counts."""
+        return self._stringMap(self.call("report")[1])
+
+    def _stringMap(self, output):
+        return dict((name.decode(errors='replace'), value.decode(errors='replace'))
+                    for name, value in output.items())
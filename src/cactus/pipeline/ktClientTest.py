@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+"""Tests the Kyoto Tycoon client against a stand-in for ktserver's RPC
+interface.
+"""
+
+import unittest
+import socket
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from sonLib.bioio import TestStatus
+from cactus.pipeline.ktClient import KtClient, KtError, encodeTsv, decodeTsv
+
+class FakeKtHandler(BaseHTTPRequestHandler):
+    """Implements get, set, remove and status on a dict, answering in URL
+    encoding to check that the client decodes what it is told to."""
+    def do_POST(self):
+        columns = decodeTsv(self.rfile.read(int(self.headers["Content-Length"])), self.headers["Content-Type"])
+        records = self.server.records
+        procedure = self.path[len("/rpc/"):]
+        status, output = 200, {}
+        if procedure == "get":
+            if columns[b"key"] in records:
+                output[b"value"] = records[columns[b"key"]]
+            else:
+                status, output = 450, {b"ERROR": b"DB: 7: no record"}
+        elif procedure == "set":
+            records[columns[b"key"]] = columns[b"value"]
+        elif procedure == "remove":
+            if records.pop(columns[b"key"], None) is None:
+                status, output = 450, {b"ERROR": b"DB: 7: no record"}
+        elif procedure == "status":
+            output = {b"count": str(len(records)).encode(), b"size": str(sum(map(len, records.values()))).encode()}
+        else:
+            status, output = 501, {b"ERROR": b"not implemented"}
+        body = b"".join(b"%s\t%s\n" % (name, b"".join(b"%%%02X" % c for c in value))
+                        for name, value in output.items())
+        self.send_response(status)
+        self.send_header("Content-Type", "text/tab-separated-values; colenc=U")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = HTTPServer(("127.0.0.1", 0), FakeKtHandler)
+        self.server.records = {}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = KtClient("127.0.0.1", self.server.server_address[1])
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    @TestStatus.shortLength
+    def testTsv(self):
+        columns = {b"key\t\n": b"\x00\xff value"}
+        self.assertEqual(decodeTsv(encodeTsv(columns), "text/tab-separated-values; colenc=B"), columns)
+        self.assertEqual(decodeTsv(b"a\tb\nc\td\n", "text/tab-separated-values"), {b"a": b"b", b"c": b"d"})
+
+    @TestStatus.shortLength
+    def testClient(self):
+        self.assertEqual(self.client.get("TERMINATE"), None)
+        self.assertFalse(self.client.remove("TERMINATE"))
+        self.client.set("TERMINATE", "1")
+        self.client.set(b"binary\tkey", b"\x00\x01\n")
+        self.assertEqual(self.client.get("TERMINATE"), b"1")
+        self.assertEqual(self.client.get(b"binary\tkey"), b"\x00\x01\n")
+        self.assertEqual(self.client.status(), {"count": "2", "size": "4"})
+        self.assertTrue(self.client.remove("TERMINATE"))
+        self.assertEqual(self.client.get("TERMINATE"), None)
+        with self.assertRaises(KtError):
+            self.client.report()
+
+    @TestStatus.shortLength
+    def testUnreachable(self):
+        # A port nothing listens on
+        with socket.socket() as unused:
+            unused.bind(("127.0.0.1", 0))
+            port = unused.getsockname()[1]
+        with self.assertRaises(KtError):
+            KtClient("127.0.0.1", port, timeout=5).get("TERMINATE")
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""
+Snapshots of a ktserver DB, kept in the job store as compressed chunks
+addressed by their content. Saving the DB at the end of a checkpoint
+phase only uploads the chunks that changed since it was loaded, and
+loading it streams the chunks into place in parallel.
+
+Chunk boundaries are defined by the content: a chunk ends after a byte
+where a rolling hash of the bytes before it has its top bits clear, so
+records inserted or removed in the middle of the snapshot only change
+the chunks around them, rather than shifting every chunk after them.
+
+The snapshot's own file in the job store holds a manifest: the codec
+and size of the snapshot, the compression ktserver itself applied to the
+snapshot (if any), and the SHA-256, length and file ID of each chunk, in
+order.
+"""
+
+import os
+import json
+import math
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from cactus.shared.compression import getCodec
+
+MANIFEST_HEADER = b"cactus ktserver snapshot manifest\n"
+
+# The average size of chunks. They are at least a quarter and at most four
+# times as large.
+SNAPSHOT_CHUNK_SIZE = 64 * 1024 * 1024
+
+# The rolling hash of a byte is the sum of random values for it and the
+# bytes before it in a window of this many bytes
+CHUNK_HASH_WINDOW = 64
+CHUNK_HASH_VALUES = numpy.array([int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'little')
+                                 for i in range(256)], dtype=numpy.uint32)
+# Bytes hashed at once, in each thread
+CHUNK_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Chunks compressed or decompressed at once. The compression libraries
+# release the GIL, so threads are enough.
+SNAPSHOT_TRANSFER_THREADS = 4
+
+def readManifest(jobStore, snapshotID):
+    """Get the manifest of a snapshot, or None if the file is not a
+    manifest (a whole snapshot saved before snapshots were chunked)."""
+    with jobStore.readFileStream(snapshotID) as f:
+        if f.read(len(MANIFEST_HEADER)) != MANIFEST_HEADER:
+            return None
+        return json.loads(f.read().decode())
+
+def chunkBoundaryCandidates(fd, size, bits, threads=SNAPSHOT_TRANSFER_THREADS):
+    """Get the offsets in the file just after the bytes whose rolling hash
+    has its top bits clear, in order."""
+    def blockCandidates(blockStart):
+        # Along with the end of the previous block, for the windows that overlap both
+        start = max(0, blockStart - CHUNK_HASH_WINDOW)
+        block = os.pread(fd, blockStart + CHUNK_HASH_BLOCK_SIZE - start, start)
+        # Sums wrap around, which leaves the windowed sums right
+        sums = numpy.cumsum(numpy.take(CHUNK_HASH_VALUES, numpy.frombuffer(block, dtype=numpy.uint8)),
+                            dtype=numpy.uint32)
+        hashes = sums[CHUNK_HASH_WINDOW:] - sums[:-CHUNK_HASH_WINDOW]
+        ends = numpy.flatnonzero(hashes < (1 << (32 - bits)))
+        return (ends + (start + CHUNK_HASH_WINDOW + 1)).tolist()
+
+    with ThreadPool(threads) as pool:
+        return [candidate for candidates in pool.map(blockCandidates, range(0, size, CHUNK_HASH_BLOCK_SIZE))
+                for candidate in candidates]
+
+def chunkSnapshot(fd, size, chunkSize=SNAPSHOT_CHUNK_SIZE, threads=SNAPSHOT_TRANSFER_THREADS):
+    """Split the file into content-defined chunks of chunkSize bytes on
+    average, returning the offset and length of each."""
+    minSize = max(chunkSize // 4, CHUNK_HASH_WINDOW)
+    maxSize = chunkSize * 4
+    bits = max(1, round(math.log2(max(chunkSize - minSize, 2))))
+    chunks = []
+    start = 0
+    for end in chunkBoundaryCandidates(fd, size, bits, threads) + [size]:
+        while end - start > maxSize:
+            chunks.append((start, maxSize))
+            start += maxSize
+        if end - start >= minSize or (end == size and end > start):
+            chunks.append((start, end - start))
+            start = end
+    return chunks
+
+def saveSnapshot(jobStore, snapshotPath, snapshotID, codecName, baseManifest=None, compression=None,
+                 chunkSize=SNAPSHOT_CHUNK_SIZE, threads=SNAPSHOT_TRANSFER_THREADS):
+    """Save a snapshot file to the (existing) job store file snapshotID.
+    Chunks with the same content as a chunk of baseManifest, the manifest
+    of the snapshot the DB was loaded from, are not uploaded again.
+    compression is the compression ktserver was told to apply to the
+    snapshot (its -bgsc option), which has to be given to the ktserver
+    that loads it.
+
+    Returns the manifest, and the number of chunks that were uploaded."""
+    codec = getCodec(codecName)
+    knownChunks = {}
+    if baseManifest is not None and baseManifest["codec"] == codec.name:
+        knownChunks = dict((chunk["sha256"], chunk) for chunk in baseManifest["chunks"])
+    size = os.path.getsize(snapshotPath)
+    fd = os.open(snapshotPath, os.O_RDONLY)
+
+    def saveChunk(args):
+        offset, length = args
+        data = os.pread(fd, length, offset)
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in knownChunks:
+            return knownChunks[digest], False
+        with jobStore.writeFileStream() as (f, fileID):
+            f.write(codec.compress(data))
+        return { "sha256": digest, "length": len(data), "fileID": fileID }, True
+
+    try:
+        with ThreadPool(threads) as pool:
+            chunks = pool.map(saveChunk, chunkSnapshot(fd, size, chunkSize, threads), chunksize=1)
+    finally:
+        os.close(fd)
+
+    manifest = { "codec": codec.name,
+                 "compression": compression,
+                 "size": size,
+                 "chunks": [chunk for chunk, uploaded in chunks] }
+    # Written last, as the file becoming non-empty means the snapshot is saved
+    with jobStore.updateFileStream(snapshotID) as f:
+        f.write(MANIFEST_HEADER + json.dumps(manifest).encode())
+    return manifest, sum(uploaded for chunk, uploaded in chunks)
+
+def restoreSnapshot(jobStore, snapshotID, snapshotPath, threads=SNAPSHOT_TRANSFER_THREADS):
+    """Write the snapshot saved in snapshotID to snapshotPath, returning
+    its manifest (or None if it wasn't chunked)."""
+    manifest = readManifest(jobStore, snapshotID)
+    if manifest is None:
+        jobStore.readFile(snapshotID, snapshotPath)
+        return None
+    codec = getCodec(manifest["codec"])
+    offsets = []
+    offset = 0
+    for chunk in manifest["chunks"]:
+        offsets.append(offset)
+        offset += chunk["length"]
+    assert offset == manifest["size"]
+
+    def restoreChunk(args):
+        chunk, offset = args
+        with jobStore.readFileStream(chunk["fileID"]) as f:
+            data = codec.decompress(f.read())
+        if len(data) != chunk["length"] or hashlib.sha256(data).hexdigest() != chunk["sha256"]:
+            raise RuntimeError("Chunk %s of snapshot %s is corrupt" % (chunk["fileID"], snapshotID))
+        os.pwrite(fd, data, offset)
+
+    fd = os.open(snapshotPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, manifest["size"])
+        with ThreadPool(threads) as pool:
+            pool.map(restoreChunk, list(zip(manifest["chunks"], offsets)), chunksize=1)
+    finally:
+        os.close(fd)
+    return manifest
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+"""Tests saving ktserver snapshots to the job store in chunks.
+"""
+
+import unittest
+import os
+import io
+import shutil
+import random
+import threading
+from contextlib import contextmanager
+from sonLib.bioio import TestStatus
+from sonLib.bioio import getTempDirectory
+from cactus.shared.compression import availableCodecs
+from cactus.pipeline.ktSnapshot import saveSnapshot, restoreSnapshot, readManifest
+
+class MemoryJobStore(object):
+    """The parts of the job store API used by snapshots, in memory."""
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def getEmptyFileStoreID(self):
+        with self.lock:
+            fileID = "file%d" % len(self.files)
+            self.files[fileID] = b""
+        return fileID
+
+    @contextmanager
+    def writeFileStream(self):
+        fileID = self.getEmptyFileStoreID()
+        with self.updateFileStream(fileID) as f:
+            yield f, fileID
+
+    @contextmanager
+    def updateFileStream(self, fileID):
+        f = io.BytesIO()
+        yield f
+        self.files[fileID] = f.getvalue()
+
+    @contextmanager
+    def readFileStream(self, fileID):
+        yield io.BytesIO(self.files[fileID])
+
+    def readFile(self, fileID, localPath):
+        with open(localPath, 'wb') as f:
+            f.write(self.files[fileID])
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.jobStore = MemoryJobStore()
+        self.snapshotPath = os.path.join(self.tempDir, "snapshot")
+        self.restoredPath = os.path.join(self.tempDir, "restored")
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tempDir)
+
+    def writeSnapshot(self, data):
+        with open(self.snapshotPath, 'wb') as f:
+            f.write(data)
+
+    def assertRestores(self, snapshotID, data):
+        manifest = restoreSnapshot(self.jobStore, snapshotID, self.restoredPath, threads=3)
+        with open(self.restoredPath, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        return manifest
+
+    @TestStatus.shortLength
+    def testSaveAndRestore(self):
+        data = os.urandom(1000) + b"A" * 5000 + os.urandom(1234)
+        for codec in ["none"] + availableCodecs():
+            self.writeSnapshot(data)
+            snapshotID = self.jobStore.getEmptyFileStoreID()
+            manifest, uploaded = saveSnapshot(self.jobStore, self.snapshotPath, snapshotID, codec,
+                                              chunkSize=1000, threads=3)
+            self.assertEqual(manifest["size"], len(data))
+            self.assertEqual(manifest["compression"], None)
+            self.assertTrue(len(manifest["chunks"]) > 1)
+            self.assertTrue(all(250 <= chunk["length"] <= 4000 for chunk in manifest["chunks"][:-1]))
+            self.assertEqual(uploaded, len(manifest["chunks"]))
+            self.assertEqual(readManifest(self.jobStore, snapshotID), manifest)
+            self.assertRestores(snapshotID, data)
+
+        # Empty DBs have empty snapshots
+        self.writeSnapshot(b"")
+        snapshotID = self.jobStore.getEmptyFileStoreID()
+        self.assertEqual(saveSnapshot(self.jobStore, self.snapshotPath, snapshotID, "gzip")[1], 0)
+        self.assertRestores(snapshotID, b"")
+
+    @TestStatus.shortLength
+    def testOnlyChangedChunksUploaded(self):
+        rng = random.Random(1)
+        data = bytes(rng.getrandbits(8) for i in range(100000))
+        self.writeSnapshot(data)
+        firstID = self.jobStore.getEmptyFileStoreID()
+        saveSnapshot(self.jobStore, self.snapshotPath, firstID, "gzip", chunkSize=1000)
+        baseManifest = self.assertRestores(firstID, data)
+        self.assertTrue(len(baseManifest["chunks"]) > 50)
+
+        # The next phase inserts some records in the middle and adds some at
+        # the end. The chunks after the insertion are the same, just shifted.
+        data = data[:50000] + bytes(rng.getrandbits(8) for i in range(100)) + data[50000:] + b"A" * 500
+        self.writeSnapshot(data)
+        secondID = self.jobStore.getEmptyFileStoreID()
+        filesBefore = len(self.jobStore.files)
+        manifest, uploaded = saveSnapshot(self.jobStore, self.snapshotPath, secondID, "gzip",
+                                          baseManifest=baseManifest, chunkSize=1000)
+        self.assertTrue(uploaded <= 4)
+        self.assertEqual(len(self.jobStore.files), filesBefore + uploaded)
+        self.assertEqual(manifest["chunks"][0], baseManifest["chunks"][0])
+        reused = [chunk for chunk in manifest["chunks"] if chunk in baseManifest["chunks"]]
+        self.assertTrue(len(reused) >= len(manifest["chunks"]) - 4)
+        self.assertRestores(secondID, data)
+
+        # Chunks compressed with another codec can't be reused
+        thirdID = self.jobStore.getEmptyFileStoreID()
+        self.assertEqual(saveSnapshot(self.jobStore, self.snapshotPath, thirdID, "none",
+                                      baseManifest=manifest, chunkSize=1000)[1], len(manifest["chunks"]))
+
+    @TestStatus.shortLength
+    def testCompressionRecorded(self):
+        # Snapshots ktserver compressed itself say so, so they're loaded the same way
+        self.writeSnapshot(b"KC\nlzo snapshot")
+        snapshotID = self.jobStore.getEmptyFileStoreID()
+        manifest, uploaded = saveSnapshot(self.jobStore, self.snapshotPath, snapshotID, "gzip", compression="lzo")
+        self.assertEqual(self.assertRestores(snapshotID, b"KC\nlzo snapshot")["compression"], "lzo")
+
+    @TestStatus.shortLength
+    def testCorruptChunk(self):
+        self.writeSnapshot(os.urandom(3000))
+        snapshotID = self.jobStore.getEmptyFileStoreID()
+        manifest, uploaded = saveSnapshot(self.jobStore, self.snapshotPath, snapshotID, "none", chunkSize=1000)
+        self.jobStore.files[manifest["chunks"][-1]["fileID"]] = os.urandom(1000)
+        with self.assertRaises(RuntimeError):
+            restoreSnapshot(self.jobStore, snapshotID, self.restoredPath)
+
+    @TestStatus.shortLength
+    def testWholeSnapshot(self):
+        # Snapshots saved before they were chunked are read as they are
+        snapshotID = self.jobStore.getEmptyFileStoreID()
+        self.jobStore.files[snapshotID] = b"KC\nsnapshot"
+        self.assertEqual(self.assertRestores(snapshotID, b"KC\nsnapshot"), None)
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -4,78 +4,242 @@ Functions to launch and manage KyotoTycoon servers.
 """
 
 import os
+import fcntl
 import platform
-import random
+import queue
 import socket
 import signal
 import sys
+import tempfile
 import traceback
 from contextlib import closing
 from glob import glob
-from multiprocessing import Process, Queue
-from time import sleep
+from multiprocessing import Process, Queue, Event
+from time import sleep, time
 
 from toil.lib.bioio import logger
 from cactus.shared.common import cactus_call
+from cactus.shared.compression import getCodec
+from cactus.pipeline.ktClient import KtClient, KtError
+from cactus.pipeline.ktSnapshot import saveSnapshot, restoreSnapshot
 
 # For some reason ktserver believes there are only 32768 TCP ports.
+MIN_KTSERVER_PORT = 1025
 MAX_KTSERVER_PORT = 32767
 
+# How many ports to try if ktserver finds its port taken anyway (by
+# something that doesn't use the port registry)
+KTSERVER_START_ATTEMPTS = 3
+
 # The name of the snapshot that KT outputs.
 KTSERVER_SNAPSHOT_NAME = "00000000.ktss"
 
-def runKtserver(dbElem, fileStore, existingSnapshotID=None, snapshotExportID=None):
+# How often the babysitter checks for the TERMINATE flag set by other jobs
+# with stopKtserver. KtServerService.stop tells it directly, so this is
+# only a fallback, and is kept long to spare the DB the RPCs
+TERMINATE_CHECK_INTERVAL = 60
+
+# How often the babysitter of a persistent DB checks for the save and
+# reload requests of saveKtserver and reloadKtserver, which phases wait on
+REQUEST_CHECK_INTERVAL = 1
+
+# How long to wait for the babysitter of a ktserver that failed to start
+# to exit by itself
+BABYSITTER_EXIT_TIMEOUT = 10
+
+# Keys through which jobs ask the babysitter of a persistent DB to save or
+# reload a snapshot (see saveKtserver and reloadKtserver), and which mark
+# the snapshot the DB holds and whether a phase has started changing it.
+# None of them is 8 bytes long, the length of cactus's own keys.
+SAVE_SNAPSHOT_KEY = "SAVE_SNAPSHOT"
+RELOAD_SNAPSHOT_KEY = "RELOAD_SNAPSHOT"
+LOADED_SNAPSHOT_KEY = "LOADED_SNAPSHOT"
+PHASE_STARTED_KEY = "PHASE_STARTED"
+
+def runKtserver(dbElem, fileStore, existingSnapshotID=None, snapshotExportID=None, snapshotCodec="gzip",
+                persistent=False):
     """
     Run a KTServer. This function launches a separate python process that manages the server.
 
     Writing to the special key "TERMINATE" signals this thread to safely shut
     down the DB and save the results. After finishing, the data will
-    eventually be written to snapshotFile.
+    eventually be written to snapshotFile, as chunks compressed with
+    snapshotCodec (see cactus.pipeline.ktSnapshot).
+
+    A persistent DB instead saves snapshots when saveKtserver asks it to,
+    and reloads them when reloadKtserver does. snapshotExportID then holds
+    the ID of the last snapshot saved, and nothing is saved when it stops.
+
+    The port is reserved in the node's port registry (see reservePort)
+    first. If ktserver still can't bind it, another port is tried, up to
+    KTSERVER_START_ATTEMPTS times.
 
     Returns a tuple containing an updated version of the database config dbElem and the
     path to the log file.
     """
-    logPath = fileStore.getLocalTempFile()
+    # Fail before starting the DB if the codec can't be used
+    getCodec(snapshotCodec)
     dbElem.setDbHost(getHostName())
+    for attempt in range(1, KTSERVER_START_ATTEMPTS + 1):
+        port, portLock = reservePort()
+        dbElem.setDbPort(port)
+        logPath = fileStore.getLocalTempFile()
 
-    # Find a suitable port to run on.
-    try:
-        occupiedPorts = findOccupiedPorts()
-        unoccupiedPorts = set(range(1025,MAX_KTSERVER_PORT)) - occupiedPorts
-        port = random.choice(list(unoccupiedPorts))
-    except:
-        logger.warning("Can't find which ports are occupied--likely netstat is not installed."
-                       " Choosing a random port to start the DB on, good luck!")
-        port = random.randint(1025,MAX_KTSERVER_PORT)
-    dbElem.setDbPort(port)
+        process = ServerProcess(dbElem, logPath, fileStore, existingSnapshotID, snapshotExportID,
+                                snapshotCodec=snapshotCodec, persistent=persistent,
+                                portLock=portLock)
+        process.daemon = True
+        process.start()
 
-    process = ServerProcess(dbElem, logPath, fileStore, existingSnapshotID, snapshotExportID)
-    process.daemon = True
-    process.start()
+        if blockUntilKtserverIsRunning(logPath, host=dbElem.getDbHost(), port=port, process=process):
+            fileStore.logToMaster("Started ktserver on %s:%d (attempt %d)" % (dbElem.getDbHost(), port, attempt))
+            return process, dbElem, logPath
 
-    if not blockUntilKtserverIsRunning(logPath):
         try:
             with open(logPath) as f:
                 log = f.read()
         except:
             log = ''
-        raise RuntimeError("Unable to launch ktserver in time. Log: %s" % log)
+        # The babysitter exits by itself once it sees the failure; it
+        # releases the port as it goes
+        process.join(BABYSITTER_EXIT_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+            releasePort(portLock)
+        discardServerExceptions()
+        if not isPortCollision(log) or attempt == KTSERVER_START_ATTEMPTS:
+            raise RuntimeError("Unable to launch ktserver in time. Log: %s" % log)
+        logger.warning("Ktserver couldn't bind port %d, trying another one" % port)
+
+def getPortRegistryDir():
+    """The node-local directory of port reservations, shared by all users."""
+    registryDir = os.environ.get("CACTUS_KTSERVER_PORT_DIR",
+                                 os.path.join(tempfile.gettempdir(), "cactus_ktserver_ports"))
+    if not os.path.isdir(registryDir):
+        try:
+            os.mkdir(registryDir)
+            # Sticky and world-writable, like /tmp
+            os.chmod(registryDir, 0o1777)
+        except FileExistsError:
+            pass
+    return registryDir
+
+def isPortFree(port):
+    """Check if nothing is bound to a TCP port, by binding it ourselves. Ports
+    with only connections in TIME_WAIT left count as free, as ktserver uses
+    SO_REUSEADDR too."""
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(('', port))
+        except OSError:
+            return False
+    return True
 
-    return process, dbElem, logPath
+def isProcessAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Someone else's process
+        pass
+    return True
+
+def reservePort(registryDir=None, maxCandidates=1000):
+    """Find a free port for a ktserver and reserve it in the node's port
+    registry, so that no other DB started on this node takes it before
+    ktserver binds it.
+
+    A reservation is a lock file named after the port, holding the pid of
+    the process that made it. Reservations of processes that no longer
+    exist are taken over. The candidates are scanned in order from a port
+    determined by the pid, and are only taken if they can be bound.
+
+    Returns the port and its lock file, to be given to releasePort once
+    the server has stopped."""
+    registryDir = registryDir or getPortRegistryDir()
+    numPorts = MAX_KTSERVER_PORT - MIN_KTSERVER_PORT + 1
+    firstCandidate = (os.getpid() * 7919) % numPorts
+    # Opened read-only, as it may belong to another user
+    registryLock = os.open(os.path.join(registryDir, "registry.lock"), os.O_RDONLY | os.O_CREAT, 0o644)
+    with closing(os.fdopen(registryLock)):
+        # Reservations are only made while holding the registry lock, so
+        # two processes can't both take over the same stale one
+        fcntl.flock(registryLock, fcntl.LOCK_EX)
+        try:
+            for i in range(min(maxCandidates, numPorts)):
+                port = MIN_KTSERVER_PORT + (firstCandidate + i) % numPorts
+                portLock = os.path.join(registryDir, "%d.lock" % port)
+                if os.path.exists(portLock):
+                    try:
+                        with open(portLock) as f:
+                            pid = int(f.read().strip())
+                    except (OSError, ValueError):
+                        continue
+                    if isProcessAlive(pid):
+                        continue
+                    try:
+                        os.remove(portLock)
+                    except OSError:
+                        continue
+                if not isPortFree(port):
+                    continue
+                try:
+                    fd = os.open(portLock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                except OSError:
+                    continue
+                with os.fdopen(fd, 'w') as f:
+                    f.write("%d\n" % os.getpid())
+                logger.debug("Reserved port %d for ktserver" % port)
+                return port, portLock
+        finally:
+            fcntl.flock(registryLock, fcntl.LOCK_UN)
+    raise RuntimeError("Couldn't find a free port for ktserver after trying %d ports" % maxCandidates)
+
+def releasePort(portLock):
+    """Release a port reserved by reservePort."""
+    try:
+        os.remove(portLock)
+    except FileNotFoundError:
+        pass
+
+def isPortCollision(log):
+    """Does a ktserver log say that it couldn't bind its port?"""
+    log = log.lower()
+    return "address already in use" in log or "bind failed" in log
+
+def discardServerExceptions():
+    """Drop the exceptions sent by babysitters that failed to start, so
+    that they aren't blamed on the one that did."""
+    try:
+        while True:
+            ServerProcess.exceptionMsg.get(timeout=1)
+    except queue.Empty:
+        pass
 
 class ServerProcess(Process):
     """Independent process that babysits the ktserver process.
 
-    Waits for the TERMINATE flag to be set, then kills the DB and
-    copies the final snapshot to snapshotExportID.
+    Waits for stop() to be called from the process that started it, or
+    for the TERMINATE flag to be set (checked every
+    TERMINATE_CHECK_INTERVAL seconds), then kills the DB and copies the
+    final snapshot to snapshotExportID. The ktserver of a persistent DB is
+    also restarted to save or reload snapshots when asked to.
     """
     exceptionMsg = Queue()
 
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
+        self.terminateEvent = Event()
         super(ServerProcess, self).__init__()
 
+    def stop(self):
+        """Shut the DB down without waiting for the next check of the
+        TERMINATE flag."""
+        self.terminateEvent.set()
+
     def run(self):
         """Run the tryRun method, signaling the main thread if an exception occurs."""
         try:
@@ -84,106 +248,216 @@ class ServerProcess(Process):
             self.exceptionMsg.put("".join(traceback.format_exception(*sys.exc_info())))
             raise
 
-    def tryRun(self, dbElem, logPath, fileStore, existingSnapshotID=None, snapshotExportID=None):
+    def tryRun(self, dbElem, logPath, fileStore, existingSnapshotID=None, snapshotExportID=None,
+               snapshotCodec="gzip", persistent=False, portLock=None):
+        try:
+            self.runServer(dbElem, logPath, fileStore, existingSnapshotID, snapshotExportID, snapshotCodec,
+                           persistent)
+        finally:
+            if portLock is not None:
+                releasePort(portLock)
+
+    def runServer(self, dbElem, logPath, fileStore, existingSnapshotID=None, snapshotExportID=None,
+                  snapshotCodec="gzip", persistent=False):
         snapshotDir = os.path.join(fileStore.getLocalTempDir(), 'snapshot')
         os.mkdir(snapshotDir)
         snapshotPath = os.path.join(snapshotDir, KTSERVER_SNAPSHOT_NAME)
-        if existingSnapshotID is not None:
-            # Extract the existing snapshot to the snapshot
-            # directory so it will be automatically loaded
-            fileStore.readGlobalFile(existingSnapshotID, userPath=snapshotPath)
+        # Extract the existing snapshot to the snapshot directory so it
+        # will be automatically loaded
+        baseManifest, compression = self.loadSnapshot(fileStore, existingSnapshotID, snapshotPath)
+        process, log, client = self.startServer(dbElem, logPath, snapshotDir, compression, existingSnapshotID,
+                                                persistent)
+
+        lastTerminateCheck = time()
+        while not self.terminateEvent.is_set():
+            # Check for the termination signal of other jobs
+            if time() - lastTerminateCheck >= TERMINATE_CHECK_INTERVAL:
+                if client.get("TERMINATE") is not None:
+                    break
+                lastTerminateCheck = time()
+            # Check that the DB is still alive
+            log.update()
+            if process.poll() is not None or log.failed:
+                with open(log.logPath) as f:
+                    raise RuntimeError("KTServer failed. Log: %s" % f.read())
+            request = takeKtserverRequest(client) if persistent else None
+            if request is not None:
+                saveID, reloadID = request
+                self.stopServer(process, log.logPath)
+                if saveID is not None:
+                    baseManifest = self.saveServerSnapshot(fileStore, log.logPath, snapshotDir, saveID,
+                                                           snapshotCodec, baseManifest, compression)
+                    # So that a restarted service carries on from it
+                    with fileStore.jobStore.updateFileStream(snapshotExportID) as f:
+                        f.write(saveID.encode())
+                else:
+                    for path in glob(os.path.join(snapshotDir, "*.ktss")):
+                        os.remove(path)
+                    baseManifest, compression = self.loadSnapshot(fileStore, reloadID or None, snapshotPath)
+                process, log, client = self.startServer(dbElem, logPath, snapshotDir, compression,
+                                                        saveID or reloadID or None, persistent)
+                continue
+            # stop() wakes this up at once
+            self.terminateEvent.wait(REQUEST_CHECK_INTERVAL if persistent else TERMINATE_CHECK_INTERVAL)
+        self.stopServer(process, log.logPath)
+        # Nothing needs what a persistent DB holds after the snapshot saved
+        # at the end of the last phase, so the one it leaves isn't saved
+        if snapshotExportID is not None and not persistent:
+            self.saveServerSnapshot(fileStore, log.logPath, snapshotDir, snapshotExportID, snapshotCodec,
+                                    baseManifest, compression)
+
+    def loadSnapshot(self, fileStore, snapshotID, snapshotPath):
+        """Restore the snapshot snapshotID, if there is one, to where
+        ktserver will load it. Returns its manifest, and the compression
+        ktserver has to load it (and take its own snapshots) with."""
+        if snapshotID is None:
+            return None, None
+        manifest = restoreSnapshot(fileStore.jobStore, snapshotID, snapshotPath)
+        # Whole snapshots, saved before they were chunked, were compressed with lzo
+        return manifest, manifest.get("compression") if manifest is not None else "lzo"
+
+    def startServer(self, dbElem, logPath, snapshotDir, compression, snapshotID, persistent):
+        """Start ktserver on the DB's port, loading any snapshot in
+        snapshotDir, which is snapshotID. Returns the process, its log and
+        a client for it."""
+        if os.path.exists(logPath) and os.path.getsize(logPath) > 0:
+            # A restart, which gets its own log so that it isn't taken as
+            # having finished already
+            logPath = "%s.%d" % (logPath, len(glob(logPath + ".*")) + 1)
         process = cactus_call(server=True, shell=False,
-                              parameters=getKtserverCommand(dbElem, logPath, snapshotDir),
+                              parameters=getKtserverCommand(dbElem, logPath, snapshotDir,
+                                                            snapshotCompression=compression),
                               port=dbElem.getDbPort())
-
-        blockUntilKtserverIsRunning(logPath)
-        if existingSnapshotID is not None:
+        log = KtserverLog(logPath)
+        if not blockUntilKtserverIsRunning(logPath, host=dbElem.getDbHost(), port=dbElem.getDbPort(),
+                                           process=process):
+            raise RuntimeError("Unable to launch ktserver in time. Log: %s" % readLogTail(logPath))
+        client = KtClient.fromDbElem(dbElem)
+        if snapshotID is not None:
             # Clear the termination flag from the snapshot
-            cactus_call(parameters=["ktremotemgr", "remove"] + getRemoteParams(dbElem) + ["TERMINATE"])
-
-        while True:
-            # Check for the termination signal
-            try:
-                cactus_call(parameters=["ktremotemgr", "get"] + getRemoteParams(dbElem) + ["TERMINATE"],
-                            swallowStdErr=True)
-            except:
-                # No terminate signal sent yet
-                pass
-            else:
-                # Terminate signal received
-                break
-            # Check that the DB is still alive
-            if process.poll() is not None or isKtServerFailed(logPath):
-                with open(logPath) as f:
-                    raise RuntimeError("KTServer failed. Log: %s" % f.read())
-            sleep(60)
+            client.remove("TERMINATE")
+        if persistent:
+            # No phase has changed it yet
+            if snapshotID is not None:
+                client.set(LOADED_SNAPSHOT_KEY, snapshotID)
+            client.remove(PHASE_STARTED_KEY)
+        return process, log, client
+
+    def stopServer(self, process, logPath):
+        """Shut ktserver down, leaving its snapshot in its snapshot directory."""
         process.send_signal(signal.SIGINT)
         process.wait()
-        blockUntilKtserverIsFinished(logPath)
-        if snapshotExportID is not None:
-            if not os.path.exists(snapshotPath):
-                with open(logPath) as f:
-                    raise RuntimeError("KTServer did not leave a snapshot on termination,"
-                                       " but a snapshot was requested. Log: %s" % f.read())
-            if len(glob(os.path.join(snapshotDir, "*.ktss"))) != 1:
-                # More than one snapshot file. It's not clear what
-                # conditions trigger this--if any--but we
-                # don't support it right now.
-                with open(logPath) as f:
-                    raise RuntimeError("KTServer left more than one snapshot. Log: %s" % f.read())
-
-            # Export the snapshot file to the file store
-            fileStore.jobStore.updateFile(snapshotExportID, snapshotPath)
-
-def blockUntilKtserverIsRunning(logPath, createTimeout=1800):
+        blockUntilKtserverIsFinished(logPath, timeout=60)
+
+    def saveServerSnapshot(self, fileStore, logPath, snapshotDir, snapshotID, snapshotCodec, baseManifest,
+                           compression):
+        """Save the snapshot a stopped ktserver left to snapshotID,
+        returning its manifest."""
+        if len(glob(os.path.join(snapshotDir, "*.ktss"))) == 0:
+            with open(logPath) as f:
+                raise RuntimeError("KTServer did not leave a snapshot on termination,"
+                                   " but a snapshot was requested. Log: %s" % f.read())
+        if len(glob(os.path.join(snapshotDir, "*.ktss"))) != 1:
+            # More than one snapshot file. It's not clear what
+            # conditions trigger this--if any--but we
+            # don't support it right now.
+            with open(logPath) as f:
+                raise RuntimeError("KTServer left more than one snapshot. Log: %s" % f.read())
+
+        # Export the snapshot file to the file store
+        manifest, uploaded = saveSnapshot(fileStore.jobStore, os.path.join(snapshotDir, KTSERVER_SNAPSHOT_NAME),
+                                          snapshotID, snapshotCodec, baseManifest=baseManifest,
+                                          compression=compression)
+        logger.info("Saved ktserver snapshot of %d bytes, uploading %d of its %d chunks" % (
+            manifest["size"], uploaded, len(manifest["chunks"])))
+        return manifest
+
+class KtserverLog(object):
+    """Follows a ktserver log, reading only what was added since the last
+    update."""
+    def __init__(self, logPath):
+        self.logPath = logPath
+        self.offset = 0
+        self.running = False
+        self.failed = False
+        self.finished = False
+
+    def update(self):
+        with open(self.logPath, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # Leave any partial line for next time
+        data = data[:data.rfind(b'\n') + 1]
+        self.offset += len(data)
+        for line in data.decode(errors='replace').lower().splitlines():
+            if "listening" in line:
+                self.running = True
+            if "error" in line:
+                self.failed = True
+            if "[finish]" in line:
+                self.finished = True
+
+def ktserverResponds(host, port, timeout=5):
+    """Check if a ktserver answers an RPC on the port. Just connecting isn't
+    enough, as docker accepts connections to a container's ports before
+    anything in it listens on them."""
+    try:
+        with closing(socket.create_connection((host, port), timeout=timeout)) as sock:
+            sock.sendall(b"GET /rpc/void HTTP/1.0\r\n\r\n")
+            return sock.recv(64).startswith(b"HTTP/1.1 200")
+    except (OSError, socket.timeout):
+        return False
+
+def isRunning(process):
+    """Check if a babysitter Process, or a ktserver Popen, is still running."""
+    return process.poll() is None if hasattr(process, "poll") else process.is_alive()
+
+def readLogTail(logPath, maxBytes=64*1024):
+    """Get the end of a ktserver log, which may be long after restarts."""
+    try:
+        with open(logPath, 'rb') as f:
+            f.seek(max(0, os.path.getsize(logPath) - maxBytes))
+            return f.read().decode(errors='replace')
+    except OSError:
+        return ''
+
+def blockUntilKtserverIsRunning(logPath, createTimeout=1800, host=None, port=None, process=None,
+                                pollInterval=0.1):
     """Check status until it's successful, an error is found, or we timeout.
+    If the port is given, the server is probed on it rather than waiting
+    for it to log that it is listening.
 
     Returns True if the ktserver is now running, False if something went wrong."""
-    success = False
-    for i in range(createTimeout):
-        if isKtServerFailed(logPath):
+    log = KtserverLog(logPath)
+    deadline = time() + createTimeout
+    while time() < deadline:
+        if os.path.exists(logPath):
+            log.update()
+        if log.failed:
             logger.critical('Error starting ktserver.')
-            success = False
-            break
-        if isKtServerRunning(logPath):
+            return False
+        if process is not None and not isRunning(process):
+            logger.critical('Ktserver or its babysitter exited.')
+            return False
+        if log.running if port is None else ktserverResponds(host or 'localhost', port):
             logger.info('Ktserver running.')
-            success = True
-            break
-        sleep(1)
-    return success
+            return True
+        sleep(pollInterval)
+    return False
 
-def blockUntilKtserverIsFinished(logPath, timeout=1800,
-                                 timeStep=10):
+def blockUntilKtserverIsFinished(logPath, timeout=1800, pollInterval=0.1):
     """Wait for the ktserver log to indicate that it shut down properly.
 
-    Returns True if the server shut down, False if the timeout expired."""
-    for i in range(0, timeout, timeStep):
-        with open(logPath) as f:
-            log = f.read()
-            if '[FINISH]' in log:
-                return True
-        sleep(timeStep)
+    Returns True if the server shut down, raises if the timeout expired."""
+    log = KtserverLog(logPath)
+    deadline = time() + timeout
+    while time() < deadline:
+        log.update()
+        if log.finished:
+            return True
+        sleep(pollInterval)
     raise RuntimeError("Timeout reached while waiting for ktserver.")
 
-def isKtServerRunning(logPath):
-    """Check if the server started running."""
-    success = False
-    with open(logPath) as f:
-        for line in f:
-            if line.lower().find("listening") >= 0:
-                success = True
-    return success
-
-def isKtServerFailed(logPath):
-    """Does the server log contain an error?"""
-    isFailed = False
-    with open(logPath) as f:
-        for line in f:
-            if line.lower().find("error") >= 0:
-                isFailed = True
-                break
-    return isFailed
-
 def getKtTuningOptions(dbElem):
     """Get the appropriate KTServer tuning parameters (bucket size, etc.)"""
     # these are some hardcoded defaults.  should think about moving to config
@@ -203,7 +477,7 @@ def getKtServerOptions(dbElem):
         serverOptions = dbElem.getDbServerOptions()
     return serverOptions
 
-def getKtserverCommand(dbElem, logPath, snapshotDir):
+def getKtserverCommand(dbElem, logPath, snapshotDir, snapshotCompression=None):
     """Get a ktserver command line with the proper options (in popen-type list format)."""
     serverOptions = getKtServerOptions(dbElem)
     tuning = getKtTuningOptions(dbElem)
@@ -212,20 +486,89 @@ def getKtserverCommand(dbElem, logPath, snapshotDir):
     # Configure background snapshots, but set the interval between
     # snapshots to ~ 10 days so it'll never trigger. We are only
     # interested in the snapshot that the DB creates on termination.
-    cmd += ["-bgs", snapshotDir, "-bgsc", "lzo", "-bgsi", "1000000"]
+    # The snapshot is left uncompressed, as it is compressed in chunks
+    # when saved to the job store.
+    cmd += ["-bgs", snapshotDir, "-bgsi", "1000000"]
+    if snapshotCompression is not None:
+        cmd += ["-bgsc", snapshotCompression]
     cmd += ["-log", logPath]
     cmd += [":" + tuning]
     return cmd
 
-def getRemoteParams(dbElem):
-    """Get parameters to supply to ktremotemgr to connect to the right DB."""
-    host = dbElem.getDbHost() or 'localhost'
-    return ['-port', str(dbElem.getDbPort()),
-            '-host', host]
-
 def stopKtserver(dbElem):
     """Attempt to send the terminate signal to a ktserver."""
-    cactus_call(parameters=['ktremotemgr', 'set'] + getRemoteParams(dbElem) + ['TERMINATE', '1'])
+    KtClient.fromDbElem(dbElem).set("TERMINATE", "1")
+
+def isKtserverAtSnapshot(client, snapshotID):
+    """Check that a persistent DB holds the snapshot snapshotID (or is
+    empty, if it is None), unchanged by any phase."""
+    return client.get(PHASE_STARTED_KEY) is None and \
+        (client.get(LOADED_SNAPSHOT_KEY) or b"") == (snapshotID or "").encode()
+
+def takeKtserverRequest(client):
+    """Get the request sent to the babysitter of a persistent DB by
+    saveKtserver or reloadKtserver, as the snapshot ID to save to and the
+    one to reload ("" for an empty DB), or None if there isn't one. A DB
+    to be saved is marked as holding the snapshot it is saved to."""
+    saveID = client.get(SAVE_SNAPSHOT_KEY)
+    if saveID is not None:
+        client.remove(SAVE_SNAPSHOT_KEY)
+        client.remove(PHASE_STARTED_KEY)
+        client.set(LOADED_SNAPSHOT_KEY, saveID)
+        return saveID.decode(), None
+    reloadID = client.get(RELOAD_SNAPSHOT_KEY)
+    if reloadID is not None:
+        client.remove(RELOAD_SNAPSHOT_KEY)
+        return None, reloadID.decode()
+    return None
+
+def waitForKtserver(condition, pollInterval, maxPollInterval):
+    """Poll condition until it is true, backing off from pollInterval to
+    maxPollInterval seconds between checks. A DB that doesn't answer is
+    taken as still restarting."""
+    while True:
+        try:
+            if condition():
+                return
+        except KtError:
+            pass
+        sleep(pollInterval)
+        pollInterval = min(pollInterval * 2, maxPollInterval)
+
+def isFileWritten(jobStore, fileID):
+    with jobStore.readFileStream(fileID) as f:
+        return f.read(1) != b''
+
+def saveKtserver(dbElem, jobStore, snapshotID, pollInterval=0.1, maxPollInterval=5):
+    """Have the babysitter of a persistent DB save a snapshot of it to the
+    (existing, empty) job store file snapshotID, and wait until it is saved
+    and the DB is running again."""
+    client = KtClient.fromDbElem(dbElem)
+    client.set(SAVE_SNAPSHOT_KEY, snapshotID)
+    # The file stays empty until the whole snapshot is saved, which the
+    # DB is only restarted after
+    waitForKtserver(lambda: isFileWritten(jobStore, snapshotID), pollInterval, maxPollInterval)
+    waitForKtserver(lambda: isKtserverAtSnapshot(client, snapshotID), pollInterval, maxPollInterval)
+
+def reloadKtserver(dbElem, snapshotID, pollInterval=0.1, maxPollInterval=5):
+    """Before a phase is run against a persistent DB, make sure it holds
+    the snapshot snapshotID (or is empty, if it is None) that the phase
+    starts from, having the babysitter reload it if an earlier run of the
+    phase may have changed it. Then mark the phase as started. Returns True
+    if the DB was reloaded."""
+    client = KtClient.fromDbElem(dbElem)
+    reloaded = False
+    if not isKtserverAtSnapshot(client, snapshotID):
+        client.set(RELOAD_SNAPSHOT_KEY, snapshotID or "")
+        waitForKtserver(lambda: isKtserverAtSnapshot(client, snapshotID), pollInterval, maxPollInterval)
+        reloaded = True
+    client.set(PHASE_STARTED_KEY, "1")
+    return reloaded
+
+def getKtserverStats(dbElem):
+    """Get the number of records in a ktserver's DB and its size in bytes."""
+    status = KtClient.fromDbElem(dbElem).status()
+    return int(status["count"]), int(status["size"])
 
 def getHostName():
     if platform.system() == 'Darwin':
@@ -255,19 +598,3 @@ def getPublicIP():
         # than killing everything, because this is often called just
         # to provide a default argument
         return '127.0.0.1'
-
-def findOccupiedPorts():
-    """Attempt to find all currently taken TCP ports.
-
-    Returns a set of ints, representing taken ports."""
-    netstatOutput = cactus_call(parameters=["netstat", "-tuplen"], check_output=True)
-    ports = set()
-    for line in netstatOutput.split("\n"):
-        fields = line.split()
-        if len(fields) != 9:
-            # Header or other garbage line
-            continue
-        port = int(fields[3].split(':')[-1])
-        ports.add(port)
-    logger.debug('Detected ports in use: %s' % repr(ports))
-    return ports
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+"""Tests reserving ports for ktservers.
+"""
+
+import unittest
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import xml.etree.ElementTree as ET
+from contextlib import closing
+from http.server import HTTPServer
+from sonLib.bioio import TestStatus
+from sonLib.bioio import getTempDirectory
+from cactus.shared.experimentWrapper import DbElemWrapper
+from cactus.pipeline.ktClient import KtClient
+from cactus.pipeline.ktClientTest import FakeKtHandler
+from cactus.pipeline.ktSnapshotTest import MemoryJobStore
+from cactus.pipeline.ktserverControl import reservePort, releasePort, isPortFree, isPortCollision, \
+    getKtserverCommand, saveKtserver, reloadKtserver, takeKtserverRequest, isKtserverAtSnapshot, \
+    LOADED_SNAPSHOT_KEY, PHASE_STARTED_KEY, MIN_KTSERVER_PORT, MAX_KTSERVER_PORT
+
+class FakeBabysitter(threading.Thread):
+    """Serves the requests sent to the babysitter of a persistent DB, as it
+    would, on a fake ktserver's records, keeping the snapshots in memory."""
+    def __init__(self, server, jobStore):
+        super(FakeBabysitter, self).__init__()
+        self.records = server.records
+        self.client = KtClient(*server.server_address)
+        self.jobStore = jobStore
+        self.snapshots = {}
+        self.stopEvent = threading.Event()
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            request = takeKtserverRequest(self.client)
+            if request is not None:
+                saveID, reloadID = request
+                if saveID is not None:
+                    self.snapshots[saveID] = dict(self.records)
+                    self.jobStore.files[saveID] = b"manifest"
+                else:
+                    self.records.clear()
+                    self.records.update(self.snapshots.get(reloadID, {}))
+                    if reloadID != "":
+                        self.records[LOADED_SNAPSHOT_KEY.encode()] = reloadID.encode()
+            self.stopEvent.wait(0.01)
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tempDir = getTempDirectory(os.getcwd())
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tempDir)
+
+    @TestStatus.shortLength
+    def testReservePort(self):
+        port1, lock1 = reservePort(self.tempDir)
+        port2, lock2 = reservePort(self.tempDir)
+        self.assertNotEqual(port1, port2)
+        for port in (port1, port2):
+            self.assertTrue(MIN_KTSERVER_PORT <= port <= MAX_KTSERVER_PORT)
+        with open(lock1) as f:
+            self.assertEqual(int(f.read()), os.getpid())
+
+        # A released port can be reserved again
+        releasePort(lock1)
+        self.assertFalse(os.path.exists(lock1))
+        self.assertEqual(reservePort(self.tempDir)[0], port1)
+
+        # Reservations of processes that are gone are taken over
+        deadProcess = subprocess.Popen([sys.executable, "-c", ""])
+        deadProcess.wait()
+        with open(lock1, 'w') as f:
+            f.write("%d\n" % deadProcess.pid)
+        self.assertEqual(reservePort(self.tempDir)[0], port1)
+
+    @TestStatus.shortLength
+    def testReserveSkipsBoundPorts(self):
+        port, lock = reservePort(self.tempDir)
+        releasePort(lock)
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+            sock.bind(('', port))
+            sock.listen(1)
+            self.assertFalse(isPortFree(port))
+            self.assertNotEqual(reservePort(self.tempDir)[0], port)
+
+    @TestStatus.shortLength
+    def testIsPortCollision(self):
+        self.assertTrue(isPortCollision("2020-01-01T00:00:00: [ERROR]: socket error: "
+                                        "expr=bind failed: Address already in use"))
+        self.assertFalse(isPortCollision("[ERROR]: could not open the database"))
+
+    @TestStatus.shortLength
+    def testKtserverCommand(self):
+        dbElem = DbElemWrapper(ET.fromstring('<st_kv_database_conf type="kyoto_tycoon">'
+                                             '<kyoto_tycoon host="localhost" port="1234"/></st_kv_database_conf>'))
+        command = getKtserverCommand(dbElem, "log", "snapshots")
+        self.assertEqual(command[:3], ["ktserver", "-port", "1234"])
+        # Snapshots are uncompressed, and only taken on termination
+        self.assertEqual(command[command.index("-bgsi") + 1], "1000000")
+        self.assertFalse("-bgsc" in command)
+
+        # Loading a whole snapshot from before they were chunked
+        command = getKtserverCommand(dbElem, "log", "snapshots", snapshotCompression="lzo")
+        self.assertEqual(command[command.index("-bgsc") + 1], "lzo")
+
+    @TestStatus.shortLength
+    def testPersistentDbCheckpoints(self):
+        server = HTTPServer(("127.0.0.1", 0), FakeKtHandler)
+        server.records = {}
+        serverThread = threading.Thread(target=server.serve_forever)
+        serverThread.start()
+        jobStore = MemoryJobStore()
+        babysitter = FakeBabysitter(server, jobStore)
+        babysitter.start()
+        try:
+            dbElem = DbElemWrapper(ET.fromstring('<st_kv_database_conf type="kyoto_tycoon">'
+                                                 '<kyoto_tycoon host="127.0.0.1" port="%d"/>'
+                                                 '</st_kv_database_conf>' % server.server_address[1]))
+            client = KtClient.fromDbElem(dbElem)
+
+            # The setup checkpoint starts from an empty DB, and saves it at its end
+            self.assertFalse(reloadKtserver(dbElem, None, pollInterval=0.01))
+            self.assertFalse(isKtserverAtSnapshot(client, None))
+            client.set("setup", "1")
+            setupID = jobStore.getEmptyFileStoreID()
+            saveKtserver(dbElem, jobStore, setupID, pollInterval=0.01)
+            self.assertTrue(isKtserverAtSnapshot(client, setupID))
+            self.assertEqual(client.get(PHASE_STARTED_KEY), None)
+
+            # The next checkpoint carries on with the DB as it is
+            self.assertFalse(reloadKtserver(dbElem, setupID, pollInterval=0.01))
+            client.set("bar", "1")
+            # A rerun after the phase failed reloads what it started from
+            self.assertTrue(reloadKtserver(dbElem, setupID, pollInterval=0.01))
+            self.assertEqual(client.get("setup"), b"1")
+            self.assertEqual(client.get("bar"), None)
+            # As does a rerun of an earlier checkpoint
+            self.assertTrue(reloadKtserver(dbElem, None, pollInterval=0.01))
+            self.assertEqual(client.get("setup"), None)
+        finally:
+            babysitter.stopEvent.set()
+            babysitter.join()
+            server.shutdown()
+            server.server_close()
+            serverThread.join()
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
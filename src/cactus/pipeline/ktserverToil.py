@@ -7,44 +7,59 @@
 import os
 import stat
 from toil.job import Job
-from cactus.pipeline.ktserverControl import runKtserver, blockUntilKtserverIsRunning, stopKtserver, \
-    blockUntilKtserverIsFinished
+from cactus.pipeline.ktserverControl import runKtserver, blockUntilKtserverIsRunning, TERMINATE_CHECK_INTERVAL
 
 class KtServerService(Job.Service):
-    def __init__(self, dbElem, isSecondary, existingSnapshotID=None,
+    def __init__(self, dbElem, isSecondary, existingSnapshotID=None, snapshotCodec="gzip",
+                 snapshotExportID=None, persistent=False,
                  memory=None, cores=None, disk=None):
         Job.Service.__init__(self, memory=memory, cores=cores, disk=disk, preemptable=False)
         self.dbElem = dbElem
         self.isSecondary = isSecondary
         self.existingSnapshotID = existingSnapshotID
+        self.snapshotCodec = snapshotCodec
+        self.snapshotExportID = snapshotExportID
+        self.persistent = persistent
         self.failed = False
         self.process = None
 
     def start(self, job):
-        snapshotExportID = job.fileStore.jobStore.getEmptyFileStoreID()
+        snapshotExportID = self.snapshotExportID or job.fileStore.jobStore.getEmptyFileStoreID()
         # We need to run this garbage in case we are on a file-based
         # jobStore with caching enabled. The caching jobStore sets
         # this empty file to be unwritable for some reason. Since we
         # need to write something to it, obviously that won't do.
         path = job.fileStore.readGlobalFile(snapshotExportID)
         os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH)
+        existingSnapshotID = self.existingSnapshotID
+        if self.persistent:
+            with job.fileStore.jobStore.readFileStream(snapshotExportID) as f:
+                savedSnapshotID = f.read().decode()
+            if savedSnapshotID != "":
+                # The service is being restarted after the DB was saved at
+                # the end of a phase. The checkpoint being run reloads the
+                # snapshot it starts from if that isn't the one.
+                existingSnapshotID = savedSnapshotID
         self.process, self.dbElem, self.logPath = runKtserver(self.dbElem, fileStore=job.fileStore,
-                                                              existingSnapshotID=self.existingSnapshotID,
-                                                              snapshotExportID=snapshotExportID)
+                                                              existingSnapshotID=existingSnapshotID,
+                                                              snapshotExportID=snapshotExportID,
+                                                              snapshotCodec=self.snapshotCodec,
+                                                              persistent=self.persistent)
         assert self.dbElem.getDbHost() != None
-        blockUntilKtserverIsRunning(self.logPath)
+        blockUntilKtserverIsRunning(self.logPath, host=self.dbElem.getDbHost(), port=self.dbElem.getDbPort())
         self.check()
         return self.dbElem.getConfString(), snapshotExportID
 
     def stop(self, job):
         self.check()
-        try:
-            stopKtserver(self.dbElem)
-        except:
-            # Server is probably already terminated
-            pass
-        if not self.failed:
-            blockUntilKtserverIsFinished(self.logPath, timeout=1200)
+        # Tell the babysitter to shut the server down (if the TERMINATE
+        # flag hasn't already), and wait for it to save the snapshot,
+        # which takes as long as the DB is large
+        self.process.stop()
+        while self.process.is_alive():
+            self.process.join(TERMINATE_CHECK_INTERVAL)
+            self.check()
+        self.check()
 
     def check(self):
         if self.process.exceptionMsg.empty():
@@ -26,7 +26,7 @@ from cactus.shared.common import readGlobalFileWithoutCache
 from cactus.shared.common import cactusRootPath
 from cactus.shared.configWrapper import ConfigWrapper
 from cactus.progressive.seqFile import SeqFile
-from cactus.shared.common import setupBinaries, importSingularityImage
+from cactus.shared.common import setupBinaries, importSingularityImage, setResourceRounding
 from cactus.shared.common import enableDumpStack
 from toil.lib.bioio import setLoggingFromOptions
 from toil.realtimeLogger import RealtimeLogger
@@ -282,6 +282,7 @@ def stageWorkflow(outputSequenceDir, configFile, inputSequences, toil, restart=F
         assert len(outputSequences) == len(inputSequences)
     if configNode.find("constants") != None:
         ConfigWrapper(configNode).substituteAllPredefinedConstantsWithLiterals()
+        setResourceRounding(configNode)
     if not restart:
         inputSequenceIDs = [toil.importFile(makeURL(seq)) for seq in inputSequences]
         outputSequenceIDs = toil.start(CactusPreprocessor(inputSequenceIDs, configNode))
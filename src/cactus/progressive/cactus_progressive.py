@@ -35,6 +35,7 @@ from cactus.shared.common import getDockerImage
 from cactus.shared.version import cactus_commit
 from cactus.shared.common import cactusRootPath
 from cactus.shared.common import enableDumpStack
+from cactus.shared.fastaStats import getFastaStats, writeFastaStats
 
 from toil.job import Job
 from toil.common import Toil
@@ -49,7 +50,8 @@ from cactus.shared.experimentWrapper import ExperimentWrapper
 from cactus.shared.configWrapper import ConfigWrapper
 from cactus.progressive.schedule import Schedule
 from cactus.progressive.projectWrapper import ProjectWrapper
-from cactus.shared.common import setupBinaries, importSingularityImage
+from cactus.shared.common import setupBinaries, importSingularityImage, setResourceRounding, \
+    setMemoryEscalationsFile
 
 from sonLib.nxnewick import NXNewick
 from sonLib.bioio import getTempDirectory
@@ -162,12 +164,15 @@ class ProgressiveUp(RoundedJob):
         configXml = ET.parse(configPath).getroot()
 
         seqIDMap = dict()
+        seqStatsIDMap = dict()
         tree = experiment.getTree()
         seqNames = []
         for node in tree.postOrderTraversal():
             name = tree.getName(node)
             if tree.isLeaf(node) or (name == experiment.getRootGenome() and experiment.isRootReconstructed() == False):
                 seqIDMap[name] = self.project.outputSequenceIDMap[name]
+                if str(seqIDMap[name]) in self.project.sequenceStatsIDMap:
+                    seqStatsIDMap[str(seqIDMap[name])] = self.project.sequenceStatsIDMap[str(seqIDMap[name])]
                 seqNames.append(name)
         logger.info("Sequences in progressive, %s: %s" % (self.event, seqNames))
 
@@ -185,7 +190,8 @@ class ProgressiveUp(RoundedJob):
         # get parameters that cactus_workflow stuff wants
         configFile = fileStore.readGlobalFile(experiment.getConfigID())
         configNode = ET.parse(configFile).getroot()
-        workFlowArgs = CactusWorkflowArguments(self.options, experimentFile=experimentFile, configNode=configNode, seqIDMap = seqIDMap)
+        workFlowArgs = CactusWorkflowArguments(self.options, experimentFile=experimentFile, configNode=configNode, seqIDMap = seqIDMap,
+                                               seqStatsIDMap = seqStatsIDMap)
 
         # copy over the options so we don't trail them around
         workFlowArgs.buildHal = self.options.buildHal
@@ -204,9 +210,11 @@ class ProgressiveUp(RoundedJob):
         return finalExpWrapper
 
 def logAssemblyStats(job, message, name, sequenceID, preemptable=True):
-    sequenceFile = job.fileStore.readGlobalFile(sequenceID)
-    analysisString = cactus_call(parameters=["cactus_analyseAssembly", sequenceFile], check_output=True)
-    job.fileStore.logToMaster("%s, got assembly stats for genome %s: %s" % (message, name, analysisString))
+    """Log the stats of a sequence, returning the ID of their sidecar so
+    that later jobs don't have to rescan it."""
+    stats = getFastaStats(job.fileStore, sequenceID)
+    job.fileStore.logToMaster("%s, got assembly stats for genome %s: %s" % (message, name, stats.summary()))
+    return writeFastaStats(job.fileStore, stats)
 
 class RunCactusPreprocessorThenProgressiveDown(RoundedJob):
     def __init__(self, options, project, memory=None, cores=None):
@@ -223,7 +231,7 @@ class RunCactusPreprocessorThenProgressiveDown(RoundedJob):
 
         # Log the stats for the un-preprocessed assemblies
         for name, sequence in list(self.project.inputSequenceIDMap.items()):
-            self.addChildJobFn(logAssemblyStats, "Before preprocessing", name, sequence)
+            self.project.sequenceStatsIDMap[str(sequence)] = self.addChildJobFn(logAssemblyStats, "Before preprocessing", name, sequence).rv()
 
         # Create jobs to create the output sequences
         logger.info("Reading config file from: %s" % self.project.getConfigID())
@@ -269,7 +277,9 @@ class RunCactusPreprocessorThenProgressiveDown2(RoundedJob):
             for genome, seqID in list(preprocessedSequences.items()):
                 fileStore.exportFile(seqID, self.options.intermediateResultsUrl + '-preprocessed-' + genome)
 
-        # Log the stats for the preprocessed assemblies
+        # Log the stats for the preprocessed assemblies. This is a side
+        # branch: the progressive jobs don't wait for it, and scan the
+        # sequences themselves where they need the stats
         for name, sequence in list(self.project.outputSequenceIDMap.items()):
             self.addChildJobFn(logAssemblyStats, "After preprocessing", name, sequence)
 
@@ -410,6 +420,7 @@ def main():
 
 def runCactusProgressive(options):
     with Toil(options) as toil:
+        setMemoryEscalationsFile(options.jobStore)
         importSingularityImage(options)
         #Run the workflow
         if options.restart:
@@ -448,7 +459,8 @@ def runCactusProgressive(options):
             configNode = ET.parse(project.getConfigPath()).getroot()
             configWrapper = ConfigWrapper(configNode)
             configWrapper.substituteAllPredefinedConstantsWithLiterals()
-
+            configWrapper.checkCodecs()
+            setResourceRounding(configNode)
 
             project.writeXML(pjPath)
             halID = toil.start(RunCactusPreprocessorThenProgressiveDown(options, project, memory=configWrapper.getDefaultMemory()))
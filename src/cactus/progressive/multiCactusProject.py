@@ -24,6 +24,8 @@ class MultiCactusProject:
         self.inputSequenceMap = {}
         self.inputSequenceIDMap = {}
         self.outputSequenceIDMap = {}
+        # str(sequence ID) -> ID of its FastaStats sidecar
+        self.sequenceStatsIDMap = {}
         self.configID = None
 
     def readXML(self, path):
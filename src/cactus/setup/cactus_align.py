@@ -15,7 +15,8 @@ from operator import itemgetter
 
 from cactus.progressive.seqFile import SeqFile
 from cactus.progressive.multiCactusTree import MultiCactusTree
-from cactus.shared.common import setupBinaries, importSingularityImage
+from cactus.shared.common import setupBinaries, importSingularityImage, setResourceRounding, \
+    setMemoryEscalationsFile
 from cactus.progressive.cactus_progressive import exportHal
 from cactus.progressive.multiCactusProject import MultiCactusProject
 from cactus.shared.experimentWrapper import ExperimentWrapper
@@ -28,9 +29,11 @@ from cactus.pipeline.cactus_workflow import addCactusWorkflowOptions
 from cactus.pipeline.cactus_workflow import CactusTrimmingBlastPhase
 from cactus.pipeline.cactus_workflow import CactusSetupCheckpoint
 from cactus.pipeline.cactus_workflow import prependUniqueIDs
-from cactus.blast.blast import calculateCoverage
+from cactus.blast.blast import calculateCoverageAsync
+from cactus.shared.common import gather_cactus_calls
 from cactus.shared.common import makeURL
 from cactus.shared.common import enableDumpStack
+from cactus.shared.fastaStats import getFastaStats
 from toil.realtimeLogger import RealtimeLogger
 
 from toil.job import Job
@@ -126,6 +129,7 @@ def main():
 
 def runCactusAfterBlastOnly(options):
     with Toil(options) as toil:
+        setMemoryEscalationsFile(options.jobStore)
         importSingularityImage(options)
         #Run the workflow
         if options.restart:
@@ -238,6 +242,8 @@ def runCactusAfterBlastOnly(options):
             configNode = ET.parse(project.getConfigPath()).getroot()
             configWrapper = ConfigWrapper(configNode)
             configWrapper.substituteAllPredefinedConstantsWithLiterals()
+            configWrapper.checkCodecs()
+            setResourceRounding(configNode)
 
             workFlowArgs = CactusWorkflowArguments(options, experimentFile=experimentFile, configNode=configNode, seqIDMap = project.inputSequenceIDMap)
 
@@ -270,7 +276,8 @@ def run_cactus_align(job, configWrapper, cactusWorkflowArguments, project, cactu
     
     if not cactus_blast_input:
         # if we're not taking cactus_blast input, then we need to recompute the ingroup coverage
-        cur_job = cur_job.addFollowOnJobFn(run_ingroup_coverage, cactusWorkflowArguments, project)
+        cur_job = cur_job.addFollowOnJobFn(run_ingroup_coverage, cactusWorkflowArguments, project,
+                                           cores=configWrapper.getTrimCores())
         cactusWorkflowArguments = cur_job.rv()
 
     # run cactus setup all the way through cactus2hal generation
@@ -313,8 +320,10 @@ def run_prepend_unique_ids(job, cactusWorkflowArguments, project, cactus_blast_i
     # this is horrible and needs to be fixed via drastic interface refactor
     exp = cactusWorkflowArguments.experimentWrapper
     ingroupsAndOriginalIDs = [(g, exp.getSequenceID(g)) for g in exp.getGenomesWithSequence() if g not in exp.getOutgroupGenomes()]
-    sequences = [job.fileStore.readGlobalFile(id) for id in map(itemgetter(1), ingroupsAndOriginalIDs)]
-    cactusWorkflowArguments.totalSequenceSize = sum(os.stat(x).st_size for x in sequences)
+    sequenceIDs = list(map(itemgetter(1), ingroupsAndOriginalIDs))
+    sequences = [job.fileStore.readGlobalFile(id) for id in sequenceIDs]
+    cactusWorkflowArguments.totalSequenceSize = sum(getFastaStats(job.fileStore, id, cactusWorkflowArguments.sequenceStatsIDMap, path).totalLength
+                                                    for id, path in zip(sequenceIDs, sequences))
     renamedInputSeqDir = job.fileStore.getLocalTempDir()
     id_map = {}
     uniqueFas = prependUniqueIDs(sequences, renamedInputSeqDir, id_map)
@@ -346,15 +355,17 @@ def run_ingroup_coverage(job, cactusWorkflowArguments, project):
     exp = cactusWorkflowArguments.experimentWrapper
     ingroupsAndOriginalIDs = [(g, exp.getSequenceID(g)) for g in exp.getGenomesWithSequence() if g not in exp.getOutgroupGenomes()]
     outgroups = [job.fileStore.readGlobalFile(id) for id in cactusWorkflowArguments.outgroupFragmentIDs]
-    sequences = [job.fileStore.readGlobalFile(id) for id in map(itemgetter(1), ingroupsAndOriginalIDs)]
-    cactusWorkflowArguments.totalSequenceSize = sum(os.stat(x).st_size for x in sequences)
-    ingroups = map(itemgetter(0), ingroupsAndOriginalIDs)
+    sequenceIDs = list(map(itemgetter(1), ingroupsAndOriginalIDs))
+    sequences = [job.fileStore.readGlobalFile(id) for id in sequenceIDs]
+    cactusWorkflowArguments.totalSequenceSize = sum(getFastaStats(job.fileStore, id, cactusWorkflowArguments.sequenceStatsIDMap, path).totalLength
+                                                    for id, path in zip(sequenceIDs, sequences))
     cigar = job.fileStore.readGlobalFile(cactusWorkflowArguments.alignmentsID)
     if len(outgroups) > 0:
-        # should we parallelize with child jobs?
-        for ingroup, sequence in zip(ingroups, sequences):
-            coverage_path = os.path.join(work_dir, '{}.coverage'.format(sequence))
-            calculateCoverage(sequence, cigar, coverage_path, fromGenome=outgroups, work_dir=work_dir)
+        # the ingroups are independent, so run them in parallel on the job's cores
+        coverage_paths = [os.path.join(work_dir, '{}.coverage'.format(sequence)) for sequence in sequences]
+        gather_cactus_calls([calculateCoverageAsync(sequence, cigar, coverage_path, fromGenome=outgroups, work_dir=work_dir)
+                             for sequence, coverage_path in zip(sequences, coverage_paths)], cores=job.cores)
+        for coverage_path in coverage_paths:
             cactusWorkflowArguments.ingroupCoverageIDs.append(job.fileStore.writeGlobalFile(coverage_path))
     return cactusWorkflowArguments
 
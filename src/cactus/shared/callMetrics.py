@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Resource usage (wall time, CPU, peak memory and IO) of the commands
+run by cactus_call, recorded as JSON lines.
+
+Counts of the lines and bytes going through the files of commands (see
+cactus.shared.streamStats) are recorded alongside them.
+
+Records are appended to the file named by CACTUS_METRICS_FILE. Failing
+that, if CACTUS_METRICS_LOG_TO_LEADER is 1, they are sent through the file
+store of the call's job to the leader's log, as lines starting with
+LOG_PREFIX, so they are collected the same way whatever the job store.
+Otherwise they are not recorded. readCallMetrics reads both forms.
+
+The memory that jobs killed for running out of it were rerun with is
+recorded in CACTUS_MEMORY_ESCALATIONS_FILE (by default, set by
+cactus.shared.common.setMemoryEscalationsFile to a file in file job
+stores), so that later jobs of the same kind can be made with it. Each
+process only reads the records added since it last looked.
+"""
+import os
+import json
+import time
+import threading
+import subprocess
+
+ESCALATIONS_FILE_NAME = "cactus_memory_escalations.jsonl"
+LOG_PREFIX = "cactus_call metrics: "
+
+def communicateWithRusage(process, input=None, timeout=None):
+    """Like process.communicate(input, timeout), but reaps the process with
+    os.wait4 to get its resource usage, so that concurrent calls each get
+    their own usage rather than the sum over all children given by
+    getrusage(RUSAGE_CHILDREN). Returns (stdout, stderr, rusage), where
+    rusage is None if the process was reaped elsewhere.
+
+    Raises subprocess.TimeoutExpired if the process is still running after
+    timeout seconds.
+    """
+    outputs = {}
+    def feed():
+        try:
+            if input:
+                process.stdin.write(input)
+            process.stdin.close()
+        except BrokenPipeError:
+            # The process exited without reading all its input
+            pass
+    def drain(name, stream):
+        outputs[name] = stream.read()
+        stream.close()
+    threads = []
+    if process.stdin is not None:
+        threads.append(threading.Thread(target=feed))
+    for name in ("stdout", "stderr"):
+        if getattr(process, name) is not None:
+            threads.append(threading.Thread(target=drain, args=(name, getattr(process, name))))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    result = {}
+    def reap():
+        try:
+            pid, status, result["rusage"] = os.wait4(process.pid, 0)
+            process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        except ChildProcessError:
+            # Reaped elsewhere, let Popen make what it can of it
+            process.wait()
+    if timeout is None:
+        for thread in threads:
+            thread.join()
+        reap()
+    else:
+        # Wait in a thread of its own, so that the wait can be given up on
+        reaper = threading.Thread(target=reap)
+        reaper.daemon = True
+        reaper.start()
+        reaper.join(timeout)
+        if reaper.is_alive():
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        for thread in threads:
+            thread.join()
+    return outputs.get("stdout"), outputs.get("stderr"), result.get("rusage")
+
+def makeCallMetrics(tool, mode, returnCode, startTime, rusage=None, containerMemory=None,
+                    jobName=None, features=None):
+    """Make the record of one command. rusage is the command's
+    resource.struct_rusage, and containerMemory the peak memory of its
+    container if it ran in one of its own."""
+    record = { "time": startTime,
+               "job": jobName,
+               "tool": tool,
+               "mode": mode,
+               "features": features,
+               "returnCode": returnCode,
+               "wallTime": time.time() - startTime }
+    if rusage is not None and mode != "docker":
+        # The usage of a docker command is only that of the docker client
+        record["userTime"] = rusage.ru_utime
+        record["systemTime"] = rusage.ru_stime
+        # ru_maxrss is in kilobytes on Linux
+        record["peakMemory"] = rusage.ru_maxrss * 1024
+        # Block counts are in 512 byte units
+        record["readBytes"] = rusage.ru_inblock * 512
+        record["writeBytes"] = rusage.ru_oublock * 512
+    if containerMemory:
+        record["peakMemory"] = containerMemory
+    return record
+
+def makeStreamMetrics(tool, stats, jobName=None):
+    """Make the record of the lines and bytes that went through one of the
+    files of a command, as counted by a cactus.shared.streamStats.CountingTee."""
+    return { "time": time.time(),
+             "job": jobName,
+             "tool": tool,
+             "stream": stats.name,
+             "records": stats.records,
+             "bytes": stats.bytes }
+
+def writeCallMetrics(record, fileStore=None):
+    line = json.dumps(record)
+    path = os.environ.get("CACTUS_METRICS_FILE")
+    if path is not None:
+        # A single small append, so records from concurrent calls don't interleave
+        with open(path, 'a') as metricsFile:
+            metricsFile.write(line + "\n")
+    elif fileStore is not None and os.environ.get("CACTUS_METRICS_LOG_TO_LEADER", "0") == "1":
+        # Every command is a line in the leader's log, so only if asked for
+        fileStore.logToMaster(LOG_PREFIX + line)
+
+def readCallMetrics(path):
+    """Read the records from a metrics file or a log containing them."""
+    records = []
+    with open(path) as metricsFile:
+        for line in metricsFile:
+            if LOG_PREFIX in line:
+                line = line[line.index(LOG_PREFIX) + len(LOG_PREFIX):]
+            elif not line.startswith("{"):
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Truncated record
+                continue
+    return records
+
+def escalationsPath():
+    """Get the file escalations are recorded in, or None if there isn't one."""
+    return os.environ.get("CACTUS_MEMORY_ESCALATIONS_FILE")
+
+def recordMemoryEscalation(jobName, feature, value, memory):
+    """Record that a job whose feature had the given value needed memory."""
+    path = escalationsPath()
+    if path is None:
+        return
+    record = { "time": time.time(),
+               "job": jobName,
+               "feature": feature,
+               "value": value,
+               "memory": memory }
+    with open(path, 'a') as escalationsFile:
+        escalationsFile.write(json.dumps(record) + "\n")
+
+# The escalations read so far from each file: path -> (bytes read,
+# {(job, feature): [(value, memory)]})
+_escalations = {}
+_escalationsLock = threading.Lock()
+
+def readEscalations(path):
+    """Get the escalations recorded in path by (job, feature), reading only
+    the complete records appended since the last call."""
+    with _escalationsLock:
+        offset, escalations = _escalations.get(path, (0, {}))
+        try:
+            with open(path, 'rb') as escalationsFile:
+                escalationsFile.seek(offset)
+                data = escalationsFile.read()
+        except FileNotFoundError:
+            data = b""
+        # A record being written is left for next time
+        data = data[:data.rfind(b"\n") + 1]
+        for line in data.decode().splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            escalations.setdefault((record["job"], record["feature"]), []).append((record["value"], record["memory"]))
+        _escalations[path] = (offset + len(data), escalations)
+        return escalations
+
+def escalatedMemory(jobName, feature, value, similarity=2.0):
+    """Get the most memory recorded for jobs of the class whose feature was
+    within a factor of similarity of value, or None if there are none."""
+    path = escalationsPath()
+    if path is None:
+        return None
+    memory = None
+    for recordValue, recordMemory in readEscalations(path).get((jobName, feature), []):
+        if value / similarity <= recordValue <= value * similarity:
+            memory = max(memory or 0, recordMemory)
+    return memory
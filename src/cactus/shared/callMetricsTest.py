@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+"""Tests recording the resource usage of commands.
+"""
+
+import unittest
+import os
+import sys
+import time
+import json
+import shutil
+import subprocess
+from sonLib.bioio import TestStatus
+from sonLib.bioio import getTempDirectory
+from cactus.shared.callMetrics import communicateWithRusage, makeCallMetrics, writeCallMetrics, readCallMetrics, LOG_PREFIX, \
+    recordMemoryEscalation, escalatedMemory, makeStreamMetrics
+from cactus.shared.streamStats import StreamStats
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tempDir = getTempDirectory(os.getcwd())
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tempDir)
+        os.environ.pop("CACTUS_METRICS_FILE", None)
+        os.environ.pop("CACTUS_METRICS_LOG_TO_LEADER", None)
+        os.environ.pop("CACTUS_MEMORY_ESCALATIONS_FILE", None)
+
+    @TestStatus.shortLength
+    def testCommunicateWithRusage(self):
+        startTime = time.time()
+        # Allocate about 100MB
+        process = subprocess.Popen([sys.executable, "-c", "x = bytearray(100 * 1024 * 1024); x[-1] = 1"])
+        output, error, rusage = communicateWithRusage(process)
+        self.assertEqual(process.returncode, 0)
+        record = makeCallMetrics("python", "local", process.returncode, startTime, rusage=rusage,
+                                 jobName="job", features={"flowerGroupSize": 3})
+        self.assertTrue(record["peakMemory"] >= 100 * 1024 * 1024)
+        self.assertTrue(record["wallTime"] >= record["userTime"] > 0)
+        self.assertEqual(record["features"], {"flowerGroupSize": 3})
+
+        # Input and output go through pipes as with communicate, and the
+        # exit status is still available
+        process = subprocess.Popen([sys.executable, "-c", "import sys; print(sys.stdin.read().upper()); sys.exit(3)"],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   encoding="ascii")
+        output, error, rusage = communicateWithRusage(process, "input" * 100000)
+        self.assertEqual((process.returncode, output, error), (3, "INPUT" * 100000 + "\n", ""))
+        self.assertTrue(rusage is not None)
+        self.assertEqual(process.wait(), 3)
+
+        # Signals are reported as by Popen
+        process = subprocess.Popen(["sleep", "60"])
+        with self.assertRaises(subprocess.TimeoutExpired):
+            communicateWithRusage(process, timeout=0.1)
+        process.kill()
+        communicateWithRusage(process)
+        self.assertEqual(process.returncode, -9)
+
+    @TestStatus.shortLength
+    def testWriteAndReadMetrics(self):
+        metricsFile = os.path.join(self.tempDir, "metrics.jsonl")
+        os.environ["CACTUS_METRICS_FILE"] = metricsFile
+        records = [makeCallMetrics("tool%d" % i, "local", 0, time.time()) for i in range(3)]
+        stats = StreamStats("Input cigar file")
+        stats.update(b"a\nb\n")
+        records.append(makeStreamMetrics("tool0", stats))
+        for record in records:
+            writeCallMetrics(record)
+        self.assertEqual(readCallMetrics(metricsFile), records)
+
+        # Without a metrics file, records only go to the leader's log if
+        # asked for, whatever the job store
+        del os.environ["CACTUS_METRICS_FILE"]
+        class FileStore(object):
+            jobStore = type("JobStore", (object,), {"jobStoreDir": self.tempDir})()
+            def __init__(self):
+                self.messages = []
+            def logToMaster(self, message):
+                self.messages.append(message)
+        fileStore = FileStore()
+        writeCallMetrics(records[0], fileStore)
+        self.assertEqual(fileStore.messages, [])
+        os.environ["CACTUS_METRICS_LOG_TO_LEADER"] = "1"
+        writeCallMetrics(records[0], fileStore)
+        self.assertEqual(fileStore.messages, [LOG_PREFIX + json.dumps(records[0])])
+        self.assertEqual(sorted(os.listdir(self.tempDir)), ["metrics.jsonl"])
+
+        # Records can also be read back from a log
+        logFile = os.path.join(self.tempDir, "log.txt")
+        with open(logFile, 'w') as log:
+            log.write("some other line\n")
+            log.write("worker 12: " + LOG_PREFIX + '{"tool": "x"}\n')
+        self.assertEqual(readCallMetrics(logFile), [{"tool": "x"}])
+
+    @TestStatus.shortLength
+    def testMemoryEscalations(self):
+        os.environ["CACTUS_MEMORY_ESCALATIONS_FILE"] = os.path.join(self.tempDir, "escalations.jsonl")
+        self.assertEqual(escalatedMemory("CactusBarWrapper", "flowerGroupSize", 1000), None)
+        recordMemoryEscalation("CactusBarWrapper", "flowerGroupSize", 1000, 4000)
+        recordMemoryEscalation("CactusBarWrapper", "flowerGroupSize", 1500, 8000)
+        recordMemoryEscalation("CactusCafWrapper", "flowerGroupSize", 1000, 16000)
+        self.assertEqual(escalatedMemory("CactusBarWrapper", "flowerGroupSize", 1000), 8000)
+        self.assertEqual(escalatedMemory("CactusBarWrapper", "flowerGroupSize", 600), 4000)
+        self.assertEqual(escalatedMemory("CactusBarWrapper", "flowerGroupSize", 100), None)
+        self.assertEqual(escalatedMemory("CactusBarWrapper", "maxFlowerSize", 1000), None)
+
+        # Only the records added since the last lookup are read, and only once complete
+        with open(os.environ["CACTUS_MEMORY_ESCALATIONS_FILE"], 'a') as f:
+            f.write('{"job": "CactusBarWrapper", "feature": "flowerGroupSize", "value": 100, "memory": 2')
+        self.assertEqual(escalatedMemory("CactusBarWrapper", "flowerGroupSize", 100), None)
+        with open(os.environ["CACTUS_MEMORY_ESCALATIONS_FILE"], 'a') as f:
+            f.write('000}\n')
+        self.assertEqual(escalatedMemory("CactusBarWrapper", "flowerGroupSize", 100), 2000)
+        self.assertEqual(escalatedMemory("CactusBarWrapper", "flowerGroupSize", 1000), 8000)
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
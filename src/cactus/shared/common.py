@@ -14,6 +14,7 @@ import pathlib
 import pipes
 import uuid
 import json
+import pickle
 import time
 import signal
 import hashlib
@@ -21,7 +22,11 @@ import tempfile
 import math
 import threading
 import traceback
+import atexit
+import asyncio
+import functools
 import errno
+import psutil
 
 
 from urllib.parse import urlparse
@@ -37,6 +42,7 @@ from toil.realtimeLogger import RealtimeLogger
 from sonLib.bioio import popenCatch
 
 from cactus.shared.version import cactus_commit
+from cactus.shared.callMetrics import communicateWithRusage, makeCallMetrics, writeCallMetrics, ESCALATIONS_FILE_NAME
 
 _log = logging.getLogger(__name__)
 
@@ -863,7 +869,10 @@ def maxMemUsageOfContainer(containerInfo):
     # container, in a few different possible locations depending on
     # the distribution
     possibleLocations = ["/sys/fs/cgroup/memory/docker/%s/memory.max_usage_in_bytes",
-                         "/sys/fs/cgroup/memory/system.slice.docker-%s.scope/memory.max_usage_in_bytes"]
+                         "/sys/fs/cgroup/memory/system.slice.docker-%s.scope/memory.max_usage_in_bytes",
+                         # cgroup v2
+                         "/sys/fs/cgroup/system.slice/docker-%s.scope/memory.peak",
+                         "/sys/fs/cgroup/docker/%s/memory.peak"]
     possibleLocations = [s % containerInfo['id'] for s in possibleLocations]
     for location in possibleLocations:
         try:
@@ -980,6 +989,91 @@ def importSingularityImage(options):
         else:
             logger.info("Using pre-built singularity image: '{}'".format(imgPath))
 
+def singularityImageSandbox(tool):
+    """Get the cache directory of singularity images, and the sandbox
+    directory in it that the image of the tool is (or will be) cached in."""
+    # Problem: Multiple Singularity downloads sharing the same cache directory will
+    # not work correctly. See https://github.com/sylabs/singularity/issues/3634
+    # and https://github.com/sylabs/singularity/issues/4555.
+
+    # As a workaround, we have out own cache which we manage ourselves.
+    home_dir = str(pathlib.Path.home())
+    default_singularity_dir = os.path.join(home_dir, '.singularity')
+    cache_dir = os.path.join(os.environ.get('SINGULARITY_CACHEDIR',  default_singularity_dir), 'toil')
+
+    # hack to transform back to docker image
+    if tool == 'cactus':
+        tool = getDockerImage()
+    # not a url or local file? try it as a Docker specifier
+    if not tool.startswith('/') and '://' not in tool:
+        tool = 'docker://' + tool
+
+    # What name in the cache dir do we want?
+    # We cache everything as sandbox directories and not .sif files because, as
+    # laid out in https://github.com/sylabs/singularity/issues/4617, there
+    # isn't a way to run from a .sif file and have write permissions on system
+    # directories in the container, because the .sif build process makes
+    # everything owned by root inside the image. Since some toil-vg containers
+    # (like the R one) want to touch system files (to install R packages at
+    # runtime), we do it this way to act more like Docker.
+    #
+    # Also, only sandbox directories work with user namespaces, and only user
+    # namespaces work inside unprivileged Docker containers like the Toil
+    # appliance.
+    sandbox_dirname = os.path.join(cache_dir, '{}.sandbox'.format(hashlib.sha256(tool.encode('utf-8')).hexdigest()))
+    return cache_dir, sandbox_dirname
+
+def singularityImageMayNeedBuilding(tool='cactus'):
+    """Check if running the tool in singularity mode may mean building its
+    image first, on whichever node the job ends up on."""
+    if os.environ.get("CACTUS_BINARIES_MODE", "docker") != "singularity":
+        return False
+    return not (tool == 'cactus' and "CACTUS_SINGULARITY_IMG" in os.environ)
+
+def getSingularityImage(tool, work_dir, file_store=None):
+    """Get the local sandbox directory of a singularity image, building it
+    from the docker image if it isn't cached yet."""
+    cache_dir, sandbox_dirname = singularityImageSandbox(tool)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    if not os.path.exists(sandbox_dirname):
+        # We atomically drop the sandbox at that name when we get it
+
+        # Make a temp directory to be the sandbox
+        temp_sandbox_dirname = tempfile.mkdtemp(dir=cache_dir)
+
+        # Download with a fresh cache to a sandbox
+        download_env = os.environ.copy()
+        download_env['SINGULARITY_CACHEDIR'] = file_store.getLocalTempDir() if file_store else tempfile.mkdtemp(dir=work_dir)
+        build_cmd = ['singularity', 'build', '-s', '-F', temp_sandbox_dirname, tool]
+
+        cactus_realtime_log_info("Running the command: \"{}\"".format(' '.join(build_cmd)))
+        start_time = time.time()
+        subprocess.check_call(build_cmd, env=download_env)
+        run_time = time.time() - start_time
+        cactus_realtime_log_info("Successfully ran the command: \"{}\" in {} seconds".format(' '.join(build_cmd), run_time))
+
+        # Clean up the Singularity cache since it is single use
+        shutil.rmtree(download_env['SINGULARITY_CACHEDIR'])
+
+        try:
+            # This may happen repeatedly but it is atomic
+            os.rename(temp_sandbox_dirname, sandbox_dirname)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                # Can't rename a directory over another
+                # Make sure someone else has made the directory
+                assert os.path.exists(sandbox_dirname)
+                # Remove our redundant copy
+                shutil.rmtree(temp_sandbox_dirname)
+            else:
+                raise
+
+        # TODO: we could save some downloading by having one process download
+        # and the others wait, but then we would need a real fnctl locking
+        # system here.
+    return sandbox_dirname
+
 def singularityCommand(tool=None,
                        work_dir=None,
                        parameters=None,
@@ -1011,73 +1105,7 @@ def singularityCommand(tool=None,
         # Note that we target Singularity 3+.
         baseSingularityCall += ['-u', '-B', '{}:{}'.format(os.path.abspath(work_dir), '/mnt'), '--pwd', '/mnt']
 
-        # Problem: Multiple Singularity downloads sharing the same cache directory will
-        # not work correctly. See https://github.com/sylabs/singularity/issues/3634
-        # and https://github.com/sylabs/singularity/issues/4555.
-
-        # As a workaround, we have out own cache which we manage ourselves.
-        home_dir = str(pathlib.Path.home())
-        default_singularity_dir = os.path.join(home_dir, '.singularity')
-        cache_dir = os.path.join(os.environ.get('SINGULARITY_CACHEDIR',  default_singularity_dir), 'toil')
-        os.makedirs(cache_dir, exist_ok=True)
-
-        # hack to transform back to docker image
-        if tool == 'cactus':
-            tool = getDockerImage()
-        # not a url or local file? try it as a Docker specifier
-        if not tool.startswith('/') and '://' not in tool:
-            tool = 'docker://' + tool
-
-        # What name in the cache dir do we want?
-        # We cache everything as sandbox directories and not .sif files because, as
-        # laid out in https://github.com/sylabs/singularity/issues/4617, there
-        # isn't a way to run from a .sif file and have write permissions on system
-        # directories in the container, because the .sif build process makes
-        # everything owned by root inside the image. Since some toil-vg containers
-        # (like the R one) want to touch system files (to install R packages at
-        # runtime), we do it this way to act more like Docker.
-        #
-        # Also, only sandbox directories work with user namespaces, and only user
-        # namespaces work inside unprivileged Docker containers like the Toil
-        # appliance.
-        sandbox_dirname = os.path.join(cache_dir, '{}.sandbox'.format(hashlib.sha256(tool.encode('utf-8')).hexdigest()))
-
-        if not os.path.exists(sandbox_dirname):
-            # We atomically drop the sandbox at that name when we get it
-
-            # Make a temp directory to be the sandbox
-            temp_sandbox_dirname = tempfile.mkdtemp(dir=cache_dir)
-
-            # Download with a fresh cache to a sandbox
-            download_env = os.environ.copy()
-            download_env['SINGULARITY_CACHEDIR'] = file_store.getLocalTempDir() if file_store else tempfile.mkdtemp(dir=work_dir)
-            build_cmd = ['singularity', 'build', '-s', '-F', temp_sandbox_dirname, tool]
-
-            cactus_realtime_log_info("Running the command: \"{}\"".format(' '.join(build_cmd)))
-            start_time = time.time()
-            subprocess.check_call(build_cmd, env=download_env)
-            run_time = time.time() - start_time
-            cactus_realtime_log_info("Successfully ran the command: \"{}\" in {} seconds".format(' '.join(build_cmd), run_time))
-
-            # Clean up the Singularity cache since it is single use
-            shutil.rmtree(download_env['SINGULARITY_CACHEDIR'])
-
-            try:
-                # This may happen repeatedly but it is atomic
-                os.rename(temp_sandbox_dirname, sandbox_dirname)
-            except OSError as e:
-                if e.errno == errno.EEXIST:
-                    # Can't rename a directory over another
-                    # Make sure someone else has made the directory
-                    assert os.path.exists(sandbox_dirname)
-                    # Remove our redundant copy
-                    shutil.rmtree(temp_sandbox_dirname)
-                else:
-                    raise
-
-            # TODO: we could save some downloading by having one process download
-            # and the others wait, but then we would need a real fnctl locking
-            # system here.
+        sandbox_dirname = getSingularityImage(tool, work_dir, file_store)
         return baseSingularityCall + [sandbox_dirname] + parameters
 
 
@@ -1115,15 +1143,166 @@ def dockerCommand(tool=None,
     if rm:
         base_docker_call.append('--rm')
 
-    docker_tag = getDockerTag()
-    tool = "%s/%s:%s" % (dockstore, tool, docker_tag)
-    call = base_docker_call + [tool] + parameters
+    call = base_docker_call + [dockerToolImage(tool, dockstore)] + parameters
     return call, containerInfo
 
+def dockerToolImage(tool, dockstore):
+    return "%s/%s:%s" % (dockstore, tool, getDockerTag())
+
+# Containers that cactus_call runs commands in when
+# CACTUS_PERSISTENT_CONTAINERS is set, which are kept running until the
+# worker process exits: (mode, image, root) -> container or instance name
+_persistentContainers = {}
+_persistentContainersLock = threading.Lock()
+# Modes whose containers left behind by dead processes have been removed
+_reapedContainerModes = set()
+
+# Persistent containers are named after the process that owns them:
+# <prefix><pid>-<process start time>-<random>
+PERSISTENT_CONTAINER_PREFIX = "cactus-persistent-"
+
+# Seconds between checks of the container watchdogs for their owner
+CONTAINER_WATCHDOG_INTERVAL = 5
+
+# Run by the container watchdogs: wait for the process given by the first
+# argument to go, then run the command given by the rest
+_containerWatchdogScript = """
+import os, sys, time, subprocess
+pid, interval = int(sys.argv[1]), float(sys.argv[2])
+while True:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        break
+    except PermissionError:
+        pass
+    time.sleep(interval)
+subprocess.call(sys.argv[3:], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+"""
+
+def persistentContainerRoot(work_dir):
+    """Get the directory to mount in a persistent container to run a
+    command in work_dir, or None if persistent containers are off or
+    work_dir isn't under the root (CACTUS_PERSISTENT_CONTAINER_ROOT, or
+    the temp directory that Toil puts its working directories in by default).
+    """
+    if os.environ.get("CACTUS_PERSISTENT_CONTAINERS", "0") == "0":
+        return None
+    root = os.path.realpath(os.environ.get("CACTUS_PERSISTENT_CONTAINER_ROOT", tempfile.gettempdir()))
+    work_dir = os.path.realpath(work_dir)
+    if work_dir != root and not work_dir.startswith(root + os.sep):
+        return None
+    return root
+
+def processStartTime(pid):
+    """Get the start time of a process in whole seconds, which tells it
+    apart from later processes with the same pid, or None if it's gone."""
+    try:
+        return int(psutil.Process(pid).create_time())
+    except psutil.NoSuchProcess:
+        return None
+
+def persistentContainerName():
+    """Get a new name for a persistent container owned by this process."""
+    return "%s%d-%d-%s" % (PERSISTENT_CONTAINER_PREFIX, os.getpid(), processStartTime(os.getpid()),
+                           uuid.uuid4().hex[:8])
+
+def isStaleContainer(name):
+    """Is name that of a persistent container whose owner is gone?"""
+    if not name.startswith(PERSISTENT_CONTAINER_PREFIX):
+        return False
+    try:
+        pid, startTime = [int(field) for field in name[len(PERSISTENT_CONTAINER_PREFIX):].split("-")[:2]]
+    except ValueError:
+        return False
+    return processStartTime(pid) != startTime
+
+def stopContainerCommand(mode, name):
+    if mode == "docker":
+        return ['docker', 'rm', '--force', name]
+    return ['singularity', '-q', 'instance', 'stop', name]
+
+def reapStaleContainers(mode):
+    """Remove the persistent containers on this node whose owners died
+    without removing them."""
+    if mode == "docker":
+        list_call = ['docker', 'ps', '--all', '--filter', 'name=' + PERSISTENT_CONTAINER_PREFIX,
+                     '--format', '{{.Names}}']
+    else:
+        list_call = ['singularity', '-q', 'instance', 'list']
+    try:
+        output = subprocess.check_output(list_call, stderr=subprocess.DEVNULL, universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        _log.warning("Unable to list the %s containers to remove stale ones: %s" % (mode, e))
+        return
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) > 0 and isStaleContainer(fields[0]):
+            _log.info("Removing persistent container %s, whose owner is gone" % fields[0])
+            subprocess.call(stopContainerCommand(mode, fields[0]), stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+def startContainerWatchdog(pid, stop_call, interval=CONTAINER_WATCHDOG_INTERVAL):
+    """Start a process, in a session of its own, that runs stop_call once
+    process pid is gone, so that its container is removed even if the
+    process is killed before its atexit handlers can run."""
+    return subprocess.Popen([sys.executable, "-c", _containerWatchdogScript, str(pid), str(interval)] + stop_call,
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+
+def persistentContainerCommand(mode, image, root, work_dir, parameters, singularityVerb='exec'):
+    """Get the command that runs parameters in work_dir inside a long-lived
+    docker container or singularity instance of image, starting it if
+    this process hasn't already. root is mounted at the same path inside
+    the container, so work_dir and any paths under root are the same
+    inside and out.
+
+    The container is removed when this process exits, by an atexit
+    handler or, if the process is killed, by a watchdog. Containers left
+    by processes that died along with their watchdogs are removed before
+    the first container of a mode is started.
+    """
+    key = (mode, image, root)
+    with _persistentContainersLock:
+        name = _persistentContainers.get(key)
+        if name is None:
+            if mode not in _reapedContainerModes:
+                reapStaleContainers(mode)
+                _reapedContainerModes.add(mode)
+            name = persistentContainerName()
+            if mode == "docker":
+                start_call = ['docker', 'run', '--detach', '--rm', '--net=host', '--log-driver=none',
+                              '-u', '%s:%s' % (os.getuid(), os.getgid()),
+                              '-v', '{}:{}'.format(root, root), '--name', name,
+                              '--entrypoint', 'sleep', image, 'infinity']
+            else:
+                assert mode == "singularity"
+                start_call = ['singularity', '-q', 'instance', 'start', '-u',
+                              '-B', '{}:{}'.format(root, root), image, name]
+            _log.info("Starting persistent container %s" % name)
+            subprocess.check_call(start_call, stdout=subprocess.DEVNULL)
+            startContainerWatchdog(os.getpid(), stopContainerCommand(mode, name))
+            if len(_persistentContainers) == 0:
+                atexit.register(stopPersistentContainers)
+            _persistentContainers[key] = name
+    work_dir = os.path.realpath(work_dir)
+    if mode == "docker":
+        return ['docker', 'exec', '--interactive', '-u', '%s:%s' % (os.getuid(), os.getgid()),
+                '-w', work_dir, name] + parameters
+    return ['singularity', '-q', singularityVerb, '--pwd', work_dir, 'instance://' + name] + parameters
+
+def stopPersistentContainers():
+    """Stop the containers started by persistentContainerCommand."""
+    with _persistentContainersLock:
+        for (mode, image, root), name in _persistentContainers.items():
+            subprocess.call(stopContainerCommand(mode, name), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _persistentContainers.clear()
+
 def prepareWorkDir(work_dir, parameters):
     if not work_dir:
         # Make sure all the paths we're accessing are in the same directory
-        files = [par for par in parameters if os.path.isfile(par)]
+        # Anything that isn't a directory, so FIFOs are included
+        files = [par for par in parameters if os.path.exists(par) and not os.path.isdir(par)]
         folders = [par for par in parameters if os.path.isdir(par)]
         work_dirs = set([os.path.dirname(fileName) for fileName in files] + [os.path.dirname(folder) for folder in folders])
         _log.info("Work dirs: %s" % work_dirs)
@@ -1157,6 +1336,86 @@ def prepareWorkDir(work_dir, parameters):
         parameters = [adjustPath(par, work_dir) for par in parameters]
     return work_dir, parameters
 
+class MemoryMonitor(threading.Thread):
+    """Samples the max memory usage of the docker container of a command
+    run by cactus_call every interval seconds, from a background thread
+    so that the call itself can just wait for the command to exit.
+    """
+    def __init__(self, containerInfo, interval=10):
+        super(MemoryMonitor, self).__init__()
+        self.daemon = True
+        self.containerInfo = containerInfo
+        self.interval = interval
+        self.memUsage = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            updatedMemUsage = maxMemUsageOfContainer(self.containerInfo)
+            if updatedMemUsage is not None:
+                assert self.memUsage <= updatedMemUsage, "memory.max_usage_in_bytes should never decrease"
+                self.memUsage = updatedMemUsage
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class CactusOOMError(RuntimeError):
+    """Raised by cactus_call when its command was killed for running out of
+    memory."""
+    pass
+
+def jobCgroupPath():
+    """Get the cgroup (v2) directory of this process, if it belongs to this
+    job: the only processes in it and the cgroups under it are this
+    process, its ancestors (such as the batch system's wrappers around
+    the worker) and its descendants. Otherwise, such as when the workers
+    of a single machine run share the leader's cgroup, or if cgroup v2
+    isn't available, returns None."""
+    try:
+        with open("/proc/self/cgroup") as cgroupFile:
+            cgroups = [line.strip()[3:] for line in cgroupFile if line.startswith("0::")]
+        if not cgroups:
+            return None
+        cgroupPath = os.path.join("/sys/fs/cgroup", cgroups[0].lstrip("/"))
+        process = psutil.Process()
+        ownPids = set([process.pid] + [p.pid for p in process.parents()] +
+                      [p.pid for p in process.children(recursive=True)])
+        for dirPath, dirNames, fileNames in os.walk(cgroupPath):
+            if "cgroup.procs" in fileNames:
+                with open(os.path.join(dirPath, "cgroup.procs")) as procsFile:
+                    if any(int(pid) not in ownPids for pid in procsFile.read().split()):
+                        return None
+        return cgroupPath
+    except (IOError, ValueError, psutil.Error):
+        return None
+
+def oomKillCount(cgroupPath):
+    """Get the number of processes the OOM killer has killed in a cgroup
+    (v2) and the cgroups under it, or None if it isn't available."""
+    if cgroupPath is None:
+        return None
+    try:
+        with open(os.path.join(cgroupPath, "memory.events")) as eventsFile:
+            for line in eventsFile:
+                event, count = line.split()
+                if event == "oom_kill":
+                    return int(count)
+    except (IOError, ValueError):
+        pass
+    return None
+
+def isOOMKill(returnCode, oomKillsBefore, oomKillsAfter):
+    """Was a command that exited with returnCode killed for running out of
+    memory? It must have got a SIGKILL (directly, or from the exit status
+    of a shell or container around it) while the OOM killer went from
+    oomKillsBefore to oomKillsAfter kills in the job's own cgroup. Without
+    the counts, a SIGKILL could have come from anywhere, so it isn't
+    taken as one."""
+    if returnCode not in (-signal.SIGKILL, 128 + signal.SIGKILL):
+        return False
+    return oomKillsBefore is not None and oomKillsAfter is not None and oomKillsAfter > oomKillsBefore
+
 def cactus_call(tool=None,
                 work_dir=None,
                 parameters=None,
@@ -1183,6 +1442,11 @@ def cactus_call(tool=None,
     if tool is None:
         tool = "cactus"
 
+    if (len(parameters) > 0) and isinstance(parameters[0], list):
+        toolName = ' | '.join(p[0] for p in parameters if len(p) > 0)
+    else:
+        toolName = parameters[0] if len(parameters) > 0 else None
+
     entrypoint = None
     if (len(parameters) > 0) and isinstance(parameters[0], list):
         # We have a list of lists, which is the convention for commands piped into one another.
@@ -1199,7 +1463,16 @@ def cactus_call(tool=None,
     if mode in ("docker", "singularity"):
         work_dir, parameters = prepareWorkDir(work_dir, parameters)
 
-    if mode == "docker":
+    # Servers and containers that are kept around get containers of their own
+    persistentRoot = None
+    if mode in ("docker", "singularity") and rm and not server and port is None:
+        persistentRoot = persistentContainerRoot(work_dir)
+
+    containerInfo = None
+    if mode == "docker" and persistentRoot is not None:
+        call = persistentContainerCommand(mode, dockerToolImage(tool, dockstore), persistentRoot, work_dir,
+                                          [entrypoint or '/opt/cactus/wrapper.sh'] + parameters)
+    elif mode == "docker":
         call, containerInfo = dockerCommand(tool=tool,
                                             work_dir=work_dir,
                                             parameters=parameters,
@@ -1207,6 +1480,13 @@ def cactus_call(tool=None,
                                             port=port,
                                             dockstore=dockstore,
                                             entrypoint=entrypoint)
+    elif mode == "singularity" and persistentRoot is not None:
+        if "CACTUS_SINGULARITY_IMG" in os.environ:
+            call = persistentContainerCommand(mode, os.environ["CACTUS_SINGULARITY_IMG"], persistentRoot, work_dir,
+                                              parameters, singularityVerb='run')
+        else:
+            call = persistentContainerCommand(mode, getSingularityImage(tool, work_dir, fileStore), persistentRoot,
+                                              work_dir, parameters)
     elif mode == "singularity":
         call = singularityCommand(tool=tool, work_dir=work_dir,
                                   parameters=parameters, port=port, file_store=fileStore)
@@ -1236,28 +1516,28 @@ def cactus_call(tool=None,
     if server:
         return process
 
-    memUsage = 0
-    first_run = True
     start_time = time.time()
-    output = stderr = None  # used later to report errors
-    while True:
-        try:
-            # Wait a bit to see if the process is done
-            output, stderr = process.communicate(stdin_string if first_run else None, timeout=10)
-        except subprocess.TimeoutExpired:
-            if mode == "docker":
-                # Every so often, check the memory usage of the container
-                updatedMemUsage = maxMemUsageOfContainer(containerInfo)
-                if updatedMemUsage is not None:
-                    assert memUsage <= updatedMemUsage, "memory.max_usage_in_bytes should never decrease"
-                    memUsage = updatedMemUsage
-            first_run = False
-            if soft_timeout is not None and time.time() - start_time > soft_timeout:
-                # Soft timeout has been triggered. Just return early.
-                process.send_signal(signal.SIGINT)
-                return None
-        else:
-            break
+    cgroupPath = jobCgroupPath()
+    oomKillsBefore = oomKillCount(cgroupPath)
+    memoryMonitor = None
+    if containerInfo is not None:
+        # Only containers of our own can be sampled
+        memoryMonitor = MemoryMonitor(containerInfo)
+        memoryMonitor.start()
+    try:
+        # Returns as soon as the process exits
+        output, stderr, rusage = communicateWithRusage(process, stdin_string, timeout=soft_timeout)
+    except subprocess.TimeoutExpired:
+        # Soft timeout has been triggered. Just return early.
+        process.send_signal(signal.SIGINT)
+        return None
+    finally:
+        if memoryMonitor is not None:
+            memoryMonitor.stop()
+    memUsage = memoryMonitor.memUsage if memoryMonitor is not None else 0
+    writeCallMetrics(makeCallMetrics(toolName, mode, process.returncode, start_time,
+                                     rusage=rusage, containerMemory=memUsage,
+                                     jobName=job_name, features=features), fileStore)
     if mode == "docker" and job_name is not None and features is not None and fileStore is not None:
         # Log a datapoint for the memory usage for these features.
         fileStore.logToMaster("Max memory used for job %s (tool %s) "
@@ -1275,6 +1555,8 @@ def cactus_call(tool=None,
         out = "stdout={}".format(output)
         if swallowStdErr:
             out += ", stderr={}".format(stderr)
+        if isOOMKill(process.returncode, oomKillsBefore, oomKillCount(cgroupPath)):
+            raise CactusOOMError("Command {} was killed for running out of memory (exit {}): {}".format(call, process.returncode, out))
         if process.returncode > 0:
             raise RuntimeError("Command {} exited {}: {}".format(call, process.returncode, out))
         else:
@@ -1283,6 +1565,25 @@ def cactus_call(tool=None,
     if check_output:
         return output
 
+async def cactus_call_async(**kwargs):
+    """Awaitable version of cactus_call (taking the same keyword arguments),
+    which runs the command from a thread so that several can run at once.
+    The command isn't started until it is awaited."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(cactus_call, **kwargs))
+
+def gather_cactus_calls(calls, cores=1):
+    """Run the awaitables made by cactus_call_async, with at most cores
+    running at once (pass the job's cores), returning their results in
+    order. Raises the first error any of them raised."""
+    async def gatherCalls():
+        semaphore = asyncio.Semaphore(max(1, int(cores)))
+        async def runCall(call):
+            async with semaphore:
+                return await call
+        return await asyncio.gather(*[runCall(call) for call in calls])
+    return asyncio.run(gatherCalls())
+
 class RunAsFollowOn(Job):
     def __init__(self, job, *args, **kwargs):
         Job.__init__(self, cores=0.1, memory=100000000, preemptable=True)
@@ -1293,6 +1594,29 @@ class RunAsFollowOn(Job):
     def run(self, fileStore):
         return self.addFollowOn(self.job(*self._args, **self._kwargs)).rv()
 
+def resourceRoundingSteps():
+    """Get the number of geometric buckets per doubling that RoundedJob rounds
+    memory and disk to, or 0 to round to multiples of its roundingAmount."""
+    return int(os.environ.get("CACTUS_RESOURCE_ROUNDING", 0))
+
+def setResourceRounding(configNode):
+    """Set the rounding of job requirements from the resourceRounding
+    constant in the config, unless CACTUS_RESOURCE_ROUNDING is already set.
+    Set before starting the workflow, so that Toil passes it to the workers."""
+    constantsNode = configNode.find("constants")
+    stepsPerDoubling = getOptionalAttrib(constantsNode, "resourceRounding", int, default=None)
+    if stepsPerDoubling is not None and "CACTUS_RESOURCE_ROUNDING" not in os.environ:
+        os.environ["CACTUS_RESOURCE_ROUNDING"] = str(stepsPerDoubling)
+
+def setMemoryEscalationsFile(jobStoreLocator):
+    """Record the memory escalations of jobs that ran out of it (see
+    cactus.shared.callMetrics) in a file job store's directory, unless
+    CACTUS_MEMORY_ESCALATIONS_FILE is already set. Set before starting or
+    restarting the workflow, so that Toil passes it to the workers."""
+    jobStoreType, jobStorePath = Toil.parseLocator(jobStoreLocator)
+    if jobStoreType == "file" and "CACTUS_MEMORY_ESCALATIONS_FILE" not in os.environ:
+        os.environ["CACTUS_MEMORY_ESCALATIONS_FILE"] = os.path.join(os.path.abspath(jobStorePath), ESCALATIONS_FILE_NAME)
+
 class RoundedJob(Job):
     """Thin wrapper around Toil.Job to round up resource requirements.
 
@@ -1304,32 +1628,48 @@ class RoundedJob(Job):
     """
     # Default rounding amount: 100 MiB
     roundingAmount = 100*1024*1024
+    # Space to build a singularity image in
+    singularityBuildDisk = 1500*1024*1024
     def __init__(self, memory=None, cores=None, disk=None, preemptable=None,
                  unitName=None, checkpoint=False):
         if memory is not None:
             memory = self.roundUp(memory)
         if disk is not None:
-            # hack: we may need extra space to cook up a singularity image on the fly
-            #       so we add it (1.5G) here.
-            # todo: only do this when needed
-            disk = 1500*1024*1024 + self.roundUp(disk)
+            disk = self.roundUp(disk)
+            if singularityImageMayNeedBuilding():
+                # we may need extra space to cook up a singularity image on the fly
+                disk += self.singularityBuildDisk
         super(RoundedJob, self).__init__(memory=memory, cores=cores, disk=disk,
                                          preemptable=preemptable, unitName=unitName,
                                          checkpoint=checkpoint)
 
     def roundUp(self, bytesRequirement):
         """
-        Round the amount up to the next self.roundingAmount.
+        Round the amount up to the next self.roundingAmount or, if
+        CACTUS_RESOURCE_ROUNDING (the resourceRounding constant in the
+        config) is a number of steps per doubling, to the next geometric
+        bucket above self.roundingAmount, so that there are only a few
+        buckets however large the requirements get.
 
         >>> j = RoundedJob()
         >>> j.roundingAmount = 100000000
         >>> j.roundUp(1000)
-        10000000
+        100000000
         >>> j.roundUp(200000000)
         200000000
         >>> j.roundUp(200000001)
         300000000
         """
+        stepsPerDoubling = resourceRoundingSteps()
+        if stepsPerDoubling > 0:
+            if bytesRequirement <= self.roundingAmount:
+                return self.roundingAmount
+            step = math.floor(stepsPerDoubling * math.log2(bytesRequirement / self.roundingAmount))
+            while True:
+                bucket = int(math.ceil(self.roundingAmount * 2 ** (step / stepsPerDoubling)))
+                if bucket >= bytesRequirement:
+                    return bucket
+                step += 1
         if bytesRequirement % self.roundingAmount == 0:
             return bytesRequirement
         return (bytesRequirement // self.roundingAmount + 1) * self.roundingAmount
@@ -1354,19 +1694,88 @@ def readGlobalFileWithoutCache(fileStore, jobStoreID):
     fileStore.jobStore.readFile(jobStoreID, f)
     return f
 
+def splitEvenly(items, numParts):
+    """Split items into at most numParts consecutive lists, whose lengths
+    differ by at most one."""
+    numParts = min(numParts, len(items))
+    parts = []
+    start = 0
+    for i in range(numParts):
+        end = start + len(items) // numParts + (1 if i < len(items) % numParts else 0)
+        parts.append(items[start:end])
+        start = end
+    return parts
+
+class ChildBatchResults(list):
+    """The return values of a batch of children added by
+    ChildTreeJob.addChildBatch, or of subtrees of batches."""
+    pass
+
+def flattenChildResults(results):
+    """Get the list of return values of the children from the (resolved)
+    return value of ChildTreeJob.addChildBatch, in the order they were
+    added. A list of return values that aren't from addChildBatch is
+    returned as is."""
+    flattened = []
+    for result in results:
+        if isinstance(result, ChildBatchResults):
+            flattened += flattenChildResults(result)
+        else:
+            flattened.append(result)
+    return flattened
+
+class ChildBatchJob(RoundedJob):
+    """Adds the children written to the job store by
+    ChildTreeJob.addChildBatch: either one batch of them, or a balanced
+    tree of jobs that add the given batches."""
+    # Memory of a job adding one batch: unpickled jobs take several times
+    # their pickled size, and Toil pickles them again as they are added
+    batchMemoryFactor = 10
+    minBatchMemory = 2*1024*1024*1024
+    def __init__(self, batchIDs=None, maxChildrenPerJob=20):
+        self.batchIDs = batchIDs
+        self.maxChildrenPerJob = maxChildrenPerJob
+        # Toil's defaults, for jobs that only add other ChildBatchJobs
+        memory = None
+        disk = None
+        if batchIDs is not None and len(batchIDs) == 1:
+            memory = max(self.minBatchMemory, self.batchMemoryFactor * batchIDs[0].size)
+            disk = RoundedJob.roundingAmount + batchIDs[0].size
+        super(ChildBatchJob, self).__init__(memory=memory, disk=disk, preemptable=True)
+
+    def run(self, fileStore):
+        if len(self.batchIDs) == 1 and self.maxChildrenPerJob is None:
+            with open(fileStore.readGlobalFile(self.batchIDs[0]), 'rb') as batchFile:
+                jobs = pickle.load(batchFile)
+            fileStore.deleteGlobalFile(self.batchIDs[0])
+            return ChildBatchResults([self.addChild(job).rv() for job in jobs])
+        results = ChildBatchResults()
+        for batchIDs in splitEvenly(self.batchIDs, self.maxChildrenPerJob):
+            maxChildrenPerJob = None if len(batchIDs) == 1 else self.maxChildrenPerJob
+            results.append(self.addChild(ChildBatchJob(batchIDs, maxChildrenPerJob)).rv())
+        return results
+
 class ChildTreeJob(RoundedJob):
     """Spreads the child-job initialization work among multiple jobs.
 
     Jobs with many children can often be a bottleneck (because they
     are written serially into the jobStore in a consistent-write
     fashion). Subclasses of this job will automatically spread out
-    that work amongst a tree of jobs, increasing the total work done
+    that work amongst a balanced tree of jobs, each with at most
+    maxChildrenPerJob children, increasing the total work done
     slightly, but reducing the wall-clock time taken dramatically.
+
+    Children whose return values are only needed together can instead be
+    added with addChildBatch, which writes them to the job store in
+    batches of childBatchSize, for the jobs of the tree to add. Then only
+    the batches, and not every child, are written by this job.
     """
     def __init__(self, memory=None, cores=None, disk=None, preemptable=None,
-                 unitName=None, checkpoint=False, maxChildrenPerJob=20):
+                 unitName=None, checkpoint=False, maxChildrenPerJob=20, childBatchSize=0):
         self.queuedChildJobs = []
+        self.queuedChildBatches = []
         self.maxChildrenPerJob = maxChildrenPerJob
+        self.childBatchSize = childBatchSize
         super(ChildTreeJob, self).__init__(memory=memory, cores=cores, disk=disk,
                                            preemptable=preemptable, unitName=unitName,
                                            checkpoint=checkpoint)
@@ -1375,54 +1784,50 @@ class ChildTreeJob(RoundedJob):
         self.queuedChildJobs.append(job)
         return job
 
+    def addChildBatch(self, jobs):
+        """Add the jobs as children, returning their return values (as a
+        promise, if they are batched), to be passed through
+        flattenChildResults once resolved. rv() mustn't be called on the
+        jobs themselves.
+        """
+        if self.childBatchSize <= 0 or len(jobs) <= self.maxChildrenPerJob:
+            return [self.addChild(job).rv() for job in jobs]
+        # The batches are written once this job has run
+        fanOutJob = ChildBatchJob(maxChildrenPerJob=self.maxChildrenPerJob)
+        super(ChildTreeJob, self).addChild(fanOutJob)
+        self.queuedChildBatches.append((fanOutJob, jobs))
+        return fanOutJob.rv()
+
+    def _addChildTree(self, parentJob, childJobs):
+        """Add the children under parentJob, through a balanced tree of
+        empty jobs if there are too many of them."""
+        addChild = super(ChildTreeJob, self).addChild if parentJob is self else parentJob.addChild
+        if len(childJobs) <= self.maxChildrenPerJob:
+            for childJob in childJobs:
+                addChild(childJob)
+            return
+        for subtreeJobs in splitEvenly(childJobs, self.maxChildrenPerJob):
+            if len(subtreeJobs) == 1:
+                addChild(subtreeJobs[0])
+            else:
+                # These only add their children, which takes no more than
+                # Toil's default memory
+                subtreeRoot = RoundedJob(disk=RoundedJob.roundingAmount, preemptable=True)
+                addChild(subtreeRoot)
+                self._addChildTree(subtreeRoot, subtreeJobs)
+
     def _run(self, jobGraph, fileStore):
         ret = super(ChildTreeJob, self)._run(jobGraph, fileStore)
-        if len(self.queuedChildJobs) <= self.maxChildrenPerJob:
-            # The number of children is small enough that we can just
-            # add them directly.
-            for childJob in self.queuedChildJobs:
-                super(ChildTreeJob, self).addChild(childJob)
-        else:
-            # Too many children, so we have to build a tree to avoid
-            # bottlenecking on consistently serializing all the jobs.
-
-            # compute the number of levels (after root) of our job tree
-            num_levels = math.floor(math.log(len(self.queuedChildJobs), self.maxChildrenPerJob))
-
-            # fill out all the internal nodes of the tree, where the root is self
-            # they will be empty RoundedJobs
-            prev_level = [self]
-            level = []
-            for i in range(num_levels):
-                for parent_job in prev_level:
-                    # with this check, we allow a partial split of the last level
-                    # to account for rounding
-                    if len(level) * self.maxChildrenPerJob < len(self.queuedChildJobs):
-                        for j in range(self.maxChildrenPerJob):
-                            child_job = RoundedJob()
-                            if parent_job is self:
-                                super(ChildTreeJob, self).addChild(child_job)
-                            else:
-                                parent_job.addChild(child_job)
-                            level.append(child_job)
-                    else:
-                        level.append(parent_job)
-
-                prev_level = level
-                level = []
-
-            # add the leaves.  these will be the jobs in self.queuedChildJobs
-            leaves_added = 0
-            for parent_job in prev_level:
-                num_children = min(len(self.queuedChildJobs) - leaves_added, self.maxChildrenPerJob)
-                for j in range(num_children):
-                    if parent_job is self:
-                        super(ChildTreeJob, self).addChild(self.queuedChildJobs[leaves_added])
-                    else:
-                        parent_job.addChild(self.queuedChildJobs[leaves_added])
-                    leaves_added += 1
-            assert leaves_added == len(self.queuedChildJobs)
-
+        # Too many children are bottlenecked on consistently serializing all
+        # the jobs, so build a tree of jobs to add them.
+        self._addChildTree(self, self.queuedChildJobs)
+        for fanOutJob, jobs in self.queuedChildBatches:
+            fanOutJob.batchIDs = []
+            for batchJobs in [jobs[i:i + self.childBatchSize] for i in range(0, len(jobs), self.childBatchSize)]:
+                batchFile = fileStore.getLocalTempFile()
+                with open(batchFile, 'wb') as batchFileHandle:
+                    pickle.dump(batchJobs, batchFileHandle, pickle.HIGHEST_PROTOCOL)
+                fanOutJob.batchIDs.append(fileStore.writeGlobalFile(batchFile))
         return ret
 
 def dumpStacksHandler(signal, frame):
@@ -1,5 +1,8 @@
 import os
+import sys
+import time
 import shutil
+import subprocess
 import unittest
 from base64 import b64encode
 
@@ -11,7 +14,12 @@ from toil.job import Job
 from toil.common import Toil
 from cactus.shared.common import encodeFlowerNames, decodeFirstFlowerName, \
                                  runCactusSplitFlowersBySecondaryGrouping, \
-                                 cactus_call, ChildTreeJob
+                                 cactus_call, ChildTreeJob, RoundedJob, \
+                                 splitEvenly, flattenChildResults, \
+                                 cactus_call_async, gather_cactus_calls, CactusOOMError, isOOMKill, \
+                                 persistentContainerRoot, persistentContainerCommand, persistentContainerName, \
+                                 stopPersistentContainers, isStaleContainer, startContainerWatchdog, \
+                                 PERSISTENT_CONTAINER_PREFIX
 
 class TestCase(unittest.TestCase):
     def setUp(self):
@@ -88,6 +96,144 @@ class TestCase(unittest.TestCase):
                              check_output=True)
         self.assertEqual(output, 'quuxbazbar\n')
 
+    @TestStatus.shortLength
+    def testCactusCallOOM(self):
+        # Only a SIGKILL along with an OOM kill in the job's own cgroup is one
+        self.assertTrue(isOOMKill(-9, 0, 1))
+        self.assertTrue(isOOMKill(137, 0, 1))
+        self.assertFalse(isOOMKill(-9, None, None))
+        self.assertFalse(isOOMKill(-9, 1, 1))
+        self.assertFalse(isOOMKill(1, 0, 1))
+        # A SIGKILL from anything else isn't
+        for parameters in [[['cat', '/dev/null'], ['bash', '-c', 'kill -9 $$']], ['false']]:
+            with self.assertRaises(RuntimeError) as context:
+                cactus_call(parameters=parameters)
+            self.assertFalse(isinstance(context.exception, CactusOOMError))
+
+    @TestStatus.shortLength
+    def testGatherCactusCalls(self):
+        inputFiles = []
+        for i in range(4):
+            inputFiles.append(getTempFile(rootDir=self.tempDir))
+            with open(inputFiles[-1], 'w') as f:
+                f.write('foo%d\n' % i)
+        outputs = gather_cactus_calls([cactus_call_async(parameters=[['cat', inputFile], ['sed', 's/foo/baz/g']],
+                                                         check_output=True)
+                                       for inputFile in inputFiles], cores=2)
+        self.assertEqual(outputs, ['baz%d\n' % i for i in range(4)])
+
+    @TestStatus.shortLength
+    def testPersistentContainerRoot(self):
+        oldEnviron = dict(os.environ)
+        try:
+            os.environ.pop("CACTUS_PERSISTENT_CONTAINERS", None)
+            self.assertEqual(persistentContainerRoot(self.tempDir), None)
+            os.environ["CACTUS_PERSISTENT_CONTAINERS"] = "1"
+            os.environ["CACTUS_PERSISTENT_CONTAINER_ROOT"] = self.tempDir
+            root = os.path.realpath(self.tempDir)
+            workDir = os.path.join(self.tempDir, "work")
+            os.mkdir(workDir)
+            self.assertEqual(persistentContainerRoot(self.tempDir), root)
+            self.assertEqual(persistentContainerRoot(workDir), root)
+            # Directories outside the root get containers of their own,
+            # even if their names start with the root's
+            self.assertEqual(persistentContainerRoot(self.tempDir + "2"), None)
+            self.assertEqual(persistentContainerRoot(os.path.dirname(root)), None)
+        finally:
+            os.environ.clear()
+            os.environ.update(oldEnviron)
+
+    @TestStatus.shortLength
+    def testStaleContainers(self):
+        deadProcess = subprocess.Popen([sys.executable, "-c", ""])
+        deadProcess.wait()
+        self.assertTrue(isStaleContainer("%s%d-0-abc" % (PERSISTENT_CONTAINER_PREFIX, deadProcess.pid)))
+        self.assertFalse(isStaleContainer(persistentContainerName()))
+        # The pid has been reused by another process
+        self.assertTrue(isStaleContainer("%s%d-0-abc" % (PERSISTENT_CONTAINER_PREFIX, os.getpid())))
+        # Other containers are left alone
+        self.assertFalse(isStaleContainer("cactus-1234"))
+        self.assertFalse(isStaleContainer(PERSISTENT_CONTAINER_PREFIX + "x-y-z"))
+
+    @TestStatus.shortLength
+    def testPersistentContainerReuse(self):
+        # A docker that logs its commands, and lists the containers in a file
+        binDir = os.path.join(self.tempDir, "bin")
+        os.mkdir(binDir)
+        dockerLog = os.path.join(self.tempDir, "docker.log")
+        containersFile = os.path.join(self.tempDir, "containers")
+        with open(os.path.join(binDir, "docker"), 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> %s\nif [ "$1" = ps ]; then cat %s; fi\n' % (dockerLog, containersFile))
+        os.chmod(os.path.join(binDir, "docker"), 0o755)
+        deadProcess = subprocess.Popen([sys.executable, "-c", ""])
+        deadProcess.wait()
+        staleName = "%s%d-0-abc" % (PERSISTENT_CONTAINER_PREFIX, deadProcess.pid)
+        liveName = persistentContainerName()
+        with open(containersFile, 'w') as f:
+            f.write("%s\n%s\nsomething-else\n" % (staleName, liveName))
+
+        oldPath = os.environ["PATH"]
+        try:
+            os.environ["PATH"] = binDir + os.pathsep + oldPath
+            root = os.path.realpath(self.tempDir)
+            call1 = persistentContainerCommand("docker", "image1", root, self.tempDir, ["echo", "1"])
+            call2 = persistentContainerCommand("docker", "image1", root, self.tempDir, ["echo", "2"])
+            call3 = persistentContainerCommand("docker", "image2", root, self.tempDir, ["echo", "3"])
+            # Calls with the same image run in the same container
+            self.assertEqual(call1[:-1], call2[:-1])
+            self.assertNotEqual(call1[:-2], call3[:-2])
+            self.assertEqual(call1[-2:], ["echo", "1"])
+            names = [call1[-3], call3[-3]]
+            stopPersistentContainers()
+        finally:
+            os.environ["PATH"] = oldPath
+        with open(dockerLog) as f:
+            commands = [line.split() for line in f]
+        # Only the container of the dead process is removed on startup, and
+        # only once
+        self.assertEqual([command for command in commands if command[0] == "ps"][0][:2], ["ps", "--all"])
+        self.assertEqual(len([command for command in commands if command[0] == "ps"]), 1)
+        removed = [command[-1] for command in commands if command[0] == "rm"]
+        self.assertEqual(removed, [staleName] + names)
+        self.assertEqual([command[-2] for command in commands if command[0] == "run"], ["image1", "image2"])
+
+    @TestStatus.shortLength
+    def testContainerWatchdog(self):
+        owner = subprocess.Popen(["sleep", "60"])
+        flagFile = os.path.join(self.tempDir, "stopped")
+        watchdog = startContainerWatchdog(owner.pid, ["touch", flagFile], interval=0.1)
+        time.sleep(0.5)
+        self.assertFalse(os.path.exists(flagFile))
+        owner.kill()
+        owner.wait()
+        self.assertEqual(watchdog.wait(10), 0)
+        self.assertTrue(os.path.exists(flagFile))
+
+    @TestStatus.shortLength
+    def testRoundUp(self):
+        job = RoundedJob()
+        oldRounding = os.environ.get("CACTUS_RESOURCE_ROUNDING")
+        try:
+            os.environ["CACTUS_RESOURCE_ROUNDING"] = "0"
+            self.assertEqual(job.roundUp(1), job.roundingAmount)
+            self.assertEqual(job.roundUp(2 * job.roundingAmount + 1), 3 * job.roundingAmount)
+
+            os.environ["CACTUS_RESOURCE_ROUNDING"] = "4"
+            self.assertEqual(job.roundUp(1), job.roundingAmount)
+            self.assertEqual(job.roundUp(2 * job.roundingAmount), 2 * job.roundingAmount)
+            buckets = set()
+            for requirement in range(10**7, 10**12, 10**7):
+                bucket = job.roundUp(requirement)
+                self.assertTrue(requirement <= bucket <= max(requirement * 2 ** 0.25 + 1, job.roundingAmount))
+                buckets.add(bucket)
+            # Four buckets per doubling from 100 MiB to 1 TB
+            self.assertTrue(len(buckets) <= 4 * 14)
+        finally:
+            if oldRounding is None:
+                del os.environ["CACTUS_RESOURCE_ROUNDING"]
+            else:
+                os.environ["CACTUS_RESOURCE_ROUNDING"] = oldRounding
+
     @TestStatus.mediumLength
     def testChildTreeJob(self):
         """Check that the ChildTreeJob class runs all children."""
@@ -105,6 +251,29 @@ class TestCase(unittest.TestCase):
             self.assertTrue(os.path.exists(os.path.join(flagDir, str(i))))
         shutil.rmtree(flagDir)
 
+    @TestStatus.shortLength
+    def testSplitEvenly(self):
+        self.assertEqual(splitEvenly(list(range(7)), 3), [[0, 1, 2], [3, 4], [5, 6]])
+        self.assertEqual(splitEvenly([0, 1], 3), [[0], [1]])
+
+    @TestStatus.mediumLength
+    def testChildTreeJobBatches(self):
+        """Check that children added in batches all run, and their return
+        values come back in order."""
+        numChildren = 100
+        flagDir = getTempDirectory()
+
+        options = Job.Runner.getDefaultOptions(getTempDirectory())
+        shutil.rmtree(options.jobStore)
+
+        with Toil(options) as toil:
+            results = toil.start(CTTestBatchParent(flagDir, numChildren))
+
+        self.assertEqual(results, list(range(numChildren)))
+        for i in range(numChildren):
+            self.assertTrue(os.path.exists(os.path.join(flagDir, str(i))))
+        shutil.rmtree(flagDir)
+
 class CTTestParent(ChildTreeJob):
     def __init__(self, flagDir, numChildren):
         self.flagDir = flagDir
@@ -115,6 +284,24 @@ class CTTestParent(ChildTreeJob):
         for i in range(self.numChildren):
             self.addChild(CTTestChild(self.flagDir, i))
 
+class CTTestBatchParent(ChildTreeJob):
+    def __init__(self, flagDir, numChildren):
+        self.flagDir = flagDir
+        self.numChildren = numChildren
+        super(CTTestBatchParent, self).__init__(maxChildrenPerJob=3, childBatchSize=7)
+
+    def run(self, fileStore):
+        results = self.addChildBatch([CTTestChild(self.flagDir, i) for i in range(self.numChildren)])
+        return self.addFollowOn(CTTestFlatten(results)).rv()
+
+class CTTestFlatten(Job):
+    def __init__(self, results):
+        self.results = results
+        super(CTTestFlatten, self).__init__()
+
+    def run(self, fileStore):
+        return flattenChildResults(self.results)
+
 class CTTestChild(Job):
     def __init__(self, flagDir, index):
         self.flagDir = flagDir
@@ -127,6 +314,7 @@ class CTTestChild(Job):
         with open(path, 'w') as f:
             # Empty file
             f.write('')
+        return self.index
 
 if __name__ == '__main__':
     unittest.main()
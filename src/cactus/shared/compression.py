@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Codecs used to compress the files (such as sequence chunks, alignments
+and DB snapshots) that are passed between jobs through the job store.
+
+gzip is always available. zstd and lz4 need the zstandard and lz4
+python packages to be installed (the zstd and lz4 extras of the package).
+"""
+import io
+import gzip
+import shutil
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+class Codec(object):
+    """Base codec, which leaves files as they are."""
+    name = "none"
+    suffix = ""
+    # Rough upper estimate of how much a FASTA or cigar file shrinks,
+    # used to guess resource requirements from compressed sizes
+    ratio = 1
+
+    def open(self, path, mode='rb'):
+        """Open a file in binary mode, compressing or decompressing on the fly."""
+        return open(path, mode)
+
+    def openText(self, path, mode='r'):
+        """Open a file in text mode, compressing or decompressing on the fly."""
+        return io.TextIOWrapper(self.open(path, mode[0] + 'b'))
+
+    def compressFile(self, inputFile, outputFile):
+        with open(inputFile, 'rb') as inFile, self.open(outputFile, 'wb') as outFile:
+            shutil.copyfileobj(inFile, outFile, 1024*1024)
+
+    def decompressFile(self, inputFile, outputFile):
+        with self.open(inputFile, 'rb') as inFile, open(outputFile, 'wb') as outFile:
+            shutil.copyfileobj(inFile, outFile, 1024*1024)
+
+    def compress(self, data):
+        """Compress a bytes object."""
+        return data
+
+    def decompress(self, data):
+        return data
+
+class GzipCodec(Codec):
+    name = "gzip"
+    suffix = ".gz"
+    ratio = 4
+
+    def open(self, path, mode='rb'):
+        return gzip.open(path, mode, compresslevel=1)
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=1)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+class Lz4Codec(Codec):
+    name = "lz4"
+    suffix = ".lz4"
+    ratio = 3
+
+    def open(self, path, mode='rb'):
+        return lz4.frame.open(path, mode)
+
+    def compress(self, data):
+        return lz4.frame.compress(data)
+
+    def decompress(self, data):
+        return lz4.frame.decompress(data)
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    suffix = ".zst"
+    ratio = 5
+
+    def open(self, path, mode='rb'):
+        if 'w' in mode:
+            # Compress on all the available cores
+            return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=3, threads=-1))
+        return zstandard.open(path, mode)
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=3).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+codecs = { "none" : (Codec, True),
+           "gzip" : (GzipCodec, True),
+           "lz4" : (Lz4Codec, lz4 is not None),
+           "zstd" : (ZstdCodec, zstandard is not None) }
+
+def availableCodecs():
+    """Get the names of the codecs that actually compress and are installed."""
+    return [name for name, (codec, available) in codecs.items() if available and name != "none"]
+
+def getCodec(name):
+    """Get a codec by name, raising a RuntimeError if it isn't known or its
+    library isn't installed."""
+    if name is None:
+        name = "none"
+    if name not in codecs:
+        raise RuntimeError("Unknown compression codec '%s', expected one of %s" % (name, ", ".join(codecs)))
+    codec, available = codecs[name]
+    if not available:
+        raise RuntimeError("The python package for the %s compression codec isn't installed. "
+                           "Install cactus with the %s extra, eg pip install .[%s]" % (name, name, name))
+    return codec()
+
+def writeGlobalFileCompressed(fileStore, path, codec, cleanup=False):
+    """Write a file to the file store, compressed with the given codec."""
+    if codec.name == "none":
+        return fileStore.writeGlobalFile(path, cleanup=cleanup)
+    compressedPath = fileStore.getLocalTempFile()
+    codec.compressFile(path, compressedPath)
+    return fileStore.writeGlobalFile(compressedPath, cleanup=cleanup)
+
+def readGlobalFileDecompressed(fileStore, fileID, codec):
+    """Read a file written by writeGlobalFileCompressed, returning the path
+    to its decompressed contents."""
+    path = fileStore.readGlobalFile(fileID)
+    if codec.name == "none":
+        return path
+    decompressedPath = fileStore.getLocalTempFile()
+    codec.decompressFile(path, decompressedPath)
+    return decompressedPath
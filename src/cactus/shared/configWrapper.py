@@ -15,6 +15,7 @@ from xml.dom import minidom
 import sys
 from cactus.shared.common import findRequiredNode
 from cactus.shared.common import getOptionalAttrib
+from cactus.shared.compression import getCodec
 
 class ConfigWrapper:
     defaultOutgroupStrategy = 'none'
@@ -95,6 +96,12 @@ class ConfigWrapper:
             return trimBlastNode.attrib["doTrimStrategy"] == "1"
         return False
 
+    def getTrimCores(self, default=1):
+        trimBlastNode = self.xmlRoot.find("trimBlast")
+        if trimBlastNode is not None and "trimCores" in trimBlastNode.attrib:
+            return int(trimBlastNode.attrib["trimCores"])
+        return default
+
     def getDoSelfAlignment(self):
         decompElem = self.getDecompositionElem()
         doSelf = self.defaultDoSelf
@@ -165,6 +172,27 @@ class ConfigWrapper:
             return int(ktServerElem.attrib["cpu"])
         return default
 
+    def getKtserverSnapshotCodec(self, default="gzip"):
+        ktServerElem = self.xmlRoot.find("ktserver")
+        if ktServerElem is not None and "snapshotCodec" in ktServerElem.attrib:
+            return ktServerElem.attrib["snapshotCodec"]
+        return default
+
+    def getKtserverPersistentPrimaryDb(self, default="auto"):
+        ktServerElem = self.xmlRoot.find("ktserver")
+        if ktServerElem is not None and "persistentPrimaryDb" in ktServerElem.attrib:
+            return ktServerElem.attrib["persistentPrimaryDb"]
+        return default
+
+    def checkCodecs(self):
+        """Raise a RuntimeError if a compression codec the config asks for
+        isn't installed, so that it fails before the alignment starts rather
+        than in its first job that compresses anything."""
+        cafElem = self.xmlRoot.find("caf")
+        if cafElem is not None and getOptionalAttrib(cafElem, "compressFiles", bool, False):
+            getCodec(getOptionalAttrib(cafElem, "compressionCodec", str, "gzip"))
+        getCodec(self.getKtserverSnapshotCodec())
+
     def getDefaultMemory(self):
         constantsElem = self.xmlRoot.find("constants")
         return int(constantsElem.attrib["defaultMemory"])
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Basic statistics (contig lengths, N content, masked fraction, N50)
+about FASTA files, computed in a single pass. They can be stored in the
+file store as a sidecar of the sequence's file ID so that the same
+sequence is not rescanned by every job that needs them.
+"""
+import os
+import json
+import string
+from collections import OrderedDict
+
+# As in cactus_analyseAssembly, anything but an uppercase base is masked
+UPPERCASE = string.ascii_uppercase.encode()
+
+class FastaStats(object):
+    """Lengths of the contigs in a set of FASTA files, along with the
+    totals reported by cactus_analyseAssembly."""
+    def __init__(self):
+        # header (first word, as in trimSequences.getSeqLengths) -> length
+        self.seqLengths = OrderedDict()
+        # length of every record, even if headers are duplicated
+        self.recordLengths = []
+        self.numNs = 0
+        # cactus_analyseAssembly counts Ns as masked too
+        self.numMasked = 0
+
+    @staticmethod
+    def fromFasta(paths):
+        """Scan one or more FASTA files (or directories of them)."""
+        if isinstance(paths, str):
+            paths = [paths]
+        stats = FastaStats()
+        for path in paths:
+            if os.path.isdir(path):
+                for name in sorted(os.listdir(path)):
+                    stats.addFasta(os.path.join(path, name))
+            else:
+                stats.addFasta(path)
+        return stats
+
+    def addFasta(self, path):
+        header = None
+        length = 0
+        with open(path, 'rb') as fastaFile:
+            for line in fastaFile:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                if line[:1] == b'>':
+                    if header is not None:
+                        self.addRecord(header, length)
+                    header = line[1:].split()[0].decode() if len(line) > 1 else ""
+                    length = 0
+                else:
+                    self.numNs += line.count(b'N') + line.count(b'n')
+                    self.numMasked += len(line.translate(None, UPPERCASE)) + line.count(b'N')
+                    length += len(line)
+        if header is not None:
+            self.addRecord(header, length)
+
+    def addRecord(self, header, length):
+        self.seqLengths[header] = self.seqLengths.get(header, 0) + length
+        self.recordLengths.append(length)
+
+    @property
+    def numSequences(self):
+        return len(self.recordLengths)
+
+    @property
+    def totalLength(self):
+        return sum(self.recordLengths)
+
+    @property
+    def proportionNs(self):
+        return float(self.numNs) / self.totalLength if self.totalLength > 0 else float('nan')
+
+    @property
+    def proportionMasked(self):
+        return float(self.numMasked) / self.totalLength if self.totalLength > 0 else float('nan')
+
+    @property
+    def n50(self):
+        """N50 as computed by cactus_analyseAssembly."""
+        totalLength = self.totalLength
+        n50 = 0
+        cumulative = 0
+        for length in sorted(self.recordLengths, reverse=True):
+            n50 = length
+            cumulative += length
+            if cumulative >= totalLength // 2:
+                break
+        return n50
+
+    def summary(self):
+        """Format the stats the same way as cactus_analyseAssembly."""
+        lengths = sorted(self.recordLengths)
+        return ("Total-sequences: %d Total-length: %d Proportion-repeat-masked: %f "
+                "ProportionNs: %f Total-Ns: %d N50: %d Median-sequence-length: %d "
+                "Max-sequence-length: %d Min-sequence-length: %d" % (
+                    self.numSequences, self.totalLength, self.proportionMasked,
+                    self.proportionNs, self.numNs, self.n50,
+                    lengths[len(lengths) // 2] if lengths else 0,
+                    lengths[-1] if lengths else 0,
+                    lengths[0] if lengths else 0))
+
+    def writeJSON(self, path):
+        with open(path, 'w') as statsFile:
+            json.dump({"seqLengths": list(self.seqLengths.items()),
+                       "recordLengths": self.recordLengths,
+                       "numNs": self.numNs,
+                       "numMasked": self.numMasked}, statsFile)
+
+    @staticmethod
+    def readJSON(path):
+        with open(path) as statsFile:
+            data = json.load(statsFile)
+        stats = FastaStats()
+        stats.seqLengths = OrderedDict(data["seqLengths"])
+        stats.recordLengths = data["recordLengths"]
+        stats.numNs = data["numNs"]
+        stats.numMasked = data["numMasked"]
+        return stats
+
+def writeFastaStats(fileStore, stats):
+    """Write the stats to the file store as a sidecar for their sequence,
+    returning the sidecar's file ID."""
+    statsPath = fileStore.getLocalTempFile()
+    stats.writeJSON(statsPath)
+    return fileStore.writeGlobalFile(statsPath)
+
+def getFastaStats(fileStore, sequenceID, statsIDMap=None, path=None):
+    """Get the FastaStats of a sequence in the file store. If statsIDMap
+    (str(sequence ID) -> sidecar ID, as in
+    MultiCactusProject.sequenceStatsIDMap) has a sidecar for the
+    sequence it is read instead of the sequence. path can be given if
+    the sequence has already been read locally."""
+    if statsIDMap is not None and str(sequenceID) in statsIDMap:
+        return FastaStats.readJSON(fileStore.readGlobalFile(statsIDMap[str(sequenceID)]))
+    if path is None:
+        path = fileStore.readGlobalFile(sequenceID)
+    return FastaStats.fromFasta(path)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+"""Tests the FASTA stats that replace cactus_analyseAssembly.
+"""
+
+import unittest
+import os
+from sonLib.bioio import TestStatus
+from sonLib.bioio import getTempFile
+from cactus.shared.fastaStats import FastaStats
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tempFiles = []
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        for tempFile in self.tempFiles:
+            if os.path.exists(tempFile):
+                os.remove(tempFile)
+
+    def writeFasta(self, contents):
+        path = getTempFile()
+        self.tempFiles.append(path)
+        with open(path, 'w') as fastaFile:
+            fastaFile.write(contents)
+        return path
+
+    @TestStatus.shortLength
+    def testStats(self):
+        fasta = self.writeFasta(">seq1 desc\nACGTacgt\nNNnn\n\n>seq2\nACG\n>seq3\nacgtACGTACGTACGTACGTAC\n")
+        stats = FastaStats.fromFasta(fasta)
+        self.assertEqual(list(stats.seqLengths.items()), [("seq1", 12), ("seq2", 3), ("seq3", 22)])
+        self.assertEqual(stats.numSequences, 3)
+        self.assertEqual(stats.totalLength, 37)
+        self.assertEqual(stats.numNs, 4)
+        # Lowercase bases and Ns count as masked
+        self.assertEqual(stats.numMasked, 12)
+        self.assertEqual(stats.n50, 22)
+        self.assertEqual(stats.summary(),
+                         "Total-sequences: 3 Total-length: 37 Proportion-repeat-masked: 0.324324 "
+                         "ProportionNs: 0.108108 Total-Ns: 4 N50: 22 Median-sequence-length: 12 "
+                         "Max-sequence-length: 22 Min-sequence-length: 3")
+
+    @TestStatus.shortLength
+    def testMaskedLikeAnalyseAssembly(self):
+        # Everything but an uppercase letter is masked, gaps included, and so are Ns
+        stats = FastaStats.fromFasta(self.writeFasta(">seq\nACGTRY-*\nacgtryNn\n"))
+        self.assertEqual(stats.totalLength, 16)
+        self.assertEqual(stats.numMasked, 10)
+
+    @TestStatus.shortLength
+    def testMultipleFilesAndJSON(self):
+        fasta1 = self.writeFasta(">a\nAC\n>b\n")
+        fasta2 = self.writeFasta(">a\nACGT\n")
+        stats = FastaStats.fromFasta([fasta1, fasta2])
+        self.assertEqual(stats.numSequences, 3)
+        # Duplicated headers are summed, like trimSequences.getSeqLengths
+        self.assertEqual(dict(stats.seqLengths), {"a": 6, "b": 0})
+        jsonPath = getTempFile()
+        self.tempFiles.append(jsonPath)
+        stats.writeJSON(jsonPath)
+        readStats = FastaStats.readJSON(jsonPath)
+        self.assertEqual(readStats.seqLengths, stats.seqLengths)
+        self.assertEqual(readStats.summary(), stats.summary())
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Counts of the records and bytes that pass through the files a command
+reads or writes, gathered as the data streams through rather than by
+reading the files again afterwards.
+"""
+import os
+import threading
+
+class StreamStats(object):
+    """Number of records (lines) and bytes in a stream."""
+    def __init__(self, name):
+        self.name = name
+        self.records = 0
+        self.bytes = 0
+
+    def update(self, data):
+        self.records += data.count(b'\n')
+        self.bytes += len(data)
+
+    def __add__(self, other):
+        total = StreamStats(self.name)
+        total.records = self.records + other.records
+        total.bytes = self.bytes + other.bytes
+        return total
+
+    def __str__(self):
+        return "%s has %d lines (%d bytes)" % (self.name, self.records, self.bytes)
+
+class CountingTee(object):
+    """Puts a FIFO in front of a file, and copies data between the two in a
+    background thread, counting it. A command given the FIFO instead of
+    the file then reads (mode 'r') or writes (mode 'w') the file as usual,
+    and the counts are in stats once the tee is closed.
+
+    Use as a context manager around the command, so the copying thread is
+    always stopped, even if the command never opens the FIFO.
+
+    The FIFO is made next to the file, so a command given both the FIFO and
+    other files in that directory only needs that directory mounted when
+    it runs in a container.
+    """
+    def __init__(self, path, mode, name=None):
+        assert mode in ('r', 'w')
+        self.path = path
+        self.mode = mode
+        self.fifo = path + ".fifo"
+        os.mkfifo(self.fifo)
+        self.stats = StreamStats(name if name is not None else os.path.basename(path))
+        self.error = None
+        self.thread = threading.Thread(target=self._copy)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _copy(self):
+        try:
+            if self.mode == 'w':
+                source, dest = open(self.fifo, 'rb'), open(self.path, 'wb')
+            else:
+                source, dest = open(self.path, 'rb'), open(self.fifo, 'wb')
+            with source, dest:
+                while True:
+                    data = source.read(1024*1024)
+                    if not data:
+                        break
+                    dest.write(data)
+                    self.stats.update(data)
+        except OSError as e:
+            # The command stopped reading early, or never opened the FIFO
+            self.error = e
+
+    def close(self):
+        """Wait for the copy to finish and remove the FIFO. Raises the
+        error if a file being written couldn't be copied."""
+        while self.thread.is_alive():
+            # Open the other end of the FIFO, in case the command didn't,
+            # so that the thread isn't left waiting for it
+            try:
+                fd = os.open(self.fifo, (os.O_WRONLY if self.mode == 'w' else os.O_RDONLY) | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+            self.thread.join(0.1)
+        os.remove(self.fifo)
+        if self.error is not None and self.mode == 'w':
+            # The file is incomplete
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+"""Tests counting the data a command reads and writes through FIFOs.
+"""
+
+import unittest
+import os
+import shutil
+import subprocess
+from sonLib.bioio import TestStatus
+from sonLib.bioio import getTempDirectory
+from cactus.shared.streamStats import CountingTee
+from cactus.shared.common import prepareWorkDir
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tempDir = getTempDirectory(os.getcwd())
+        self.inputFile = os.path.join(self.tempDir, "input")
+        with open(self.inputFile, 'w') as inputFile:
+            inputFile.write("a line\n" * 100000)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tempDir)
+
+    @TestStatus.shortLength
+    def testCountingTee(self):
+        outputFile = os.path.join(self.tempDir, "output")
+        unusedFile = os.path.join(self.tempDir, "unused")
+        with CountingTee(self.inputFile, 'r', name="Input") as inputTee, \
+             CountingTee(outputFile, 'w') as outputTee, \
+             CountingTee(unusedFile, 'w') as unusedTee:
+            with open(inputTee.fifo) as stdin, open(outputTee.fifo, 'w') as stdout:
+                subprocess.check_call(["cat"], stdin=stdin, stdout=stdout)
+        self.assertEqual((inputTee.stats.records, inputTee.stats.bytes), (100000, 700000))
+        self.assertEqual((outputTee.stats.records, outputTee.stats.bytes), (100000, 700000))
+        self.assertEqual(str(inputTee.stats), "Input has 100000 lines (700000 bytes)")
+        # The command never opened this one, but the tee still finishes
+        self.assertEqual(unusedTee.stats.records, 0)
+        with open(outputFile) as output, open(self.inputFile) as original:
+            self.assertEqual(output.read(), original.read())
+        # Only the real files are left
+        self.assertEqual(sorted(os.listdir(self.tempDir)), ["input", "output", "unused"])
+
+    @TestStatus.shortLength
+    def testCountingTeeInContainer(self):
+        """The FIFOs should be mounted along with the files next to them
+        when the command runs in a container."""
+        outputFiles = [os.path.join(self.tempDir, name) for name in ("output1", "output2")]
+        with CountingTee(self.inputFile, 'r') as inputTee, \
+             CountingTee(outputFiles[0], 'w') as outputTee1, \
+             CountingTee(outputFiles[1], 'w') as outputTee2:
+            workDir, parameters = prepareWorkDir(None, ["tee", outputTee1.fifo, outputTee2.fifo])
+            self.assertEqual(workDir, self.tempDir)
+            self.assertEqual(parameters, ["tee", "output1.fifo", "output2.fifo"])
+            # Run from the work dir, as it would be from its mount point
+            with open(inputTee.fifo) as stdin:
+                subprocess.check_call(parameters, cwd=workDir, stdin=stdin, stdout=subprocess.DEVNULL)
+        for tee in (outputTee1, outputTee2):
+            self.assertEqual((tee.stats.records, tee.stats.bytes), (100000, 700000))
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()